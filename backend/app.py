@@ -1,16 +1,29 @@
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, suppress
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 
-from similarities.db import create_db_and_tables
+from similarities.cache import result_cache
+from similarities.db import async_engine, create_db_and_tables
 from similarities.api import router
+from similarities.jobs import histogram_job_buffer, schedule_vector_indexes_maintenance
+from similarities.metrics import RequestMetricsMiddleware, latest_metrics
+from similarities.query_image import query_image_executor
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_db_and_tables()
+    schedule_vector_indexes_maintenance()
+    flush_task = asyncio.create_task(histogram_job_buffer.run_periodic_flush())
     yield
+    flush_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await flush_task
+    histogram_job_buffer.flush()
+    query_image_executor.shutdown()
+    await async_engine.dispose()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -21,9 +34,21 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestMetricsMiddleware)
 app.include_router(router)
 
 
 @app.get("/healthcheck")
 async def healthcheck():
     return {"status": "ok"}
+
+
+@app.get("/stats/cache")
+async def cache_stats():
+    return dict(result_cache.stats)
+
+
+@app.get("/metrics")
+async def metrics():
+    content, content_type = latest_metrics()
+    return Response(content, media_type=content_type)
@@ -0,0 +1,152 @@
+"""
+Recall vs latency of pgvector ANN indexes for different `probes` (ivfflat) and `ef_search` (hnsw) values.
+
+Synthetic histogram-like vectors are written to a separate `benchmark_vectors` table in DATABASE_URL database.
+Exact results (sequential scan) are compared with results found using the index.
+With `--precision half` the index is built on vectors cast to halfvec (pgvector 0.7+) and the nearest
+`limit * rerank-factor` rows found with it are reranked with full vectors, like searches of the app do.
+
+Usage: python -m benchmarks.ann_recall [--rows 100000] [--dimensions 512] [--queries 100] [--limit 10]
+                                       [--method hnsw] [--precision full] [--rerank-factor 4] [--keep-table]
+"""
+import argparse
+import time
+
+import numpy as np
+from pgvector.psycopg import register_vector
+
+from similarities.db import engine
+
+
+TABLE_NAME = "benchmark_vectors"
+INDEX_NAME = "benchmark_vectors_index"
+PROBES = [1, 2, 5, 10, 20, 50]
+EF_SEARCH = [10, 20, 40, 80, 160, 320]
+
+
+def synthetic_vectors(rows: int, dimensions: int, seed: int = 0) -> np.ndarray:
+    # Non-negative, L2 normalized and clustered, like color histograms of similar photos
+    rng = np.random.default_rng(seed)
+    centers = rng.dirichlet(np.full(dimensions, 0.1), size=max(rows // 20, 1))
+    vectors = centers[rng.integers(0, len(centers), rows)] + rng.exponential(0.01, (rows, dimensions))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+
+def create_table(connection, vectors: np.ndarray):
+    connection.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}")
+    connection.execute(f"CREATE TABLE {TABLE_NAME} (id integer PRIMARY KEY, embedding vector({vectors.shape[1]}))")
+    with connection.cursor().copy(f"COPY {TABLE_NAME} (id, embedding) FROM STDIN WITH (FORMAT BINARY)") as copy:
+        copy.set_types(["int4", "vector"])
+        for row_id, vector in enumerate(vectors):
+            copy.write_row((row_id, vector))
+    connection.execute(f"ANALYZE {TABLE_NAME}")
+
+
+def nearest(connection, query: np.ndarray, limit: int) -> tuple[list[int], float]:
+    start = time.perf_counter()
+    rows = connection.execute(
+        f"SELECT id FROM {TABLE_NAME} ORDER BY embedding <-> %s LIMIT %s", (query, limit)
+    ).fetchall()
+    return [row[0] for row in rows], time.perf_counter() - start
+
+
+def nearest_half_precision(connection, query: np.ndarray, limit: int, candidates: int) -> tuple[list[int], float]:
+    start = time.perf_counter()
+    half_vector = f"halfvec({len(query)})"
+    rows = connection.execute(
+        f"SELECT id FROM ("
+        f"SELECT id, embedding <-> %s AS distance FROM {TABLE_NAME} "
+        f"ORDER BY embedding::{half_vector} <-> %s::{half_vector} LIMIT %s"
+        f") candidates ORDER BY distance LIMIT %s",
+        (query, query, candidates, limit),
+    ).fetchall()
+    return [row[0] for row in rows], time.perf_counter() - start
+
+
+def measure(
+        connection, queries: np.ndarray, exact_results: list[set[int]], limit: int, rerank_factor: int | None = None
+) -> tuple[float, float, float]:
+    recalls, latencies = [], []
+    for query, exact in zip(queries, exact_results):
+        if rerank_factor:
+            result, latency = nearest_half_precision(connection, query, limit, limit * rerank_factor)
+        else:
+            result, latency = nearest(connection, query, limit)
+        recalls.append(len(exact.intersection(result)) / len(exact))
+        latencies.append(latency)
+    return float(np.mean(recalls)), float(np.percentile(latencies, 50)), float(np.percentile(latencies, 95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--dimensions", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    parser.add_argument("--precision", choices=["full", "half"], default="full")
+    parser.add_argument("--rerank-factor", type=int, default=4, help="Candidates per result with --precision half")
+    parser.add_argument("--keep-table", action="store_true")
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.rows + args.queries, args.dimensions)
+    table_vectors, queries = vectors[:args.rows], vectors[args.rows:]
+
+    connection = engine.raw_connection().driver_connection
+    connection.autocommit = True
+    register_vector(connection)
+    try:
+        create_table(connection, table_vectors)
+
+        connection.execute("SET enable_indexscan = off")
+        exact_results, exact_latencies = [], []
+        for query in queries:
+            result, latency = nearest(connection, query, args.limit)
+            exact_results.append(set(result))
+            exact_latencies.append(latency)
+        connection.execute("SET enable_indexscan = on")
+        print(f"{args.rows} rows, {args.dimensions} dimensions, {args.queries} queries, limit {args.limit}")
+        print(f"exact: p50 {np.percentile(exact_latencies, 50) * 1000:.1f}ms "
+              f"p95 {np.percentile(exact_latencies, 95) * 1000:.1f}ms")
+
+        if args.method == "ivfflat":
+            lists = max(args.rows // 1000, 1)
+            options, setting, values = f"lists = {lists}", "ivfflat.probes", PROBES
+        else:
+            options, setting, values = "m = 16, ef_construction = 64", "hnsw.ef_search", EF_SEARCH
+
+        if args.precision == "half":
+            indexed = f"(embedding::halfvec({args.dimensions})) halfvec_l2_ops"
+            rerank_factor = args.rerank_factor
+        else:
+            indexed, rerank_factor = "embedding vector_l2_ops", None
+
+        start = time.perf_counter()
+        connection.execute(
+            f"CREATE INDEX {INDEX_NAME} ON {TABLE_NAME} USING {args.method} ({indexed}) WITH ({options})"
+        )
+        index_size, table_size = connection.execute(
+            f"SELECT pg_size_pretty(pg_relation_size('{INDEX_NAME}')), "
+            f"pg_size_pretty(pg_total_relation_size('{TABLE_NAME}') - pg_indexes_size('{TABLE_NAME}'))"
+        ).fetchone()
+        print(
+            f"{args.method} {args.precision} precision ({options}) built in {time.perf_counter() - start:.1f}s, "
+            f"index size {index_size}, table size {table_size}"
+        )
+
+        for value in values:
+            # hnsw returns at most ef_search rows, like in the app it has to cover all the candidates
+            if setting == "hnsw.ef_search" and rerank_factor:
+                value = max(value, args.limit * rerank_factor)
+            connection.execute(f"SET {setting} = {value}")
+            recall, p50, p95 = measure(connection, queries, exact_results, args.limit, rerank_factor)
+            print(f"{setting}={value:<4} recall {recall:.3f} p50 {p50 * 1000:.1f}ms p95 {p95 * 1000:.1f}ms")
+    finally:
+        if not args.keep_table:
+            connection.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}")
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
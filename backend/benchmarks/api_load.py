@@ -0,0 +1,115 @@
+"""
+Latency of the running API under concurrent mixed upload/search load.
+
+Seed images are uploaded first and searched for afterwards, while the other part of requests uploads new images.
+Reports throughput and latency percentiles per endpoint, the tail shows if requests wait for each other.
+
+Usage: python -m benchmarks.api_load [--url http://localhost] [--concurrency 20] [--duration 30]
+                                     [--upload-ratio 0.2] [--seed-images 20] [--unique-images 300]
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import defaultdict
+
+import cv2
+import httpx
+import numpy as np
+
+from benchmarks.histograms import synthetic_images
+from similarities.serializers import SearchType
+
+
+async def upload(client: httpx.AsyncClient, image: bytes) -> str:
+    response = await client.post("/upload", files={"image": ("image.jpg", image, "image/jpeg")})
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+async def search(client: httpx.AsyncClient, image_id: str, search_type: SearchType):
+    response = await client.get(f"/similar/{image_id}/{search_type.value}")
+    response.raise_for_status()
+
+
+async def wait_until_processed(client: httpx.AsyncClient, image_ids: list[str], timeout: float):
+    deadline = time.monotonic() + timeout
+    for image_id in image_ids:
+        while time.monotonic() < deadline:
+            response = await client.get(f"/similar/{image_id}/{SearchType.COLORS.value}")
+            if response.json()["status"] == "ok":
+                break
+            await asyncio.sleep(0.5)
+        else:
+            print("Seed images not processed in time, searches may return `processing` status")
+            return
+
+
+async def run_worker(
+        client: httpx.AsyncClient,
+        deadline: float,
+        upload_ratio: float,
+        images: list[bytes],
+        seed_ids: list[str],
+        latencies: dict[str, list[float]],
+        errors: dict[str, int],
+):
+    while time.monotonic() < deadline:
+        if random.random() < upload_ratio:
+            name, request = "upload", upload(client, random.choice(images))
+        else:
+            name, request = "similar", search(client, random.choice(seed_ids), random.choice(list(SearchType)))
+
+        start = time.perf_counter()
+        try:
+            await request
+        except httpx.HTTPError:
+            errors[name] += 1
+            continue
+        latencies[name].append(time.perf_counter() - start)
+
+
+async def run(args):
+    images = [
+        cv2.imencode(".jpg", image)[1].tobytes()
+        for image in synthetic_images(args.unique_images + args.seed_images, args.width, args.height)
+    ]
+    seed_images, images = images[:args.seed_images], images[args.seed_images:]
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        seed_ids = [await upload(client, image) for image in seed_images]
+        await wait_until_processed(client, seed_ids, timeout=120)
+
+        latencies, errors = defaultdict(list), defaultdict(int)
+        start = time.monotonic()
+        await asyncio.gather(*(
+            run_worker(client, start + args.duration, args.upload_ratio, images, seed_ids, latencies, errors)
+            for _ in range(args.concurrency)
+        ))
+        elapsed = time.monotonic() - start
+
+    print(f"{args.concurrency} concurrent clients, {elapsed:.0f}s, {args.upload_ratio:.0%} uploads")
+    for name, timings in sorted(latencies.items()):
+        p50, p95, p99 = np.percentile(timings, [50, 95, 99]) * 1000
+        print(
+            f"{name:<8} {len(timings) / elapsed:7.1f} req/s  p50 {p50:7.1f}ms  p95 {p95:7.1f}ms  "
+            f"p99 {p99:7.1f}ms  max {max(timings) * 1000:7.1f}ms  errors {errors[name]}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--upload-ratio", type=float, default=0.2)
+    parser.add_argument("--seed-images", type=int, default=20)
+    parser.add_argument("--unique-images", type=int, default=300, help="Uploads after that are duplicates")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
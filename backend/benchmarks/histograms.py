@@ -0,0 +1,75 @@
+"""
+Compares calculating histograms with the single image functions against the batch API.
+
+Usage: python -m benchmarks.histograms [--images 20] [--width 2000] [--height 1500] [--repeat 3]
+                                       [--texture-filter fft] [--texture-max-side 1024]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from similarities.histograms import (
+    calculate_color_histogram,
+    calculate_histograms_batch,
+    calculate_hog_histogram,
+    calculate_texture_histogram,
+    TextureFilter,
+)
+
+
+def synthetic_images(count: int, width: int, height: int, seed: int = 0) -> list[np.ndarray]:
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        # Smooth gradients with noise on top look more like photos than plain noise
+        base = np.linspace(0, 255, width, dtype=np.float32)[None, :, None] * rng.random((1, 1, 3))
+        noise = rng.normal(0, 25, (height, width, 3))
+        images.append(np.clip(base + noise, 0, 255).astype(np.uint8))
+    return images
+
+
+def run_single_image_functions(images: list[np.ndarray]):
+    for image in images:
+        calculate_color_histogram(image)
+        calculate_hog_histogram(image)
+        calculate_texture_histogram(image)
+
+
+def measure(function, images: list[np.ndarray], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(images)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--width", type=int, default=2000)
+    parser.add_argument("--height", type=int, default=1500)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--texture-filter", type=TextureFilter, default=TextureFilter.SPATIAL)
+    parser.add_argument("--texture-max-side", type=int, default=None)
+    args = parser.parse_args()
+
+    images = synthetic_images(args.images, args.width, args.height)
+
+    single = measure(run_single_image_functions, images, args.repeat)
+    batch = measure(
+        lambda batch_images: calculate_histograms_batch(batch_images, args.texture_max_side, args.texture_filter),
+        images,
+        args.repeat,
+    )
+
+    print(f"{args.images} images {args.width}x{args.height}, best of {args.repeat}")
+    print(f"batch texture filter: {args.texture_filter.value}, max side: {args.texture_max_side}")
+    print(f"single image functions: {single:.3f}s ({args.images / single:.1f} images/s)")
+    print(f"batch:                  {batch:.3f}s ({args.images / batch:.1f} images/s)")
+    print(f"speedup:                {single / batch:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
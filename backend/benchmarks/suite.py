@@ -0,0 +1,550 @@
+"""
+Benchmark suite of ingestion and search, with results written as JSON to compare them between changes.
+
+Benchmarks:
+- descriptors: time of every histogram calculation stage per synthetic image
+- worker: throughput of the histograms job (`update_images_histograms`) on synthetic image files
+- workers: throughput of rq worker processes running the histograms jobs, forking `MetricsWorker`
+  vs non-forking `WarmWorker`
+- search: latency percentiles of similarity searches on a synthetic table for every search type,
+  `limit` and `max_distance` combination
+- response: bytes of the rows read from the database for a search with `--response-limit` results
+  (whole rows vs selected columns) and time of serializing its response (pydantic models vs plain dicts)
+- partitions: latency of searches of the table hash partitioned into `--partition-counts` partitions
+  by the partitioned backend, searching all partitions at once (0 is a table without partitions)
+- startup: import time and resident memory of fresh API (`app`) and worker (`similarities.processing`)
+  processes, median of `--startup-runs` runs
+
+Worker(s), search, response and partitions benchmarks use `image` table in a separate `benchmark` schema
+of DATABASE_URL database (or --database-url), dropped at the end unless --keep-schema is given.
+
+Usage: python -m benchmarks.suite run [--output benchmark.json]
+                                      [--only startup,descriptors,worker,workers,search,response,partitions]
+                                      [--images 20] [--width 1024] [--height 768] [--batch-size 10]
+                                      [--rows 10000] [--queries 100] [--limits 10,100] [--max-distances none,0.5]
+                                      [--response-limit 1000] [--startup-runs 5] [--backend postgres] [--index none]
+                                      [--partition-counts 0,2,4,8] [--keep-schema]
+       python -m benchmarks.suite compare BASELINE CURRENT [--threshold 0.1]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, UTC
+from unittest.mock import patch
+from uuid import uuid4
+
+import cv2
+import numpy as np
+from decouple import config
+from pgvector.psycopg import register_vector
+from fastapi.encoders import jsonable_encoder
+from prometheus_client import REGISTRY
+from pydantic import HttpUrl
+from rq import Queue
+from sqlalchemy import Engine, make_url, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, SQLModel, create_engine, func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from benchmarks.ann_recall import synthetic_vectors
+from benchmarks.histograms import synthetic_images
+from similarities.api import _similar_images_response
+from similarities.derivative_keys import DerivativeKind, get_derivative_key
+from similarities.histograms import (
+    COLOR_HISTOGRAM_VECTOR_SIZE,
+    HOG_HISTOGRAM_VECTOR_SIZE,
+    TEXTURE_HISTOGRAM_VECTOR_SIZE,
+    calculate_histograms,
+)
+from similarities.indexes import INDEX_NAMES
+from similarities.jobs import redis_conn
+from similarities.models import Image
+from similarities.partitions import migrate
+from similarities.processing import TEXTURE_FILTER, TEXTURE_MAX_SIDE, update_images_histograms
+from similarities.search import PartitionedSearchBackend, SearchBackend, create_search_backend
+from similarities.serializers import (
+    SearchType, SimilarImageEntry, SimilarImagesResponse, SimilarResponseStatus, SEARCH_TYPE_TO_COLUMN_NAME
+)
+from similarities.storage import storage
+
+
+SCHEMA = "benchmark"
+DESCRIPTOR_STAGES = ("prepare", "color", "hog", "texture")
+COPY_CHUNK_ROWS = 10000
+
+WORKER_CLASSES = {
+    "forking": "similarities.metrics.MetricsWorker",
+    "warm": "similarities.worker.WarmWorker",
+}
+
+STARTUP_MODULES = {
+    "api": "app",
+    "worker": "similarities.processing",
+}
+# Peak RSS from getrusage is inherited from the benchmark process, current RSS of the process is read instead
+STARTUP_SCRIPT = """
+import os, time
+start = time.perf_counter()
+import {module}
+with open("/proc/self/statm") as statm:
+    print(time.perf_counter() - start, int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))
+"""
+
+# Metrics with these suffixes are better when lower, the rest when higher
+LOWER_IS_BETTER = ("_ms", "_seconds", "_bytes")
+
+
+def summarize(name: str, timings: list[float]) -> dict[str, float]:
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99]) * 1000
+    return {
+        f"{name}.p50_ms": float(p50),
+        f"{name}.p95_ms": float(p95),
+        f"{name}.p99_ms": float(p99),
+        f"{name}.mean_ms": float(np.mean(timings) * 1000),
+    }
+
+
+def benchmark_startup(args) -> dict[str, float]:
+    results = {}
+    for name, module in STARTUP_MODULES.items():
+        runs = [
+            [float(value) for value in subprocess.run(
+                [sys.executable, "-c", STARTUP_SCRIPT.format(module=module)],
+                check=True, capture_output=True, text=True,
+            ).stdout.split()]
+            for _ in range(args.startup_runs)
+        ]
+        import_seconds, rss_bytes = np.median(runs, axis=0)
+        results[f"startup.{name}.import_seconds"] = float(import_seconds)
+        results[f"startup.{name}.rss_bytes"] = float(rss_bytes)
+    return results
+
+
+def benchmark_descriptors(args) -> dict[str, float]:
+    images = synthetic_images(args.images, args.width, args.height)
+    timings = {stage: [] for stage in DESCRIPTOR_STAGES}
+    for image in images:
+        # Stages are timed by the same metrics as in production
+        before = {stage: _histogram_sum(stage) for stage in DESCRIPTOR_STAGES}
+        calculate_histograms(image, TEXTURE_MAX_SIDE, TEXTURE_FILTER)
+        for stage in DESCRIPTOR_STAGES:
+            timings[stage].append(_histogram_sum(stage) - before[stage])
+
+    results = {}
+    for stage, stage_timings in timings.items():
+        results.update(summarize(f"descriptors.{stage}", stage_timings))
+    return results
+
+
+def _histogram_sum(stage: str) -> float:
+    return REGISTRY.get_sample_value("similarities_processing_duration_seconds_sum", {"stage": stage}) or 0.0
+
+
+def create_image_files(args, session: Session, directory: str) -> list:
+    image_ids = []
+    for index, image in enumerate(synthetic_images(args.images, args.width, args.height, seed=1)):
+        path = os.path.join(directory, f"{index}.jpg")
+        cv2.imwrite(path, image)
+        image_ids.append(uuid4())
+        session.add(Image(id=image_ids[-1], path=path))
+    session.commit()
+    return image_ids
+
+
+def benchmark_worker(args, engine: Engine) -> dict[str, float]:
+    with tempfile.TemporaryDirectory(prefix="benchmark") as directory, Session(engine) as session:
+        image_ids = create_image_files(args, session, directory)
+
+        # Worker uses a session of its own engine, the results cache of the app is not invalidated
+        with (
+            patch("similarities.processing.get_session_instance", return_value=session),
+            patch("similarities.processing.result_cache"),
+        ):
+            start = time.perf_counter()
+            for batch_start in range(0, len(image_ids), args.batch_size):
+                update_images_histograms(image_ids[batch_start:batch_start + args.batch_size])
+            elapsed = time.perf_counter() - start
+
+        session.execute(text("DELETE FROM image WHERE id = ANY(:ids)"), {"ids": image_ids})
+        session.commit()
+
+    return {"worker.images_per_second": len(image_ids) / elapsed, "worker.seconds": elapsed}
+
+
+def benchmark_worker_classes(args, engine: Engine) -> dict[str, float]:
+    """
+    Every worker class is started as a separate process in burst mode, with jobs of `--batch-size` images
+    waiting in its queue. Time includes the start of the worker. Jobs use the benchmark schema.
+    """
+
+    database_url = make_url(args.database_url).update_query_dict({"options": f"-c search_path={SCHEMA},public"})
+    worker_environment = {
+        **os.environ,
+        "DATABASE_URL": database_url.render_as_string(hide_password=False),
+        "WORKER_METRICS_PORT": "0",
+    }
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="benchmark") as directory, Session(engine) as session:
+        image_ids = create_image_files(args, session, directory)
+        for name, worker_class in WORKER_CLASSES.items():
+            session.execute(
+                text(
+                    "UPDATE image SET color_hist = NULL, hog_hist = NULL, texture_hist = NULL, processed_at = NULL "
+                    "WHERE id = ANY(:ids)"
+                ),
+                {"ids": image_ids},
+            )
+            session.commit()
+            queue = Queue(f"benchmark-{uuid4()}", connection=redis_conn)
+            queue.enqueue_many([
+                Queue.prepare_data(
+                    "similarities.processing.update_images_histograms",
+                    ([str(image_id) for image_id in image_ids[batch_start:batch_start + args.batch_size]],),
+                )
+                for batch_start in range(0, len(image_ids), args.batch_size)
+            ])
+
+            start = time.perf_counter()
+            subprocess.run(
+                ["rq", "worker", queue.name, "--burst", "-c", "queue_settings", "-w", worker_class],
+                env=worker_environment, check=True, capture_output=True,
+            )
+            elapsed = time.perf_counter() - start
+            queue.delete(delete_jobs=True)
+
+            processed = session.scalar(
+                select(func.count()).select_from(Image).where(Image.id.in_(image_ids), Image.processed_at.is_not(None))
+            )
+            results[f"workers.{name}.images_per_second"] = processed / elapsed
+            results[f"workers.{name}.seconds"] = elapsed
+
+        session.execute(text("DELETE FROM image WHERE id = ANY(:ids)"), {"ids": image_ids})
+        session.commit()
+    return results
+
+
+def create_vector_table(engine: Engine, rows: int, index_method: str):
+    """
+    Fills the benchmark table with `rows` synthetic images, written with COPY in chunks to keep memory usage low.
+    """
+
+    dimensions = {
+        "color_hist": COLOR_HISTOGRAM_VECTOR_SIZE,
+        "hog_hist": HOG_HISTOGRAM_VECTOR_SIZE,
+        "texture_hist": TEXTURE_HISTOGRAM_VECTOR_SIZE,
+    }
+    raw_connection = engine.raw_connection()
+    try:
+        connection = raw_connection.driver_connection
+        register_vector(connection)
+        connection.execute("TRUNCATE image")
+        now = datetime.now(UTC)
+        for chunk, chunk_start in enumerate(range(0, rows, COPY_CHUNK_ROWS)):
+            chunk_rows = min(COPY_CHUNK_ROWS, rows - chunk_start)
+            vectors = [
+                synthetic_vectors(chunk_rows, column_dimensions, seed=chunk * len(dimensions) + column)
+                for column, column_dimensions in enumerate(dimensions.values())
+            ]
+            columns = ", ".join(["id", "path", *dimensions, "created_at", "processed_at"])
+            with connection.cursor().copy(f"COPY image ({columns}) FROM STDIN WITH (FORMAT BINARY)") as copy:
+                copy.set_types(["uuid", "text", "vector", "vector", "vector", "timestamptz", "timestamptz"])
+                for row in range(chunk_rows):
+                    copy.write_row((
+                        uuid4(), f"benchmark/{chunk_start + row}.jpg", *(matrix[row] for matrix in vectors), now, now,
+                    ))
+            connection.commit()
+
+    finally:
+        raw_connection.close()
+    with engine.begin() as connection:
+        create_vector_indexes(connection, index_method)
+
+
+def create_vector_indexes(connection, index_method: str):
+    if index_method != "none":
+        for search_type, index_name in INDEX_NAMES.items():
+            column_name = SEARCH_TYPE_TO_COLUMN_NAME[search_type]
+            connection.execute(
+                text(f"CREATE INDEX {index_name} ON image USING {index_method} ({column_name} vector_l2_ops)")
+            )
+    connection.execute(text("ANALYZE image"))
+
+
+async def benchmark_search(args, backend: SearchBackend, database_url: str) -> dict[str, float]:
+    async_engine = create_async_engine(database_url, connect_args={"options": f"-c search_path={SCHEMA},public"})
+    results = {}
+    try:
+        async with AsyncSession(async_engine) as session:
+            for search_type in SearchType:
+                column = getattr(Image, SEARCH_TYPE_TO_COLUMN_NAME[search_type])
+                queries = (await session.exec(
+                    select(Image.id, column).order_by(func.random()).limit(args.queries)
+                )).all()
+                # First search loads the memory backend, it's not measured
+                await backend.search(session, search_type, queries[0][1], queries[0][0])
+
+                for limit in args.limits:
+                    for max_distance in args.max_distances:
+                        timings, returned = [], []
+                        for image_id, histogram in queries:
+                            start = time.perf_counter()
+                            similar = await backend.search(
+                                session, search_type, histogram, image_id, limit, max_distance
+                            )
+                            timings.append(time.perf_counter() - start)
+                            returned.append(len(similar))
+                            await session.rollback()
+                        distance_name = "none" if max_distance is None else max_distance
+                        name = f"search.{search_type.value}.limit_{limit}.max_distance_{distance_name}"
+                        results.update(summarize(name, timings))
+                        results[f"{name}.returned_mean"] = float(np.mean(returned))
+    finally:
+        await async_engine.dispose()
+    return results
+
+
+async def benchmark_response(args, backend: SearchBackend, database_url: str) -> dict[str, float]:
+    async_engine = create_async_engine(database_url, connect_args={"options": f"-c search_path={SCHEMA},public"})
+    results = {}
+    try:
+        async with AsyncSession(async_engine) as session:
+            for search_type in SearchType:
+                column_name = SEARCH_TYPE_TO_COLUMN_NAME[search_type]
+                image_id, image_key, histogram = (await session.exec(
+                    select(Image.id, Image.path, getattr(Image, column_name)).order_by(func.random()).limit(1)
+                )).one()
+                similar = await backend.search(session, search_type, histogram, image_id, args.response_limit)
+                # Sizes of the values as stored (vectors are not compressed), close to what is sent to the API
+                entity_bytes, projection_bytes = (await session.exec(text(f"""
+                    SELECT
+                        sum(pg_column_size(image.*)),
+                        sum(pg_column_size(id) + pg_column_size(path) + 8)
+                            + (SELECT pg_column_size({column_name}) FROM image WHERE id = :image_id)
+                    FROM image WHERE id = ANY(:ids)
+                """), params={"image_id": image_id, "ids": [image_id, *(result.id for result in similar)]})).one()
+                name = f"response.{search_type.value}.limit_{args.response_limit}"
+                results[f"{name}.entity_bytes"] = float(entity_bytes)
+                results[f"{name}.projection_bytes"] = float(projection_bytes)
+                await session.rollback()
+    finally:
+        await async_engine.dispose()
+
+    models_timings, dicts_timings = [], []
+    for _ in range(args.queries):
+        start = time.perf_counter()
+        _serialize_response_models(image_key, similar)
+        models_timings.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        _similar_images_response(SimilarResponseStatus.OK, image_key, similar)
+        dicts_timings.append(time.perf_counter() - start)
+    results.update(summarize(f"response.limit_{args.response_limit}.serialize_models", models_timings))
+    results.update(summarize(f"response.limit_{args.response_limit}.serialize_dicts", dicts_timings))
+    return results
+
+
+async def benchmark_partitions(args, engine: Engine) -> dict[str, float]:
+    """
+    The table is migrated to every partition count in turn, searches of the same images are measured on each.
+    """
+
+    async_engine = create_async_engine(
+        args.database_url, connect_args={"options": f"-c search_path={SCHEMA},public"},
+        pool_size=max(args.partition_counts) + 1,
+    )
+    results = {}
+    try:
+        async with AsyncSession(async_engine) as session:
+            queries = {
+                search_type: (await session.exec(
+                    select(Image.id, getattr(Image, SEARCH_TYPE_TO_COLUMN_NAME[search_type]))
+                    .order_by(func.random())
+                    .limit(args.queries)
+                )).all()
+                for search_type in SearchType
+            }
+
+        for partitions in args.partition_counts:
+            with engine.begin() as connection:
+                migrate(connection, partitions)
+                create_vector_indexes(connection, args.index)
+            backend = PartitionedSearchBackend(partition_timeout=60)
+            async with AsyncSession(async_engine) as session:
+                for search_type, search_queries in queries.items():
+                    for limit in args.limits:
+                        timings = []
+                        for image_id, histogram in search_queries:
+                            start = time.perf_counter()
+                            await backend.search(session, search_type, histogram, image_id, limit)
+                            timings.append(time.perf_counter() - start)
+                            await session.rollback()
+                        results.update(summarize(f"partitions.{partitions}.{search_type.value}.limit_{limit}", timings))
+    finally:
+        await async_engine.dispose()
+    return results
+
+
+def _serialize_response_models(image_key: str, similar: list) -> bytes:
+    # What FastAPI does with a returned response model: validation, conversion to JSON compatible data and encoding
+    response = SimilarImagesResponse(
+        status=SimilarResponseStatus.OK,
+        image_url=HttpUrl(storage.public_url(image_key)),
+        similar_images=[
+            SimilarImageEntry(
+                url=HttpUrl(storage.public_url(result.path)),
+                thumbnail_url=HttpUrl(storage.public_url(get_derivative_key(result.path, DerivativeKind.THUMBNAIL))),
+                distance=result.distance,
+            )
+            for result in similar
+        ],
+    )
+    content = jsonable_encoder(SimilarImagesResponse.model_validate(response.model_dump()))
+    return json.dumps(content).encode()
+
+
+def run(args):
+    benchmarks = set(args.only.split(","))
+    results = {}
+    if "startup" in benchmarks:
+        print("Measuring startup...")
+        results.update(benchmark_startup(args))
+    if "descriptors" in benchmarks:
+        print("Measuring descriptors...")
+        results.update(benchmark_descriptors(args))
+
+    if benchmarks & {"worker", "workers", "search", "response", "partitions"}:
+        engine = create_engine(args.database_url, connect_args={"options": f"-c search_path={SCHEMA},public"})
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))  # Kept by the last run
+            connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        # Without `checkfirst` tables of the public schema (visible through the search path) are taken for existing
+        SQLModel.metadata.create_all(engine, checkfirst=False)
+        try:
+            if "worker" in benchmarks:
+                print("Measuring worker...")
+                results.update(benchmark_worker(args, engine))
+            if "workers" in benchmarks:
+                print("Measuring worker classes...")
+                results.update(benchmark_worker_classes(args, engine))
+            if benchmarks & {"search", "response", "partitions"}:
+                print(f"Creating table with {args.rows} rows...")
+                create_vector_table(engine, args.rows, args.index)
+                backend = create_search_backend(args.backend)
+            if "search" in benchmarks:
+                print("Measuring search...")
+                results.update(asyncio.run(benchmark_search(args, backend, args.database_url)))
+            if "response" in benchmarks:
+                print("Measuring response...")
+                results.update(asyncio.run(benchmark_response(args, backend, args.database_url)))
+            if "partitions" in benchmarks:
+                print("Measuring partitions...")
+                results.update(asyncio.run(benchmark_partitions(args, engine)))
+        finally:
+            if not args.keep_schema:
+                with engine.begin() as connection:
+                    connection.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+            engine.dispose()
+
+    parameters = {name: value for name, value in vars(args).items() if name not in {"func", "database_url"}}
+    report = {"environment": environment(), "parameters": parameters, "results": results}
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2, sort_keys=True, default=str)
+    for name, value in sorted(results.items()):
+        print(f"{name:<70} {value:10.3f}")
+    print(f"Results written to {args.output}")
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "created_at": datetime.now(UTC).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def compare(args) -> int:
+    """
+    Prints relative changes of metrics present in both runs. Returns 1 when any got worse more than the threshold.
+    """
+
+    with open(args.baseline) as baseline_file, open(args.current) as current_file:
+        baseline, current = json.load(baseline_file)["results"], json.load(current_file)["results"]
+
+    regressions = 0
+    for name in sorted(baseline.keys() & current.keys()):
+        before, after = baseline[name], current[name]
+        change = (after - before) / before if before else 0.0
+        worse = change > args.threshold if name.endswith(LOWER_IS_BETTER) else change < -args.threshold
+        if name.endswith("returned_mean"):
+            worse = False  # Result sizes are informative
+        regressions += worse
+        marker = "REGRESSION" if worse else ""
+        print(f"{name:<70} {before:10.3f} {after:10.3f} {change:+8.1%} {marker}")
+
+    for name in sorted(baseline.keys() ^ current.keys()):
+        print(f"{name:<70} only in {'baseline' if name in baseline else 'current'}")
+    print(f"{regressions} regressions above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def parse_max_distance(value: str) -> float | None:
+    return None if value == "none" else float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(required=True)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.set_defaults(func=run)
+    run_parser.add_argument("--output", default="benchmark.json")
+    run_parser.add_argument("--only", default="startup,descriptors,worker,workers,search,response,partitions")
+    run_parser.add_argument("--database-url", default=config("DATABASE_URL"))
+    run_parser.add_argument("--images", type=int, default=20)
+    run_parser.add_argument("--width", type=int, default=1024)
+    run_parser.add_argument("--height", type=int, default=768)
+    run_parser.add_argument("--batch-size", type=int, default=10, help="Images per worker job")
+    run_parser.add_argument("--rows", type=int, default=10000, help="Rows of the search table")
+    run_parser.add_argument("--queries", type=int, default=100)
+    run_parser.add_argument(
+        "--limits", type=lambda value: [int(limit) for limit in value.split(",")], default=[10, 100]
+    )
+    run_parser.add_argument(
+        "--max-distances", type=lambda value: [parse_max_distance(distance) for distance in value.split(",")],
+        default=[None, 0.5],
+    )
+    run_parser.add_argument("--response-limit", type=int, default=1000, help="Results of the measured response")
+    run_parser.add_argument("--startup-runs", type=int, default=5, help="Processes started per measured module")
+    run_parser.add_argument("--backend", choices=["postgres", "memory"], default="postgres")
+    run_parser.add_argument("--index", choices=["none", "hnsw", "ivfflat"], default="none")
+    run_parser.add_argument(
+        "--partition-counts", type=lambda value: [int(count) for count in value.split(",")], default=[0, 2, 4, 8]
+    )
+    run_parser.add_argument("--keep-schema", action="store_true")
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.set_defaults(func=compare)
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Relative change reported as regression")
+
+    args = parser.parse_args()
+    sys.exit(args.func(args) or 0)
+
+
+if __name__ == "__main__":
+    main()
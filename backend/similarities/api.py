@@ -1,26 +1,41 @@
+import asyncio
+from datetime import datetime, UTC
 from typing import Annotated
 from uuid import UUID, uuid4
 
-import redis
+import orjson
 from decouple import config
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, responses, status
-from rq import Queue, Retry
-from sqlmodel import Session, select
+from sqlalchemy import or_
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from similarities.db import get_session
+from similarities.cache import result_cache
+from similarities.db import get_session, get_session_maker
+from similarities.derivative_keys import DerivativeKind, get_derivative_key
+from similarities.jobs import histogram_job_buffer, request_histograms
 from similarities.models import Image, validate_image_content
+from similarities.neighbours import get_neighbour_list
+from similarities.query_image import (
+    QUERY_IMAGE_MAX_BYTES, ExecutorBusy, calculate_query_histogram, query_image_executor
+)
+from similarities.search import PartialResults, SimilarImage, search_backend, search_combined
 from similarities.serializers import (
-    ImageCreationResponse, SearchType, SimilarImageEntry, SimilarImagesResponse, SimilarResponseStatus,
-    SEARCH_TYPE_TO_COLUMN_NAME
+    BatchImageCreationEntry, BatchImageCreationResponse, ImageCreationResponse, QueryImageSimilarImagesResponse,
+    SearchType, SimilarImagesResponse, SimilarResponseStatus, SimilarImagesBatchRequest, SEARCH_TYPE_TO_COLUMN_NAME
+)
+from similarities.storage import (
+    SavedUpload, discard_uploaded_file, move_uploaded_file, save_uploaded_file, storage
 )
-from similarities.processing import update_image_histograms
-from similarities.storage import save_uploaded_file, get_image_public_url
+from similarities.timing import StageTimings
 
 
-SessionDep = Annotated[Session, Depends(get_session)]
+SIMILAR_BATCH_MAX_IMAGES = config("SIMILAR_BATCH_MAX_IMAGES", default=1000, cast=int)
+SIMILAR_BATCH_CHUNK_SIZE = 100
 
-redis_conn = redis.from_url(config("QUEUE_BROKER_URL"))
-queue = Queue("default", connection=redis_conn)
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
+SessionMakerDep = Annotated[async_sessionmaker[AsyncSession], Depends(get_session_maker)]
 
 router = APIRouter()
 
@@ -29,27 +44,175 @@ router = APIRouter()
 async def upload_image(image: UploadFile, session: SessionDep):
     await validate_image_content(image)
 
-    unique_id = str(uuid4())
-    image_path = await save_uploaded_file(unique_id, image)
+    upload = await save_uploaded_file(image)
+    try:
+        [image_obj] = await _create_images(session, [(image, upload)])
+    finally:
+        await discard_uploaded_file(upload)
 
-    image_obj = Image(id=unique_id, path=str(image_path))
-    session.add(image_obj)
-    session.commit()
+    return image_obj
 
-    retry_backoff = Retry(10, interval=[5 * 2**n for n in range(10)])  # Up to 2560 seconds between last retries
-    queue.enqueue(update_image_histograms, str(image_obj.id), retry=retry_backoff)
 
-    return image_obj
+@router.post("/upload/batch", status_code=status.HTTP_201_CREATED, response_model=BatchImageCreationResponse)
+async def upload_images(images: list[UploadFile], session: SessionDep):
+    """
+    Uploads many images in one request. Images are stored with a single commit.
+    Invalid files don't fail the whole batch, they're returned with an error instead of an id.
+    """
+
+    entries = [BatchImageCreationEntry(filename=image.filename) for image in images]
+    saved_uploads = []
+    try:
+        for entry, image in zip(entries, images):
+            try:
+                await validate_image_content(image)
+            except HTTPException as error:
+                entry.error = error.detail
+                continue
+            saved_uploads.append((entry, image, await save_uploaded_file(image)))
+
+        created_images = await _create_images(session, [(image, upload) for _, image, upload in saved_uploads])
+    finally:
+        for _, _, upload in saved_uploads:
+            await discard_uploaded_file(upload)
+
+    for (entry, _, _), image_obj in zip(saved_uploads, created_images):
+        entry.id = image_obj.id
+    return BatchImageCreationResponse(images=entries)
+
+
+async def _create_images(session: AsyncSession, uploads: list[tuple[UploadFile, SavedUpload]]) -> list[Image]:
+    """
+    Stores images of saved uploads and schedules their processing.
+    """
+
+    content_hashes = {upload.content_hash for _, upload in uploads}
+    duplicates = {
+        duplicate.content_hash: duplicate
+        for duplicate in await session.exec(
+            select(Image)
+            .where(Image.content_hash.in_(content_hashes))
+            .order_by(Image.content_hash, Image.processed_at.is_(None))  # Prefer already processed duplicate
+            .distinct(Image.content_hash)
+        )
+    }
+
+    eager_columns = [
+        SEARCH_TYPE_TO_COLUMN_NAME[search_type] for search_type in histogram_job_buffer.search_types
+    ]
+    images, images_to_process, pending_duplicate_ids = [], [], []
+    for image, upload in uploads:
+        unique_id = uuid4()
+        duplicate = duplicates.get(upload.content_hash)
+        if duplicate:
+            # Same content was uploaded before. Reusing its file and histograms.
+            # If they are not calculated yet, the worker processing the duplicate fills them for this image too.
+            image_obj = Image(
+                id=unique_id,
+                path=duplicate.path,
+                content_hash=upload.content_hash,
+                perceptual_hash=duplicate.perceptual_hash,
+                color_hist=duplicate.color_hist,
+                hog_hist=duplicate.hog_hist,
+                texture_hist=duplicate.texture_hist,
+                processed_at=datetime.now(UTC) if duplicate.processed_at else None,
+            )
+            if duplicate not in images_to_process and any(
+                getattr(duplicate, column_name) is None for column_name in eager_columns
+            ):
+                pending_duplicate_ids.append(unique_id)
+        else:
+            image_key = await move_uploaded_file(str(unique_id), image.filename, upload)
+            image_obj = Image(id=unique_id, path=image_key, content_hash=upload.content_hash)
+            duplicates[upload.content_hash] = image_obj  # Same content may be uploaded again in the batch
+            images_to_process.append(image_obj)
+
+        session.add(image_obj)
+        images.append(image_obj)
+
+    await session.commit()
+
+    image_ids_to_process = [image_obj.id for image_obj in images_to_process]
+    if pending_duplicate_ids:
+        # The worker could store histograms of the duplicate before the commit, without copying them to new images.
+        # The job skips histograms stored in the meantime.
+        image_ids_to_process += (await session.exec(
+            select(Image.id)
+            .where(
+                Image.id.in_(pending_duplicate_ids),
+                or_(*(getattr(Image, column_name).is_(None) for column_name in eager_columns)),
+            )
+        )).all()
+
+    if image_ids_to_process:
+        await asyncio.to_thread(histogram_job_buffer.add, *map(str, image_ids_to_process))
+    if any(image_obj.processed_at for image_obj in images):
+        # New images are searchable right away
+        await asyncio.to_thread(result_cache.invalidate)
+
+    return images
 
 
 @router.get("/download/{image_id}")
 async def download_image(image_id: UUID, session: SessionDep):
-    image_obj = session.get(Image, image_id)
-    if not image_obj:
+    image_key = (await session.exec(select(Image.path).where(Image.id == image_id))).first()
+    if not image_key:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found.")
 
-    public_url = get_image_public_url(image_obj)
-    return responses.RedirectResponse(str(public_url), status_code=status.HTTP_301_MOVED_PERMANENTLY)
+    return responses.RedirectResponse(storage.public_url(image_key), status_code=status.HTTP_301_MOVED_PERMANENTLY)
+
+
+# Registered before the route below, "combined" would be rejected there as an unknown search type
+@router.get("/similar/{image_id}/combined", response_model=SimilarImagesResponse)
+async def similar_images_combined(
+        image_id: UUID,
+        session: SessionDep,
+        colors: float = None,
+        objects: float = None,
+        texture: float = None,
+        limit: int = 10,
+        max_distance: float = None,
+        probes: int = None,
+        ef_search: int = None,
+):
+    """
+    Similar images by many search types at once. Query params `colors`, `objects` and `texture` are weights
+    of the search types, all of them are weighted equally when none is given. Distances are in 0..1 range.
+    Durations of the search stages are returned in the `Server-Timing` header.
+    """
+
+    weights = {SearchType.COLORS: colors, SearchType.OBJECTS: objects, SearchType.TEXTURE: texture}
+    if all(weight is None for weight in weights.values()):
+        weights = dict.fromkeys(weights, 1.0)
+    weights = {search_type: weight or 0.0 for search_type, weight in weights.items()}
+    if any(weight < 0 for weight in weights.values()) or not any(weights.values()):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Weights can't be negative and at least one of them has to be positive.",
+        )
+
+    search_types = [search_type for search_type, weight in weights.items() if weight]
+    timings = StageTimings()
+    with timings.stage("image"):
+        image_row = await _get_image_histograms(session, image_id, search_types)
+    if not image_row:
+        raise HTTPException(status_code=404, detail="Image not found.")
+
+    image_key, *image_histograms = image_row
+    histograms = dict(zip(search_types, image_histograms))
+    if any(histogram is None for histogram in histograms.values()):
+        for search_type, histogram in histograms.items():
+            if histogram is None:
+                await asyncio.to_thread(request_histograms, [image_id], search_type)
+        return _similar_images_response(SimilarResponseStatus.PROCESSING, image_key, [])
+
+    results = await search_combined(
+        search_backend, session, histograms, weights, image_id, limit, max_distance, probes, ef_search, timings
+    )
+
+    return _similar_images_response(
+        SimilarResponseStatus.OK, image_key, results, headers={"Server-Timing": timings.server_timing()}
+    )
 
 
 @router.get("/similar/{image_id}/{search_type}", response_model=SimilarImagesResponse)
@@ -59,39 +222,218 @@ async def similar_images(
         session: SessionDep,
         limit: int = 10,
         max_distance: float = None,
+        probes: int = None,
+        ef_search: int = None,
 ):
-    image_obj = session.get(Image, image_id)
-    if not image_obj:
+    image_row = await _get_image_histograms(session, image_id, [search_type])
+    if not image_row:
         raise HTTPException(status_code=404, detail="Image not found.")
 
-    column_name = SEARCH_TYPE_TO_COLUMN_NAME[search_type]
-    image_histogram = getattr(image_obj, column_name)
+    image_key, image_histogram = image_row
     if image_histogram is None:
-        return SimilarImagesResponse(
-            status=SimilarResponseStatus.PROCESSING,
-            image_url=get_image_public_url(image_obj),
-            similar_images=[],
+        await asyncio.to_thread(request_histograms, [image_id], search_type)
+        return _similar_images_response(SimilarResponseStatus.PROCESSING, image_key, [])
+
+    cache_key = await result_cache.key(image_id, search_type, limit, max_distance, probes, ef_search)
+    results = await result_cache.get(cache_key)
+    if results is None:
+        results = await get_neighbour_list(session, search_type, image_id, limit, max_distance)
+    if results is None:
+        results = await search_backend.search(
+            session, search_type, image_histogram, image_id, limit, max_distance, probes, ef_search
         )
+        if not isinstance(results, PartialResults):  # Next search should ask the partitions which didn't answer
+            await result_cache.set(cache_key, results)
 
-    image_column = getattr(Image, column_name)
-    query = (
-        select(Image, image_column.l2_distance(image_histogram).label("distance"))
-        .where(Image.id != image_obj.id)
-        # Adding '0' to not use index because of the issue: https://github.com/pgvector/pgvector/issues/719
-        .order_by(image_column.l2_distance(image_histogram) + 0)
-        .limit(limit)
+    return _similar_images_response(
+        SimilarResponseStatus.OK, image_key, results, headers=_missing_partitions_headers(results)
     )
-    if max_distance:
-        query = query.where(image_column.l2_distance(image_histogram) <= max_distance)
 
-    query_result = session.exec(query)
-    similar_images = [
-        SimilarImageEntry(url=get_image_public_url(image), distance=distance)
-        for image, distance in query_result
-    ]
 
-    return SimilarImagesResponse(
-        status=SimilarResponseStatus.OK,
-        image_url=get_image_public_url(image_obj),
-        similar_images=similar_images
+@router.post("/similar/query/{search_type}", response_model=QueryImageSimilarImagesResponse)
+async def similar_images_of_query_image(
+        image: UploadFile,
+        search_type: SearchType,
+        session: SessionDep,
+        limit: int = 10,
+        max_distance: float = None,
+        probes: int = None,
+        ef_search: int = None,
+):
+    """
+    Similar images of a sent image, in one call. The image is not stored, its histogram is calculated
+    right away in a bounded pool of threads. Returns 503 when too many query images are being calculated.
+    """
+
+    await validate_image_content(image)
+    content = await image.read(QUERY_IMAGE_MAX_BYTES + 1)
+    if len(content) > QUERY_IMAGE_MAX_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Image file too large. Max size in bytes: {QUERY_IMAGE_MAX_BYTES}",
+        )
+
+    timings = StageTimings()
+    try:
+        with timings.stage("histogram"):
+            histogram = await query_image_executor.run(calculate_query_histogram, content, search_type)
+    except ExecutorBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many query images are being processed, try again later.",
+            headers={"Retry-After": "1"},
+        )
+    if histogram is None:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Corrupted image.")
+
+    with timings.stage("search"):
+        results = await search_backend.search(
+            session, search_type, histogram, None, limit, max_distance, probes, ef_search
+        )
+
+    return responses.ORJSONResponse(
+        {"similar_images": _similar_image_entries(results)},
+        headers={"Server-Timing": timings.server_timing(), **_missing_partitions_headers(results)},
     )
+
+
+@router.post("/similar/batch")
+async def similar_images_batch(request: SimilarImagesBatchRequest, session_maker: SessionMakerDep):
+    """
+    Similar images of many images for many search types. Results are streamed as NDJSON,
+    one `SimilarImagesBatchEntry` line per image and search type, as soon as its chunk of images is searched.
+    """
+
+    image_ids = list(dict.fromkeys(request.image_ids))
+    if len(image_ids) > SIMILAR_BATCH_MAX_IMAGES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {SIMILAR_BATCH_MAX_IMAGES} images can be searched at once.",
+        )
+
+    return responses.StreamingResponse(
+        _similar_images_batch_lines(session_maker, request, image_ids), media_type="application/x-ndjson"
+    )
+
+
+async def _similar_images_batch_lines(
+        session_maker: async_sessionmaker[AsyncSession], request: SimilarImagesBatchRequest, image_ids: list[UUID]
+):
+    search_types = list(dict.fromkeys(request.search_types))
+    columns = [getattr(Image, SEARCH_TYPE_TO_COLUMN_NAME[search_type]) for search_type in search_types]
+    async with session_maker() as session:
+        # Histograms of all the images in one query
+        histograms = {
+            image_id: image_histograms
+            for image_id, *image_histograms in await session.exec(
+                select(Image.id, *columns).where(Image.id.in_(image_ids))
+            )
+        }
+        await session.rollback()  # Connection is not held while the client reads
+
+        for search_type_index, search_type in enumerate(search_types):
+            missing_ids = [
+                image_id for image_id, image_histograms in histograms.items()
+                if image_histograms[search_type_index] is None
+            ]
+            if missing_ids:
+                await asyncio.to_thread(request_histograms, missing_ids, search_type)
+
+            for start in range(0, len(image_ids), SIMILAR_BATCH_CHUNK_SIZE):
+                chunk_ids = image_ids[start:start + SIMILAR_BATCH_CHUNK_SIZE]
+                results = await _search_many_cached(
+                    session, search_type, request,
+                    [
+                        (image_id, histograms[image_id][search_type_index])
+                        for image_id in chunk_ids
+                        if image_id in histograms and histograms[image_id][search_type_index] is not None
+                    ],
+                )
+                await session.rollback()
+
+                for image_id in chunk_ids:
+                    if image_id not in histograms:
+                        response_status, similar_images = SimilarResponseStatus.NOT_FOUND, []
+                    elif image_id not in results:
+                        response_status, similar_images = SimilarResponseStatus.PROCESSING, []
+                    else:
+                        response_status = SimilarResponseStatus.OK
+                        similar_images = _similar_image_entries(results[image_id])
+                    # Line of `SimilarImagesBatchEntry`
+                    entry = {
+                        "image_id": image_id,
+                        "search_type": search_type.value,
+                        "status": response_status.value,
+                        "similar_images": similar_images,
+                    }
+                    yield orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE)
+
+
+async def _search_many_cached(
+        session: AsyncSession,
+        search_type: SearchType,
+        request: SimilarImagesBatchRequest,
+        queries: list[tuple[UUID, list[float]]],
+):
+    options = (request.limit, request.max_distance, request.probes, request.ef_search)
+    results, missing, cache_keys = {}, [], {}
+    for image_id, histogram in queries:
+        cache_keys[image_id] = await result_cache.key(image_id, search_type, *options)
+        cached = await result_cache.get(cache_keys[image_id])
+        if cached is None:
+            missing.append((image_id, histogram))
+        else:
+            results[image_id] = cached
+
+    if missing:
+        found = await search_backend.search_many(session, search_type, missing, *options)
+        for image_id, image_results in found.items():
+            if not isinstance(image_results, PartialResults):
+                await result_cache.set(cache_keys[image_id], image_results)
+        results.update(found)
+    return results
+
+
+async def _get_image_histograms(session: AsyncSession, image_id: UUID, search_types: list[SearchType]):
+    """
+    Key and histograms of `search_types` of the image, None when it doesn't exist.
+    Only the needed columns are loaded, a whole row has all the vectors (about 10KB).
+    """
+
+    columns = [getattr(Image, SEARCH_TYPE_TO_COLUMN_NAME[search_type]) for search_type in search_types]
+    return (await session.exec(select(Image.path, *columns).where(Image.id == image_id))).first()
+
+
+def _missing_partitions_headers(results: list[SimilarImage]) -> dict:
+    # Partitions of the table which didn't answer the search in time, see `PartitionedSearchBackend`
+    if isinstance(results, PartialResults):
+        return {"Search-Missing-Partitions": str(results.missing_partitions)}
+    return {}
+
+
+def _similar_images_response(
+        response_status: SimilarResponseStatus, image_key: str, results: list[SimilarImage], headers: dict = None
+) -> responses.ORJSONResponse:
+    """
+    `SimilarImagesResponse` serialized right away. Response returned by the route is not validated against
+    its response model, building models of hundreds of results took longer than the search itself.
+    """
+
+    content = {
+        "status": response_status.value,
+        "image_url": storage.public_url(image_key),
+        "similar_images": _similar_image_entries(results),
+    }
+    return responses.ORJSONResponse(content, headers=headers)
+
+
+def _similar_image_entries(results: list[SimilarImage]) -> list[dict]:
+    # `SimilarImageEntry` fields
+    return [
+        {
+            "url": storage.public_url(image_key),
+            "thumbnail_url": storage.public_url(get_derivative_key(image_key, DerivativeKind.THUMBNAIL)),
+            "distance": distance,
+        }
+        for _, image_key, distance in results
+    ]
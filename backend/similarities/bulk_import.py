@@ -0,0 +1,289 @@
+"""
+Bulk import of images from a directory or a manifest (text file with one image path per line).
+
+Files are read, validated, decoded and their histograms calculated in a pool of processes.
+Rows of every batch are written with a single COPY, so imported images are searchable right away.
+Paths are imported in sorted order and the last imported one is stored in a checkpoint file after every batch,
+the import continues with paths after it when run again. Files with content already present in the database
+are skipped.
+
+Usage: python -m similarities.bulk_import SOURCE [--manifest] [--workers 4] [--batch-size 500]
+                                             [--checkpoint bulk_import.checkpoint]
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, UTC
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+from uuid import uuid4
+
+from pgvector.psycopg import register_vector
+from sqlalchemy import Engine
+
+from similarities.cache import result_cache
+from similarities.db import engine as default_engine
+from similarities.derivative_keys import DerivativeKind, get_derivative_key
+from similarities.derivatives import WORKING_COPY_MAX_SIDE, decode_image, save_derivatives
+from similarities.histograms import TextureFilter, calculate_file_perceptual_hash, calculate_histograms
+from similarities.image_header import IMAGE_HEADER_READ_SIZE, read_image_header
+from similarities.models import MAX_IMAGE_PIXELS
+from similarities.parallel import init_pool_process
+from similarities.processing import TEXTURE_FILTER, TEXTURE_MAX_SIDE
+from similarities.storage import save_image_file, storage
+
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+COPY_COLUMNS = (
+    "id", "path", "content_hash", "perceptual_hash", "color_hist", "hog_hist", "texture_hist",
+    "created_at", "processed_at",
+)
+COPY_TYPES = ["uuid", "text", "text", "text", "vector", "vector", "vector", "timestamptz", "timestamptz"]
+
+
+class ImportedFile(NamedTuple):
+    source_path: str
+    row: tuple | None  # Values of COPY_COLUMNS
+    error: str | None
+
+
+class ImportStats(NamedTuple):
+    processed: int
+    imported: int
+    duplicates: int
+    errors: int
+    seconds: float
+
+
+def read_directory(directory: str) -> Iterator[str]:
+    """
+    Image files in the directory and its subdirectories, sorted by their paths as `import_images` requires.
+    """
+
+    # Paths of a subdirectory "a" are sorted as they start with "a/", e.g. after "a-b.jpg"
+    entries = sorted(os.scandir(directory), key=lambda entry: entry.name + "/" if entry.is_dir() else entry.name)
+    for entry in entries:
+        if entry.is_dir():
+            yield from read_directory(entry.path)
+        elif Path(entry.name).suffix.lower() in SUPPORTED_EXTENSIONS:
+            yield entry.path
+
+
+def read_manifest(manifest_path: str) -> list[str]:
+    """
+    Unique paths listed in the manifest, sorted as `import_images` requires. The whole manifest is read
+    before the import starts, so lines can be in any order.
+    """
+
+    with open(manifest_path) as manifest:
+        return sorted({line.strip() for line in manifest} - {""})
+
+
+def import_images(
+        source_paths: Iterable[str],
+        checkpoint_path: str | None = None,
+        workers: int = 4,
+        batch_size: int = 500,
+        engine: Engine = default_engine,
+) -> ImportStats:
+    """
+    Imports images in batches of `batch_size`. The next batch is calculated by the pool while the previous one
+    is written to the database. Returns totals of this run.
+    `source_paths` have to be sorted (`read_directory` and `read_manifest` return them so), ValueError is raised
+    at the first unsorted one. A continued import skips paths up to the last one stored in the checkpoint,
+    so files added in the meantime are imported when they're sorted after it.
+    """
+
+    last_path = _read_checkpoint(checkpoint_path)
+    source_paths = _paths_after(source_paths, last_path)
+    if last_path:
+        logger.info("Continuing from checkpoint, skipping files up to %s", last_path)
+
+    processed = imported = duplicates = errors = 0
+    start = time.monotonic()
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=init_pool_process,
+    )
+    raw_connection = engine.raw_connection()
+    try:
+        connection = raw_connection.driver_connection
+        register_vector(connection)
+
+        for files in _import_batches(executor, _batches(source_paths, batch_size)):
+            batch_imported, batch_duplicates = _write_batch(connection, files)
+            result_cache.invalidate()
+
+            processed += len(files)
+            imported += batch_imported
+            duplicates += batch_duplicates
+            errors += sum(1 for imported_file in files if imported_file.error)
+            _write_checkpoint(checkpoint_path, files[-1].source_path)
+
+            elapsed = time.monotonic() - start
+            logger.info(
+                "Processed %d files (imported %d, duplicates %d, errors %d), %.1f files/s",
+                processed, imported, duplicates, errors, processed / elapsed,
+            )
+    finally:
+        raw_connection.close()
+        executor.shutdown(cancel_futures=True)
+
+    return ImportStats(processed, imported, duplicates, errors, time.monotonic() - start)
+
+
+def _import_batches(executor: ProcessPoolExecutor, batches: Iterable[list[str]]) -> Iterator[list[ImportedFile]]:
+    # Next batch is submitted before results of the previous one are returned, so the pool is busy while they're written
+    pending: deque[list[Future]] = deque()
+    for batch in batches:
+        pending.append([executor.submit(_import_file, path, TEXTURE_MAX_SIDE, TEXTURE_FILTER) for path in batch])
+        if len(pending) > 1:
+            yield [future.result() for future in pending.popleft()]
+
+    while pending:
+        yield [future.result() for future in pending.popleft()]
+
+
+def _import_file(source_path: str, texture_max_side: int, texture_filter: TextureFilter) -> ImportedFile:
+    """
+    Runs in the pool. Validates the file like an upload, calculates its histograms and copies it to the storage.
+    """
+
+    try:
+        content = Path(source_path).read_bytes()
+    except OSError as error:
+        return ImportedFile(source_path, None, f"Could not read file: {error}")
+
+    header = read_image_header(content[:IMAGE_HEADER_READ_SIZE])
+    if header is None:
+        return ImportedFile(source_path, None, "Unsupported or corrupted image")
+    if header.width * header.height > MAX_IMAGE_PIXELS:
+        return ImportedFile(source_path, None, "Image dimensions too large")
+
+    image = decode_image(content, WORKING_COPY_MAX_SIDE)
+    if image is None:
+        return ImportedFile(source_path, None, "Corrupted image")
+
+    histograms = calculate_histograms(image, texture_max_side, texture_filter)
+    perceptual_hash = calculate_file_perceptual_hash(content)
+    unique_id = uuid4()
+    image_key = save_image_file(str(unique_id), source_path, content)
+    save_derivatives(image_key, image)
+    now = datetime.now(UTC)
+    row = (
+        unique_id, image_key, hashlib.sha256(content).hexdigest(), perceptual_hash,
+        histograms.color, histograms.hog, histograms.texture, now, now,
+    )
+    return ImportedFile(source_path, row, None)
+
+
+def _write_batch(connection, files: list[ImportedFile]) -> tuple[int, int]:
+    """
+    Writes rows of the imported files in a single transaction. Returns numbers of imported and duplicated files.
+    """
+
+    for imported_file in files:
+        if imported_file.error:
+            logger.warning("Skipping %s: %s", imported_file.source_path, imported_file.error)
+
+    rows = [imported_file.row for imported_file in files if imported_file.row]
+    content_hashes = [row[2] for row in rows]
+    existing_hashes = {
+        content_hash
+        for (content_hash,) in connection.execute(
+            "SELECT content_hash FROM image WHERE content_hash = ANY(%s)", (content_hashes,)
+        )
+    }
+
+    new_rows = []
+    for row in rows:
+        if row[2] in existing_hashes:
+            # Already imported or uploaded. The copied file and its derivatives are not needed.
+            storage.delete(row[1])
+            for kind in DerivativeKind:
+                storage.delete(get_derivative_key(row[1], kind))
+            continue
+        existing_hashes.add(row[2])
+        new_rows.append(row)
+
+    if new_rows:
+        columns = ", ".join(COPY_COLUMNS)
+        with connection.cursor().copy(f"COPY image ({columns}) FROM STDIN WITH (FORMAT BINARY)") as copy:
+            copy.set_types(COPY_TYPES)
+            for row in new_rows:
+                copy.write_row(row)
+    connection.commit()
+
+    return len(new_rows), len(rows) - len(new_rows)
+
+
+def _batches(items: Iterable[str], batch_size: int) -> Iterator[list[str]]:
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+
+def _paths_after(source_paths: Iterable[str], last_path: str | None) -> Iterator[str]:
+    previous_path = None
+    for path in source_paths:
+        if previous_path is not None and path < previous_path:
+            raise ValueError(f"Source paths are not sorted, {path} is after {previous_path}")
+        if path == previous_path:
+            continue
+        previous_path = path
+        if last_path is None or path > last_path:
+            yield path
+
+
+def _read_checkpoint(checkpoint_path: str | None) -> str | None:
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as checkpoint_file:
+        return json.load(checkpoint_file)["last_path"]
+
+
+def _write_checkpoint(checkpoint_path: str | None, last_path: str):
+    if not checkpoint_path:
+        return
+    # Replacing the file, so it's never left half written
+    temporary_path = f"{checkpoint_path}.tmp"
+    with open(temporary_path, "w") as checkpoint_file:
+        json.dump({"last_path": last_path}, checkpoint_file)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="Directory with images or manifest file with --manifest")
+    parser.add_argument("--manifest", action="store_true", help="Source is a file with one image path per line")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--checkpoint", default="bulk_import.checkpoint",
+        help="Progress file, remove it to import another source from the beginning",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    source_paths = read_manifest(args.source) if args.manifest else read_directory(args.source)
+    stats = import_images(source_paths, args.checkpoint, args.workers, args.batch_size)
+    files_per_second = stats.processed / stats.seconds if stats.seconds else 0
+    print(
+        f"Processed {stats.processed} files in {stats.seconds:.1f}s ({files_per_second:.1f} files/s): "
+        f"imported {stats.imported}, duplicates {stats.duplicates}, errors {stats.errors}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from uuid import UUID
+
+import redis
+from decouple import config
+
+from similarities.jobs import redis_conn
+from similarities.search import SimilarImage
+from similarities.serializers import SearchType
+
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_TTL = config("RESULT_CACHE_TTL", default=3600, cast=int)  # 0 disables the cache
+RESULT_CACHE_LOCAL_SIZE = config("RESULT_CACHE_LOCAL_SIZE", default=1000, cast=int)
+RESULT_CACHE_GENERATION_CHECK_INTERVAL = config("RESULT_CACHE_GENERATION_CHECK_INTERVAL", default=1.0, cast=float)
+
+
+class SimilarityResultCache:
+    """
+    Results of similarity searches kept in Redis (shared by all API processes) with an in-process LRU in front of it.
+
+    Every cached result belongs to a generation, which is bumped whenever new histograms are stored.
+    Bumping makes all the previous results unreachable, they expire in Redis after `ttl` seconds.
+    The generation is read from Redis at most every `generation_check_interval` seconds,
+    so a process may return results older than the latest images for that long.
+    Methods used by the API are async, Redis round trips run in threads to not block the event loop.
+    """
+
+    def __init__(
+            self,
+            connection: redis.Redis,
+            ttl: int,
+            local_size: int,
+            generation_check_interval: float,
+            prefix: str = "similar",
+    ):
+        self.connection = connection
+        self.ttl = ttl
+        self.local_size = local_size
+        self.generation_check_interval = generation_check_interval
+        self.prefix = prefix
+        self.stats = Counter(local_hits=0, redis_hits=0, misses=0, errors=0)
+        self._local: OrderedDict[str, list[SimilarImage]] = OrderedDict()
+        self._generation: int | None = None
+        self._generation_checked_at: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def generation_key(self) -> str:
+        return f"{self.prefix}:generation"
+
+    async def key(
+            self,
+            image_id: UUID,
+            search_type: SearchType,
+            limit: int,
+            max_distance: float | None,
+            probes: int | None = None,
+            ef_search: int | None = None,
+    ) -> str | None:
+        """
+        Key of the search results in the current generation. It should be taken before searching,
+        so results of a search running while new images are stored end up in the older generation.
+        None when the cache is disabled or not available.
+        """
+
+        if not self.ttl:
+            return None
+
+        try:
+            generation = await self._current_generation()
+        except redis.RedisError:
+            logger.exception("Could not read similarity results generation")
+            self.stats["errors"] += 1
+            return None
+
+        parts = [generation, image_id, search_type.value, limit, max_distance, probes, ef_search]
+        return ":".join([self.prefix, *map(str, parts)])
+
+    async def get(self, key: str | None) -> list[SimilarImage] | None:
+        if key is None:
+            return None
+
+        with self._lock:
+            results = self._local.get(key)
+            if results is not None:
+                self._local.move_to_end(key)
+                self.stats["local_hits"] += 1
+                return results
+
+        try:
+            cached = await asyncio.to_thread(self.connection.get, key)
+        except redis.RedisError:
+            logger.exception("Could not read cached similarity results")
+            self.stats["errors"] += 1
+            return None
+
+        if cached is None:
+            self.stats["misses"] += 1
+            return None
+
+        results = [SimilarImage(UUID(image_id), path, distance) for image_id, path, distance in json.loads(cached)]
+        self._set_local(key, results)
+        self.stats["redis_hits"] += 1
+        return results
+
+    async def set(self, key: str | None, results: list[SimilarImage]):
+        if key is None:
+            return
+
+        value = json.dumps([(str(result.id), result.path, result.distance) for result in results])
+        try:
+            await asyncio.to_thread(self.connection.set, key, value, ex=self.ttl)
+        except redis.RedisError:
+            logger.exception("Could not cache similarity results")
+            self.stats["errors"] += 1
+            return
+        self._set_local(key, results)
+
+    def invalidate(self):
+        """
+        Makes all cached results stale, called after new histograms are committed. Blocks on Redis,
+        the API calls it in a thread.
+        """
+
+        try:
+            generation = self.connection.incr(self.generation_key)
+        except redis.RedisError:
+            # Stale results are returned until they expire
+            logger.exception("Could not invalidate cached similarity results")
+            self.stats["errors"] += 1
+            return
+        with self._lock:
+            self._set_generation(generation)
+
+    async def _current_generation(self) -> int:
+        with self._lock:
+            if (
+                self._generation_checked_at is not None
+                and time.monotonic() - self._generation_checked_at < self.generation_check_interval
+            ):
+                return self._generation
+
+        generation = int(await asyncio.to_thread(self.connection.get, self.generation_key) or 0)
+        with self._lock:
+            self._set_generation(generation)
+        return generation
+
+    def _set_generation(self, generation: int):
+        if generation != self._generation:
+            # Local entries of older generations can't be reached anymore
+            self._local.clear()
+        self._generation = generation
+        self._generation_checked_at = time.monotonic()
+
+    def _set_local(self, key: str, results: list[SimilarImage]):
+        if self.local_size <= 0:
+            return
+
+        with self._lock:
+            self._local[key] = results
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+
+result_cache = SimilarityResultCache(
+    redis_conn,
+    ttl=RESULT_CACHE_TTL,
+    local_size=RESULT_CACHE_LOCAL_SIZE,
+    generation_check_interval=RESULT_CACHE_GENERATION_CHECK_INTERVAL,
+)
@@ -1,18 +1,65 @@
 from decouple import config
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from similarities.metrics import instrument_engine
+from similarities.partitions import create_missing_partitions
 
+
+DATABASE_POOL_SIZE = config("DATABASE_POOL_SIZE", default=10, cast=int)
+DATABASE_MAX_OVERFLOW = config("DATABASE_MAX_OVERFLOW", default=10, cast=int)
+DATABASE_POOL_TIMEOUT = config("DATABASE_POOL_TIMEOUT", default=10.0, cast=float)  # Waiting for a free connection
+DATABASE_CONNECT_TIMEOUT = config("DATABASE_CONNECT_TIMEOUT", default=5, cast=int)
+DATABASE_STATEMENT_TIMEOUT = config("DATABASE_STATEMENT_TIMEOUT", default=30000, cast=int)  # ms, 0 means no limit
+
+# Synchronous engine, used by the worker and scripts
 engine = create_engine(config("DATABASE_URL"))
 
+# Asynchronous engine, used by the API, so database calls don't block the event loop
+async_engine = create_async_engine(
+    config("DATABASE_URL"),
+    pool_size=DATABASE_POOL_SIZE,
+    max_overflow=DATABASE_MAX_OVERFLOW,
+    pool_timeout=DATABASE_POOL_TIMEOUT,
+    pool_pre_ping=True,
+    connect_args={
+        "connect_timeout": DATABASE_CONNECT_TIMEOUT,
+        "options": f"-c statement_timeout={DATABASE_STATEMENT_TIMEOUT}",
+    },
+)
+async_session_maker = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+
+# Columns added after the table was created. `create_all` creates only missing tables.
+SCHEMA_UPGRADES = [
+    "ALTER TABLE image ADD COLUMN IF NOT EXISTS content_hash VARCHAR",
+    "ALTER TABLE image ADD COLUMN IF NOT EXISTS perceptual_hash VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_image_content_hash ON image (content_hash)",
+    "CREATE INDEX IF NOT EXISTS ix_image_perceptual_hash ON image (perceptual_hash)",
+]
+
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for statement in SCHEMA_UPGRADES:
+            connection.execute(text(statement))
+        create_missing_partitions(connection)
 
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    async with async_session_maker() as session:
         yield session
 
 
+def get_session_maker() -> async_sessionmaker[AsyncSession]:
+    # Streaming responses are sent after dependencies are closed, they have to open their own sessions
+    return async_session_maker
+
+
 session_obj = Session(engine)
 
 def get_session_instance():
@@ -0,0 +1,24 @@
+"""
+Keys of image derivatives in the storage. Kept apart from `similarities.derivatives`, so the API can build
+thumbnail URLs without loading OpenCV.
+"""
+from enum import Enum
+
+
+DERIVATIVES_DIRECTORY = "derivatives"
+
+
+class DerivativeKind(str, Enum):
+    WORKING = "working"
+    THUMBNAIL = "thumbnail"
+
+
+# Working copy is lossless, so histograms calculated from it are the same as from the downscaled original
+DERIVATIVE_EXTENSIONS = {DerivativeKind.WORKING: "png", DerivativeKind.THUMBNAIL: "jpg"}
+
+
+def get_derivative_key(image_key: str, kind: DerivativeKind) -> str:
+    # String operations instead of `Path(image_key).stem`, keys of all results of a search are built
+    name = image_key.rpartition("/")[2]
+    stem = name.rpartition(".")[0] or name
+    return f"{DERIVATIVES_DIRECTORY}/{kind.value}/{stem[:2]}/{stem[2:4]}/{stem}.{DERIVATIVE_EXTENSIONS[kind]}"
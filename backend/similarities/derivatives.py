@@ -0,0 +1,167 @@
+"""
+Downscaled derivatives of stored images, written once when the image is processed:
+- working copy - bounded size version histograms are calculated from (only with WORKING_COPY_MAX_SIDE above 0),
+  stored as PNG, so every job reads the same pixels as the one which decoded the original
+- thumbnail - small JPEG version shown in search results instead of the original
+
+Derivatives are kept in the storage next to the originals under `derivatives/<kind>/`, their keys are derived
+from the name of the original file, so duplicates sharing a file share its derivatives too.
+
+Derivatives of images processed before they were introduced can be created with: python -m similarities.derivatives
+"""
+import argparse
+import logging
+
+import cv2
+import numpy as np
+from decouple import config
+from sqlmodel import select
+
+from similarities.db import get_session_instance
+from similarities.derivative_keys import DerivativeKind, get_derivative_key
+from similarities.image_header import IMAGE_HEADER_READ_SIZE, read_image_header
+from similarities.models import Image
+from similarities.storage import storage
+
+
+logger = logging.getLogger(__name__)
+
+WORKING_COPY_MAX_SIDE = config("WORKING_COPY_MAX_SIDE", default=0, cast=int)
+THUMBNAIL_MAX_SIDE = config("THUMBNAIL_MAX_SIDE", default=256, cast=int)
+DERIVATIVE_JPEG_QUALITY = config("DERIVATIVE_JPEG_QUALITY", default=90, cast=int)
+# Fast compression, the working copy is written once and read by every job of the image
+WORKING_COPY_PNG_COMPRESSION = 1
+
+# Decoding at 1/2, 1/4 or 1/8 of the size is done by the JPEG decoder itself, skipping most of the work
+REDUCED_COLOR_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def reduced_read_flag(width: int, height: int, max_side: int) -> int:
+    """
+    Flag decoding the image at the smallest scale still having its longer side at least `max_side`.
+    """
+
+    if max_side > 0:
+        for scale, flag in REDUCED_COLOR_FLAGS:
+            if max(width, height) // scale >= max_side:
+                return flag
+    return cv2.IMREAD_COLOR
+
+
+def decode_image(content: bytes, max_side: int) -> np.ndarray | None:
+    """
+    Decodes the image with its longer side limited to `max_side` (0 keeps the original size).
+    """
+
+    header = read_image_header(content[:IMAGE_HEADER_READ_SIZE])
+    flag = reduced_read_flag(header.width, header.height, max_side) if header else cv2.IMREAD_COLOR
+    image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), flag)
+    return None if image is None else downscale(image, max_side)
+
+
+def read_image(image_key: str, max_side: int) -> np.ndarray | None:
+    """
+    Reads the stored image with its longer side limited to `max_side` (0 keeps the original size).
+    """
+
+    try:
+        # Ranged read, the file is not downloaded when it's not readable anyway
+        header = read_image_header(storage.read(image_key, 0, IMAGE_HEADER_READ_SIZE))
+        image_path = storage.local_path(image_key)
+    except OSError:
+        return None
+    flag = reduced_read_flag(header.width, header.height, max_side) if header else cv2.IMREAD_COLOR
+    image = cv2.imread(str(image_path), flag)
+    return None if image is None else downscale(image, max_side)
+
+
+def downscale(image: np.ndarray, max_side: int) -> np.ndarray:
+    height, width = image.shape[:2]
+    if max_side <= 0 or max(height, width) <= max_side:
+        return image
+    scale = max_side / max(height, width)
+    size = (max(round(width * scale), 1), max(round(height * scale), 1))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def read_working_image(image_key: str) -> np.ndarray | None:
+    """
+    Image histograms are calculated from. The working copy is read when it exists, otherwise the original is read
+    and derivatives are written, unless another job of the image did it already. None when the image can't be read.
+    """
+
+    if WORKING_COPY_MAX_SIDE > 0:
+        try:
+            image = cv2.imread(str(storage.local_path(get_derivative_key(image_key, DerivativeKind.WORKING))))
+        except FileNotFoundError:
+            image = None
+        if image is not None:
+            return image
+
+    image = read_image(image_key, WORKING_COPY_MAX_SIDE)
+    # The working copy is missing when it's enabled, the thumbnail could be written by another job of the image
+    thumbnail_key = get_derivative_key(image_key, DerivativeKind.THUMBNAIL)
+    if image is not None and (WORKING_COPY_MAX_SIDE > 0 or not storage.exists(thumbnail_key)):
+        save_derivatives(image_key, image)
+    return image
+
+
+def save_derivatives(image_key: str, working_image: np.ndarray):
+    """
+    Writes the working copy (when enabled) and the thumbnail made from the already decoded working image.
+    """
+
+    if WORKING_COPY_MAX_SIDE > 0:
+        _write_image(
+            get_derivative_key(image_key, DerivativeKind.WORKING),
+            working_image,
+            [cv2.IMWRITE_PNG_COMPRESSION, WORKING_COPY_PNG_COMPRESSION],
+        )
+    _write_image(
+        get_derivative_key(image_key, DerivativeKind.THUMBNAIL),
+        downscale(working_image, THUMBNAIL_MAX_SIDE),
+        [cv2.IMWRITE_JPEG_QUALITY, DERIVATIVE_JPEG_QUALITY],
+    )
+
+
+def _write_image(key: str, image: np.ndarray, params: list[int]):
+    # Format is given by the extension of the key
+    success, encoded = cv2.imencode(f".{key.rpartition('.')[2]}", image, params)
+    if not success:
+        raise ValueError(f"Could not encode derivative {key}")
+    storage.write_bytes(key, encoded.tobytes())
+
+
+def create_missing_derivatives() -> int:
+    """
+    Creates derivatives of processed images missing them. Returns the number of images they were created for.
+    """
+
+    created = 0
+    session = get_session_instance()
+    image_keys = session.exec(select(Image.path).where(Image.processed_at.is_not(None)).distinct()).all()
+    for image_key in image_keys:
+        if storage.exists(get_derivative_key(image_key, DerivativeKind.THUMBNAIL)):
+            continue
+        image = read_image(image_key, WORKING_COPY_MAX_SIDE)
+        if image is None:
+            logger.error("Could not read image %s", image_key)
+            continue
+        save_derivatives(image_key, image)
+        created += 1
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    print(f"Created derivatives of {create_missing_derivatives()} images")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+"""
+Sizes of histogram vectors. Kept apart from `similarities.histograms`, so models (and the API) can be imported
+without loading OpenCV and scikit-image.
+"""
+
+COLOR_HISTOGRAM_VECTOR_SIZE = 512
+HOG_HISTOGRAM_VECTOR_SIZE = 1764
+TEXTURE_HISTOGRAM_VECTOR_SIZE = 48
@@ -1,7 +1,18 @@
+from enum import Enum
+from functools import lru_cache
+from typing import Iterable, NamedTuple
+
 import cv2
 import numpy as np
 from skimage.feature import hog
 
+from similarities.dimensions import (
+    COLOR_HISTOGRAM_VECTOR_SIZE,
+    HOG_HISTOGRAM_VECTOR_SIZE,
+    TEXTURE_HISTOGRAM_VECTOR_SIZE,
+)
+from similarities.metrics import PROCESSING_DURATION
+
 
 """
 ---------------------------------------
@@ -13,9 +24,112 @@ from skimage.feature import hog
 ---------------------------------------
 """
 
-COLOR_HISTOGRAM_VECTOR_SIZE = 512
-HOG_HISTOGRAM_VECTOR_SIZE = 1764
-TEXTURE_HISTOGRAM_VECTOR_SIZE = 48
+HOG_IMAGE_SIZE = (64, 64)
+
+DESCRIPTORS = ("color", "hog", "texture")
+
+GABOR_KERNEL_SIZE = 31
+TEXTURE_HISTOGRAM_BINS = 12
+
+
+def _build_gabor_kernels() -> list[np.ndarray]:
+    num_orientations = 4
+    frequency = 0.2
+    orientations = np.linspace(0, np.pi, num_orientations, endpoint=False)
+    return [
+        cv2.getGaborKernel((GABOR_KERNEL_SIZE, GABOR_KERNEL_SIZE), 4.0, theta, frequency, 0.5, 0, ktype=cv2.CV_32F)
+        for theta in orientations
+    ]
+
+
+GABOR_KERNELS = _build_gabor_kernels()
+
+
+class TextureFilter(str, Enum):
+    SPATIAL = "spatial"
+    FFT = "fft"
+
+
+class PreparedImage(NamedTuple):
+    """
+    Image variants shared by all histogram types, so each conversion is done only once per image.
+    """
+    bgr: np.ndarray
+    gray: np.ndarray
+    hog_gray: np.ndarray
+
+
+class ImageHistograms(NamedTuple):
+    # None for descriptors which were not calculated
+    color: np.ndarray | None
+    hog: np.ndarray | None
+    texture: np.ndarray | None
+
+
+class HistogramsBatch(NamedTuple):
+    color: np.ndarray  # (N, 512)
+    hog: np.ndarray  # (N, 1764)
+    texture: np.ndarray  # (N, 48)
+
+
+def prepare_image(image) -> PreparedImage:
+    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return PreparedImage(
+        bgr=image,
+        gray=gray_image,
+        hog_gray=cv2.resize(gray_image, HOG_IMAGE_SIZE),
+    )
+
+
+def calculate_histograms(
+        image,
+        texture_max_side: int | None = None,
+        texture_filter: TextureFilter = TextureFilter.SPATIAL,
+        descriptors: Iterable[str] = DESCRIPTORS,
+) -> ImageHistograms:
+    """
+    Histograms of `descriptors` (all of them by default) for a single image, sharing the preprocessing between them.
+    """
+
+    descriptors = set(descriptors)
+    color = hog_histogram = texture = None
+    with PROCESSING_DURATION.labels("prepare").time():
+        prepared = prepare_image(image)
+    if "color" in descriptors:
+        with PROCESSING_DURATION.labels("color").time():
+            color = _color_histogram(prepared.bgr)
+    if "hog" in descriptors:
+        with PROCESSING_DURATION.labels("hog").time():
+            hog_histogram = _hog_histogram(prepared.hog_gray)
+    if "texture" in descriptors:
+        with PROCESSING_DURATION.labels("texture").time():
+            texture = _texture_histogram(prepared.gray, texture_max_side, texture_filter)
+    return ImageHistograms(color=color, hog=hog_histogram, texture=texture)
+
+
+def calculate_histograms_batch(
+        images: Iterable,
+        texture_max_side: int | None = None,
+        texture_filter: TextureFilter = TextureFilter.SPATIAL,
+) -> HistogramsBatch:
+    """
+    All histogram types for many images, stacked into float32 matrices (one row per image).
+    Images are consumed one by one, so a generator decoding them lazily keeps memory usage low.
+    Rows are equal to the single image functions' results cast to float32.
+    """
+
+    color_rows, hog_rows, texture_rows = [], [], []
+    for image in images:
+        histograms = calculate_histograms(image, texture_max_side, texture_filter)
+        color_rows.append(histograms.color)
+        hog_rows.append(histograms.hog)
+        texture_rows.append(histograms.texture)
+
+    return HistogramsBatch(
+        color=_stack_rows(color_rows, COLOR_HISTOGRAM_VECTOR_SIZE),
+        hog=_stack_rows(hog_rows, HOG_HISTOGRAM_VECTOR_SIZE),
+        texture=_stack_rows(texture_rows, TEXTURE_HISTOGRAM_VECTOR_SIZE),
+    )
 
 
 def calculate_color_histogram(image):
@@ -25,48 +139,133 @@ def calculate_color_histogram(image):
     Returns Vector size: 512
     """
 
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    channels = [0, 1, 2]
-    hist_size = [8, 8, 8]
-    ranges = [0, 256, 0, 256, 0, 256]
-    hist = cv2.calcHist([image], channels, None, hist_size, ranges)
-    return cv2.normalize(hist, hist).flatten()
+    return _color_histogram(image)
 
 
-def calculate_texture_histogram(image):
+def calculate_texture_histogram(
+        image,
+        max_side: int | None = None,
+        texture_filter: TextureFilter = TextureFilter.SPATIAL,
+):
     """
     Haralick (Texture histogram)
     For images with similar texture schema.
+    Images with longer side than `max_side` are downscaled before filtering.
+    FFT filtering gives results within float precision of the spatial one and is faster for big images.
     Returns Vector size: 48
     """
 
     gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return _texture_histogram(gray_image, max_side, texture_filter)
 
-    num_orientations = 4
-    num_bins = 12
-    ksize = 31
-    frequency = 0.2
-    orientations = np.linspace(0, np.pi, num_orientations, endpoint=False)
+
+def calculate_hog_histogram(image):
+    """
+    HOG (Histogram of Oriented Gradients)
+    For images with similar objects
+    Returns Vector size: 1764
+    """
+
+    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return _hog_histogram(cv2.resize(gray_image, HOG_IMAGE_SIZE))
+
+
+def calculate_perceptual_hash(gray_image) -> str:
+    """
+    Difference hash (dHash). Similar looking images have the same hash even if their files differ
+    (e.g. were resized or re-compressed).
+    Returns 64 bit hash as hex string.
+    """
+
+    resized_image = cv2.resize(gray_image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = resized_image[:, 1:] > resized_image[:, :-1]
+    return np.packbits(bits).tobytes().hex()
+
+
+def calculate_file_perceptual_hash(content: bytes) -> str | None:
+    """
+    Perceptual hash of an encoded image, None when it can't be decoded.
+    Hashes of uploads and bulk imports are compared exactly, so both are calculated by this function.
+    """
+
+    # Reduced decoding is enough for 9x8 hash and much faster than the full one
+    gray_image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    return None if gray_image is None else calculate_perceptual_hash(gray_image)
+
+
+def _color_histogram(bgr_image):
+    # Reading channels in reversed order gives the RGB histogram without converting the image
+    channels = [2, 1, 0]
+    hist_size = [8, 8, 8]
+    ranges = [0, 256, 0, 256, 0, 256]
+    hist = cv2.calcHist([bgr_image], channels, None, hist_size, ranges)
+    return cv2.normalize(hist, hist).flatten()
+
+
+def _texture_histogram(gray_image, max_side: int | None, texture_filter: TextureFilter):
+    if max_side and max(gray_image.shape) > max_side:
+        gray_image = _downscale(gray_image, max_side)
+
+    if texture_filter == TextureFilter.FFT:
+        filtered_images = _gabor_filter_fft(gray_image)
+    else:
+        filtered_images = (cv2.filter2D(gray_image, cv2.CV_32F, kernel) for kernel in GABOR_KERNELS)
 
     histograms = []
-    for theta in orientations:
-        kernel = cv2.getGaborKernel((ksize, ksize), 4.0, theta, frequency, 0.5, 0, ktype=cv2.CV_32F)
-        filtered = cv2.filter2D(gray_image, cv2.CV_32F, kernel)
-        hist, _ = np.histogram(filtered, bins=num_bins, range=(filtered.min(), filtered.max()), density=True)
+    for filtered in filtered_images:
+        hist, _ = np.histogram(
+            filtered, bins=TEXTURE_HISTOGRAM_BINS, range=(filtered.min(), filtered.max()), density=True
+        )
         histograms.append(hist)
 
     full_histogram = np.concatenate(histograms)
     return full_histogram / np.sum(full_histogram)
 
 
-def calculate_hog_histogram(image):
+def _downscale(image, max_side: int):
+    scale = max_side / max(image.shape[:2])
+    size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def _gabor_filter_fft(gray_image):
     """
-    HOG (Histogram of Oriented Gradients)
-    For images with similar objects
-    Returns Vector size: 1764
+    Same as `cv2.filter2D` with default border for every Gabor kernel,
+    but with a single forward transform of the image shared by all of them.
     """
 
-    target_size = (64, 64)
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    resized_image = cv2.resize(gray_image, target_size)
-    return hog(resized_image, orientations=9, pixels_per_cell=(8, 8), cells_per_block=(2, 2), block_norm='L2-Hys')
+    pad = GABOR_KERNEL_SIZE // 2
+    rows, cols = gray_image.shape
+    padded = cv2.copyMakeBorder(gray_image, pad, pad, pad, pad, cv2.BORDER_REFLECT_101)
+    dft_shape = (cv2.getOptimalDFTSize(padded.shape[0]), cv2.getOptimalDFTSize(padded.shape[1]))
+
+    dft_input = np.zeros(dft_shape, dtype=np.float32)
+    dft_input[:padded.shape[0], :padded.shape[1]] = padded
+    image_spectrum = cv2.dft(dft_input)
+
+    for kernel_spectrum in _gabor_kernel_spectra(dft_shape):
+        # Multiplying by the spectrum of the flipped kernel gives correlation, like filter2D does
+        filtered = cv2.idft(
+            cv2.mulSpectrums(image_spectrum, kernel_spectrum, 0), flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE
+        )
+        yield filtered[2 * pad:2 * pad + rows, 2 * pad:2 * pad + cols]
+
+
+@lru_cache(maxsize=2)
+def _gabor_kernel_spectra(dft_shape: tuple[int, int]) -> list[np.ndarray]:
+    spectra = []
+    for kernel in GABOR_KERNELS:
+        dft_input = np.zeros(dft_shape, dtype=np.float32)
+        dft_input[:GABOR_KERNEL_SIZE, :GABOR_KERNEL_SIZE] = kernel[::-1, ::-1]
+        spectra.append(cv2.dft(dft_input))
+    return spectra
+
+
+def _hog_histogram(resized_gray_image):
+    return hog(resized_gray_image, orientations=9, pixels_per_cell=(8, 8), cells_per_block=(2, 2), block_norm='L2-Hys')
+
+
+def _stack_rows(rows: list, vector_size: int) -> np.ndarray:
+    if not rows:
+        return np.empty((0, vector_size), dtype=np.float32)
+    return np.stack(rows).astype(np.float32, copy=False)
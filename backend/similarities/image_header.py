@@ -0,0 +1,78 @@
+"""
+Reading format and dimensions of images from the beginning of their files, without decoding them.
+"""
+import struct
+from typing import NamedTuple
+
+
+# Enough for metadata segments preceding dimensions in JPEG files
+IMAGE_HEADER_READ_SIZE = 512 * 1024
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8"
+
+# Start of frame markers containing dimensions, C4 (DHT), C8 (JPG) and CC (DAC) are not frames
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+JPEG_START_OF_SCAN = 0xDA
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD9)}
+
+
+class ImageHeader(NamedTuple):
+    format: str  # png or jpeg
+    width: int
+    height: int
+
+
+def read_image_header(data: bytes) -> ImageHeader | None:
+    """
+    Returns None when `data` doesn't start with a PNG or JPEG header or the dimensions aren't in it.
+    JPEG dimensions follow metadata segments (EXIF, ICC profile), so `data` should contain
+    the first `IMAGE_HEADER_READ_SIZE` bytes of the file.
+    """
+
+    if data.startswith(PNG_SIGNATURE):
+        return _read_png_header(data)
+    if data.startswith(JPEG_SIGNATURE):
+        return _read_jpeg_header(data)
+    return None
+
+
+def _read_png_header(data: bytes) -> ImageHeader | None:
+    # IHDR is always the first chunk: length, type, width, height
+    if len(data) < 24 or data[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", data[16:24])
+    return _valid_header("png", width, height)
+
+
+def _read_jpeg_header(data: bytes) -> ImageHeader | None:
+    position = len(JPEG_SIGNATURE)
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+
+        marker = data[position + 1]
+        if marker == 0xFF:  # Fill byte
+            position += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            position += 2
+            continue
+        if marker == JPEG_START_OF_SCAN:
+            return None
+
+        (segment_length,) = struct.unpack(">H", data[position + 2:position + 4])
+        if marker in JPEG_SOF_MARKERS:
+            if position + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[position + 5:position + 9])
+            return _valid_header("jpeg", width, height)
+        position += 2 + segment_length
+
+    return None
+
+
+def _valid_header(image_format: str, width: int, height: int) -> ImageHeader | None:
+    if width == 0 or height == 0:
+        return None
+    return ImageHeader(image_format, width, height)
@@ -0,0 +1,197 @@
+"""
+Lifecycle of pgvector ANN indexes on histogram columns.
+
+Indexes are not created together with the table, because ivfflat built on an empty table has useless centroids.
+They are built once the table has `VECTOR_INDEX_MIN_ROWS` processed images and rebuilt when their parameters
+no longer match the data size or the configuration.
+
+Indexes of a partitioned table (see `similarities.partitions`) are built concurrently on every partition and attached
+to an index of the whole table, which is valid once all of them are attached.
+
+With `VECTOR_INDEX_PRECISION=half` indexes are built on histograms cast to `halfvec` (pgvector 0.7+), which makes
+them half the size. Searches find candidates with the compact index and rerank them with the full vectors.
+
+Usage: python -m similarities.indexes
+"""
+import logging
+import math
+from typing import NamedTuple
+
+from decouple import config
+from rq import get_current_job
+from sqlalchemy import Connection, func, text
+from sqlmodel import select
+
+from similarities.db import engine
+from similarities.jobs import is_current_vector_indexes_maintenance, schedule_vector_indexes_maintenance
+from similarities.models import Image, histogram_dimensions
+from similarities.partitions import get_partitions
+from similarities.serializers import SearchType, SEARCH_TYPE_TO_COLUMN_NAME
+
+
+logger = logging.getLogger(__name__)
+
+VECTOR_INDEX_TYPE = config("VECTOR_INDEX_TYPE", default="hnsw")  # hnsw, ivfflat or none
+VECTOR_INDEX_MIN_ROWS = config("VECTOR_INDEX_MIN_ROWS", default=10000, cast=int)
+VECTOR_INDEX_PRECISION = config("VECTOR_INDEX_PRECISION", default="full")  # full or half
+HNSW_M = config("HNSW_M", default=16, cast=int)
+HNSW_EF_CONSTRUCTION = config("HNSW_EF_CONSTRUCTION", default=64, cast=int)
+
+INDEX_NAMES = {
+    SearchType.COLORS: "ix_image_color",
+    SearchType.OBJECTS: "ix_image_hog",
+    SearchType.TEXTURE: "ix_image_texture",
+}
+
+MAINTENANCE_LOCK_ID = 719719  # Postgres advisory lock, so only one worker builds indexes at a time
+
+
+HALF_PRECISION_OPERATOR_CLASS = "halfvec_l2_ops"
+
+
+class IndexDefinition(NamedTuple):
+    method: str  # Access method followed by the operator class when it's not vector_l2_ops
+    options: dict[str, str]
+
+
+def desired_index(row_count: int) -> IndexDefinition | None:
+    if VECTOR_INDEX_TYPE == "none" or row_count < VECTOR_INDEX_MIN_ROWS:
+        return None
+    if VECTOR_INDEX_TYPE == "ivfflat":
+        # pgvector recommendation: rows / 1000 lists up to 1M rows, sqrt(rows) above
+        lists = row_count // 1000 if row_count <= 1_000_000 else int(math.sqrt(row_count))
+        return IndexDefinition(_method("ivfflat"), {"lists": str(max(lists, 1))})
+    if VECTOR_INDEX_TYPE == "hnsw":
+        return IndexDefinition(_method("hnsw"), {"m": str(HNSW_M), "ef_construction": str(HNSW_EF_CONSTRUCTION)})
+    raise ValueError(f"Unknown vector index type: {VECTOR_INDEX_TYPE}")
+
+
+def _method(access_method: str) -> str:
+    if VECTOR_INDEX_PRECISION == "half":
+        return f"{access_method} {HALF_PRECISION_OPERATOR_CLASS}"
+    if VECTOR_INDEX_PRECISION == "full":
+        return access_method
+    raise ValueError(f"Unknown vector index precision: {VECTOR_INDEX_PRECISION}")
+
+
+def needs_rebuild(existing: IndexDefinition | None, desired: IndexDefinition | None) -> bool:
+    if existing is None or desired is None:
+        return existing != desired
+    if existing.method != desired.method:
+        return True
+    if desired.method.startswith("ivfflat"):
+        # Lists are rebuilt only when the data size changed a lot, every rebuild scans the whole table
+        existing_lists, desired_lists = int(existing.options.get("lists", 100)), int(desired.options["lists"])
+        return desired_lists >= 2 * existing_lists or 2 * desired_lists <= existing_lists
+    return existing.options != desired.options
+
+
+def maintain_vector_indexes():
+    """
+    Builds, rebuilds or drops indexes when needed. Indexes are built concurrently, searches are not blocked.
+    """
+
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        if not connection.scalar(text("SELECT pg_try_advisory_lock(:id)"), {"id": MAINTENANCE_LOCK_ID}):
+            logger.info("Vector indexes maintenance already running")
+            return
+
+        try:
+            for search_type, index_name in INDEX_NAMES.items():
+                _maintain_index(connection, search_type, index_name)
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MAINTENANCE_LOCK_ID})
+
+
+def maintain_vector_indexes_periodically():
+    """
+    Job which runs the maintenance and schedules itself again after `VECTOR_INDEX_CHECK_INTERVAL` seconds.
+    """
+
+    job = get_current_job()
+    if job and not is_current_vector_indexes_maintenance(job.id):
+        logger.info("Vector indexes maintenance job %s replaced by a newer one", job.id)
+        return
+
+    try:
+        maintain_vector_indexes()
+    finally:
+        schedule_vector_indexes_maintenance(next_run=True)
+
+
+def _maintain_index(connection: Connection, search_type: SearchType, index_name: str):
+    column_name = SEARCH_TYPE_TO_COLUMN_NAME[search_type]
+    image_column = getattr(Image, column_name)
+    row_count = connection.scalar(select(func.count()).select_from(Image).where(image_column.is_not(None)))
+    existing = _existing_index(connection, index_name)
+    desired = desired_index(row_count)
+    if not needs_rebuild(existing, desired):
+        return
+
+    # Index of a partitioned table can't be dropped concurrently, it's dropped with its partitions' indexes at once
+    partitions = get_partitions(connection)
+    drop_index = "DROP INDEX IF EXISTS" if partitions else "DROP INDEX CONCURRENTLY IF EXISTS"
+    if desired is None:
+        logger.info("Dropping index %s, %d rows", index_name, row_count)
+        connection.execute(text(f"{drop_index} {index_name}"))
+        return
+
+    logger.info("Building index %s %s, %d rows", index_name, desired, row_count)
+    new_index_name = f"{index_name}_new"
+    access_method, _, operator_class = desired.method.partition(" ")
+    if operator_class == HALF_PRECISION_OPERATOR_CLASS:
+        # Expression has to be the same as in searches, see `similarities.search`
+        indexed = f"({column_name}::halfvec({histogram_dimensions(column_name)})) {operator_class}"
+    else:
+        indexed = f"{column_name} vector_l2_ops"
+    options = ", ".join(f"{name} = {value}" for name, value in desired.options.items())
+    connection.execute(text(f"{drop_index} {new_index_name}"))  # Leftover of failed build
+    if not partitions:
+        connection.execute(text(
+            f"CREATE INDEX CONCURRENTLY {new_index_name} ON image USING {access_method} ({indexed}) WITH ({options})"
+        ))
+    else:
+        connection.execute(text(
+            f"CREATE INDEX {new_index_name} ON ONLY image USING {access_method} ({indexed}) WITH ({options})"
+        ))
+        for partition in partitions:
+            partition_index_name = f"{new_index_name}_{partition}"
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {partition_index_name}"))
+            connection.execute(text(
+                f"CREATE INDEX CONCURRENTLY {partition_index_name} ON {partition} "
+                f"USING {access_method} ({indexed}) WITH ({options})"
+            ))
+            connection.execute(text(f"ALTER INDEX {new_index_name} ATTACH PARTITION {partition_index_name}"))
+    connection.execute(text(f"{drop_index} {index_name}"))
+    connection.execute(text(f"ALTER INDEX {new_index_name} RENAME TO {index_name}"))
+    for partition in partitions:
+        # Names of the next build are free
+        connection.execute(text(f"ALTER INDEX {new_index_name}_{partition} RENAME TO {index_name}_{partition}"))
+
+
+def _existing_index(connection: Connection, index_name: str) -> IndexDefinition | None:
+    row = connection.execute(
+        text(
+            "SELECT am.amname, opc.opcname, c.reloptions FROM pg_class c "
+            "JOIN pg_am am ON am.oid = c.relam "
+            "JOIN pg_index i ON i.indexrelid = c.oid "
+            "JOIN pg_opclass opc ON opc.oid = i.indclass[0] "
+            "WHERE c.relname = :name AND c.relkind IN ('i', 'I')"
+        ),
+        {"name": index_name},
+    ).first()
+    if row is None:
+        return None
+
+    method, operator_class, reloptions = row
+    if operator_class != "vector_l2_ops":
+        # Index with another operator class is not used by l2 distance searches
+        method = f"{method} {operator_class}"
+    options = dict(option.split("=", 1) for option in reloptions or [])
+    return IndexDefinition(method, options)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    maintain_vector_indexes()
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import timedelta
+from uuid import UUID, uuid4
+
+import redis
+from decouple import Csv, config
+from rq import Queue, Retry
+
+from similarities.serializers import SearchType
+
+
+logger = logging.getLogger(__name__)
+
+HISTOGRAM_BATCH_SIZE = config("HISTOGRAM_BATCH_SIZE", default=1, cast=int)
+HISTOGRAM_BATCH_MAX_WAIT = config("HISTOGRAM_BATCH_MAX_WAIT", default=1.0, cast=float)
+# Histograms of other search types are calculated only when they're searched for the first time
+EAGER_SEARCH_TYPES = config(
+    "EAGER_SEARCH_TYPES", default=",".join(search_type.value for search_type in SearchType), cast=Csv(SearchType)
+)
+
+redis_conn = redis.from_url(config("QUEUE_BROKER_URL"))
+queue = Queue("default", connection=redis_conn)
+# Workers take jobs from the queues in the order they're given: rq worker high default
+priority_queue = Queue("high", connection=redis_conn)
+
+HISTOGRAM_JOB_RETRY = Retry(10, interval=[5 * 2**n for n in range(10)])  # Up to 2560 seconds between last retries
+
+# Repeated searches don't enqueue the same on demand job again during this time
+HISTOGRAM_REQUEST_TTL = 60
+
+VECTOR_INDEX_CHECK_INTERVAL = config("VECTOR_INDEX_CHECK_INTERVAL", default=600, cast=int)
+VECTOR_INDEXES_MAINTENANCE_KEY = "vector-indexes-maintenance-job"
+
+
+def schedule_vector_indexes_maintenance(next_run: bool = False):
+    """
+    Periodic maintenance of vector indexes is a chain of jobs, each one scheduling the next one.
+    Id of the next job in the chain is kept in Redis, so a new chain is started (`next_run=False`)
+    only when there's none or the previous one broke and its key expired.
+    """
+
+    job_id = f"maintain-vector-indexes-{uuid4()}"
+    lease = 3 * VECTOR_INDEX_CHECK_INTERVAL
+    if not next_run:
+        if redis_conn.set(VECTOR_INDEXES_MAINTENANCE_KEY, job_id, nx=True, ex=lease):
+            queue.enqueue("similarities.indexes.maintain_vector_indexes_periodically", job_id=job_id)
+        return
+
+    redis_conn.set(VECTOR_INDEXES_MAINTENANCE_KEY, job_id, ex=lease)
+    queue.enqueue_in(
+        timedelta(seconds=VECTOR_INDEX_CHECK_INTERVAL),
+        "similarities.indexes.maintain_vector_indexes_periodically",
+        job_id=job_id,
+    )
+
+
+def is_current_vector_indexes_maintenance(job_id: str) -> bool:
+    # Job of a chain replaced by a newer one. Missing key means it expired while the worker was down.
+    current_job_id = redis_conn.get(VECTOR_INDEXES_MAINTENANCE_KEY)
+    return current_job_id is None or current_job_id.decode() == job_id
+
+
+def request_histograms(image_ids: list[UUID], search_type: SearchType):
+    """
+    Puts a job calculating missing histograms of `search_type` on the priority queue, so searched images
+    are processed before the ones waiting in the default queue. Images already requested recently are skipped.
+    Blocks on Redis, the API calls it in a thread.
+    """
+
+    pipeline = redis_conn.pipeline()
+    for image_id in image_ids:
+        pipeline.set(f"histogram-requested:{search_type.value}:{image_id}", 1, nx=True, ex=HISTOGRAM_REQUEST_TTL)
+    requested_ids = [str(image_id) for image_id, is_new in zip(image_ids, pipeline.execute()) if is_new]
+    if requested_ids:
+        priority_queue.enqueue(
+            "similarities.processing.update_images_histograms",
+            requested_ids,
+            [search_type.value],
+            retry=HISTOGRAM_JOB_RETRY,
+        )
+
+
+def enqueue_neighbour_lists_builds(image_id_chunks: list[list[str]], search_type: SearchType):
+    # Chunks are independent, every free worker takes the next one
+    queue.enqueue_many([
+        Queue.prepare_data("similarities.neighbours.build_neighbour_lists", (image_ids, search_type.value))
+        for image_ids in image_id_chunks
+    ])
+
+
+class HistogramJobBuffer:
+    """
+    Coalesces ids of uploaded images, so that many of them are processed by a single worker job.
+    Pending ids are flushed to the queue when `max_size` of them are collected
+    or when the oldest one waits longer than `max_wait` seconds.
+    Every search type of `EAGER_SEARCH_TYPES` gets its own job, failure of one of them doesn't repeat the others.
+    """
+
+    def __init__(self, max_size: int, max_wait: float, search_types: list[SearchType] = EAGER_SEARCH_TYPES):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.search_types = search_types
+        self._pending: list[str] = []
+        self._oldest_pending_at: float | None = None
+        self._lock = threading.Lock()
+
+    def add(self, *image_ids: str):
+        # Flushing blocks on Redis, the API calls it in a thread
+        if not self.search_types or not image_ids:
+            return
+
+        with self._lock:
+            if not self._pending:
+                self._oldest_pending_at = time.monotonic()
+            self._pending.extend(image_ids)
+            is_full = len(self._pending) >= self.max_size
+
+        if is_full:
+            try:
+                self.flush()
+            except Exception:
+                # The upload is already stored, pending ids are flushed again periodically
+                logger.exception("Could not flush pending histogram jobs")
+
+    def flush(self):
+        with self._lock:
+            image_ids, self._pending = self._pending, []
+            self._oldest_pending_at = None
+
+        if not image_ids:
+            return
+
+        try:
+            # Ids added at once (e.g. by a batch upload) may be more than `max_size`
+            queue.enqueue_many([
+                Queue.prepare_data(
+                    "similarities.processing.update_images_histograms",
+                    (image_ids[start:start + self.max_size], [search_type.value]),
+                    retry=HISTOGRAM_JOB_RETRY,
+                )
+                for start in range(0, len(image_ids), self.max_size)
+                for search_type in self.search_types
+            ])
+        except Exception:
+            # Putting ids back so they are not lost when the broker is temporarily unavailable
+            with self._lock:
+                self._pending = image_ids + self._pending
+                self._oldest_pending_at = time.monotonic()
+            raise
+
+    def flush_expired(self):
+        with self._lock:
+            is_expired = (
+                self._oldest_pending_at is not None
+                and time.monotonic() - self._oldest_pending_at >= self.max_wait
+            )
+
+        if is_expired:
+            self.flush()
+
+    async def run_periodic_flush(self):
+        while True:
+            await asyncio.sleep(self.max_wait / 2)
+            try:
+                await asyncio.to_thread(self.flush_expired)
+            except Exception:
+                logger.exception("Could not flush pending histogram jobs")
+
+
+histogram_job_buffer = HistogramJobBuffer(max_size=HISTOGRAM_BATCH_SIZE, max_wait=HISTOGRAM_BATCH_MAX_WAIT)
@@ -0,0 +1,177 @@
+"""
+Prometheus metrics of the API (served at /metrics) and the worker (served by `MetricsWorker` on WORKER_METRICS_PORT).
+
+Processes sharing metrics (forked work horses of rq, many API processes) have to run with
+PROMETHEUS_MULTIPROC_DIR set to an empty directory, their values are then aggregated from the files written there.
+"""
+import os
+import shutil
+import time
+from datetime import UTC
+
+from decouple import config
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess, start_http_server
+from rq import SimpleWorker, Worker
+from rq.exceptions import InvalidJobOperation
+from rq.job import Job
+from rq.queue import Queue
+from rq.utils import now
+from sqlalchemy import Engine, event
+
+
+WORKER_METRICS_PORT = config("WORKER_METRICS_PORT", default=9100, cast=int)
+
+ROWS_BUCKETS = (0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+REQUEST_DURATION = Histogram(
+    "similarities_request_duration_seconds",
+    "Duration of API requests",
+    ["method", "route", "search_type", "status"],
+)
+SEARCH_DURATION = Histogram(
+    "similarities_search_duration_seconds",
+    "Duration of similarity searches, without loading the queried image",
+    ["backend", "search_type", "operation"],
+)
+SEARCH_ROWS = Histogram(
+    "similarities_search_rows",
+    "Rows scanned (memory backend) and returned by similarity searches",
+    ["backend", "search_type", "kind"],
+    buckets=ROWS_BUCKETS,
+)
+SEARCH_PARTITION_FAILURES = Counter(
+    "similarities_search_partition_failures",
+    "Partitions of the image table left out of partitioned searches, because they timed out or failed",
+    ["search_type", "reason"],
+)
+DB_QUERY_DURATION = Histogram(
+    "similarities_db_query_duration_seconds",
+    "Duration of database queries by statement type",
+    ["statement"],
+)
+PROCESSING_DURATION = Histogram(
+    "similarities_processing_duration_seconds",
+    "Duration of image processing stages: read, prepare, color, hog, texture, perceptual_hash and store",
+    ["stage"],
+)
+QUEUE_WAIT = Histogram(
+    "similarities_queue_wait_seconds",
+    "Time jobs spent in the queue before a worker started them",
+    ["function"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+)
+JOB_DURATION = Histogram(
+    "similarities_job_duration_seconds",
+    "Duration of worker jobs",
+    ["function", "status"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+
+STATEMENT_TYPES = {"select", "insert", "update", "delete", "copy", "create", "drop", "alter"}
+
+
+def metrics_registry() -> CollectorRegistry:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def latest_metrics() -> tuple[bytes, str]:
+    return generate_latest(metrics_registry()), CONTENT_TYPE_LATEST
+
+
+def instrument_engine(engine: Engine):
+    """
+    Measures all the queries run by the engine. Async engines are instrumented with their `sync_engine`.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - connection.info["query_start"].pop()
+        statement_type = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "other"
+        DB_QUERY_DURATION.labels(statement_type if statement_type in STATEMENT_TYPES else "other").observe(duration)
+
+
+class RequestMetricsMiddleware:
+    """
+    Pure ASGI middleware, so measuring doesn't wrap response bodies like `BaseHTTPMiddleware` does.
+    Routes are labeled with their templates to keep the number of series low.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Route is set in the scope by the router when the request matches it
+            route = scope.get("route")
+            REQUEST_DURATION.labels(
+                method=scope["method"],
+                route=route.path if route else "unmatched",
+                search_type=scope.get("path_params", {}).get("search_type", ""),
+                status=str(status_code),
+            ).observe(time.perf_counter() - start)
+
+
+class MetricsWorkerMixin:
+    """
+    Serves metrics of the worker and measures queue wait and duration of jobs. Both are measured by the main
+    worker process, metrics of the job itself are written by the work horse (see the module docstring).
+    """
+
+    def work(self, *args, **kwargs):
+        self.start_metrics_server()
+        return super().work(*args, **kwargs)
+
+    def start_metrics_server(self):
+        if multiprocess_directory := os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            # Values of the previous run would be added to the new ones
+            shutil.rmtree(multiprocess_directory, ignore_errors=True)
+            os.makedirs(multiprocess_directory)
+        start_http_server(WORKER_METRICS_PORT, registry=metrics_registry())
+
+    def execute_job(self, job: Job, queue: Queue):
+        function = job.func_name
+        if job.enqueued_at:
+            enqueued_at = job.enqueued_at if job.enqueued_at.tzinfo else job.enqueued_at.replace(tzinfo=UTC)
+            QUEUE_WAIT.labels(function).observe(max((now() - enqueued_at).total_seconds(), 0))
+
+        start = time.perf_counter()
+        try:
+            return super().execute_job(job, queue)
+        finally:
+            try:
+                status = job.get_status(refresh=True).value
+            except InvalidJobOperation:  # Removed right after finishing
+                status = "unknown"
+            JOB_DURATION.labels(function, status).observe(time.perf_counter() - start)
+
+
+class MetricsWorker(MetricsWorkerMixin, Worker):
+    pass
+
+
+class MetricsSimpleWorker(MetricsWorkerMixin, SimpleWorker):
+    pass
@@ -1,18 +1,18 @@
 from datetime import datetime, UTC
 from uuid import UUID, uuid4
 
-import cv2
-import numpy as np
+from decouple import config
 from fastapi import HTTPException, UploadFile, status
 from pgvector.sqlalchemy import Vector
-from sqlalchemy import Column
-from sqlmodel import Field, SQLModel, Index
+from sqlalchemy import ARRAY, Column, Float, Uuid
+from sqlmodel import Field, SQLModel
 
-from similarities.histograms import (
+from similarities.dimensions import (
     COLOR_HISTOGRAM_VECTOR_SIZE,
     HOG_HISTOGRAM_VECTOR_SIZE,
     TEXTURE_HISTOGRAM_VECTOR_SIZE,
 )
+from similarities.image_header import IMAGE_HEADER_READ_SIZE, read_image_header
 
 
 ACCEPTED_CONTENT_TYPES = {
@@ -21,31 +21,60 @@ ACCEPTED_CONTENT_TYPES = {
     "image/jpg",
 }
 
+MAX_IMAGE_PIXELS = config("MAX_IMAGE_PIXELS", default=100_000_000, cast=int)  # Decoded image takes 3 bytes per pixel
+# Hash partitions of the image table, 0 keeps it a single table. See `similarities.partitions`.
+IMAGE_PARTITIONS = config("IMAGE_PARTITIONS", default=0, cast=int)
+
 
 class Image(SQLModel, table=True):
+    __table_args__ = {"postgresql_partition_by": "HASH (id)"} if IMAGE_PARTITIONS else {}
+
     id: UUID = Field(default=uuid4, primary_key=True)
     path: str
+    content_hash: str | None = Field(default=None, index=True)
+    perceptual_hash: str | None = Field(default=None, index=True)
     color_hist: list[float] = Field(sa_column=Column(Vector(COLOR_HISTOGRAM_VECTOR_SIZE)))
     hog_hist: list[float] = Field(sa_column=Column(Vector(HOG_HISTOGRAM_VECTOR_SIZE)))
     texture_hist: list[float] = Field(sa_column=Column(Vector(TEXTURE_HISTOGRAM_VECTOR_SIZE)))
     created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
     processed_at: datetime | None
 
-    __table_args__ = (
-        Index('ix_image_color', 'color_hist', postgresql_using='ivfflat'),
-        Index('ix_image_hog', 'hog_hist', postgresql_using='ivfflat'),
-        Index('ix_image_texture', 'texture_hist', postgresql_using='ivfflat'),
-    )
+    # Vector indexes are managed separately, see `similarities.indexes`
+
+
+class NeighbourList(SQLModel, table=True):
+    """
+    Nearest images of an image by a search type, ordered by distance. See `similarities.neighbours`.
+    """
+
+    __tablename__ = "neighbour_list"
+
+    image_id: UUID = Field(primary_key=True)
+    search_type: str = Field(primary_key=True)
+    neighbour_ids: list[UUID] = Field(sa_column=Column(ARRAY(Uuid), nullable=False))
+    distances: list[float] = Field(sa_column=Column(ARRAY(Float), nullable=False))
+
+
+def histogram_dimensions(column_name: str) -> int:
+    return Image.__table__.columns[column_name].type.dim
 
 
 async def validate_image_content(image: UploadFile):
-    contents = await image.read()
+    """
+    Checks only the header of the file, so it's cheap for big images. Truncated or otherwise corrupted image data
+    is detected later by the worker, which doesn't calculate histograms for images it can't decode.
+    """
+
+    header = read_image_header(await image.read(IMAGE_HEADER_READ_SIZE))
     await image.seek(0)
-    file_bytes = np.frombuffer(contents, dtype=np.uint8)
-    im = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
 
-    if im is None or image.content_type not in ACCEPTED_CONTENT_TYPES:
+    if header is None or image.content_type not in ACCEPTED_CONTENT_TYPES:
         raise HTTPException(
             status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
             detail=f"Unsupported content type or corrupted image. Supported content types: {ACCEPTED_CONTENT_TYPES}",
         )
+    if header.width * header.height > MAX_IMAGE_PIXELS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Image dimensions too large. Max number of pixels: {MAX_IMAGE_PIXELS}",
+        )
@@ -0,0 +1,276 @@
+"""
+Materialized lists of nearest images, so repeated searches of popular images don't scan the table.
+
+With `NEIGHBOUR_LISTS_SIZE` (K) above 0 every processed image gets a list of its K nearest images for every
+search type, kept as arrays of ids and distances in a single `neighbour_list` row. Searches with `limit` up to K
+are served from the list of the searched image, the others and images without a list use a live search.
+
+Lists are maintained incrementally by the worker storing histograms. `NEIGHBOUR_UPDATE_CANDIDATES` nearest images
+of every new image are found (with the ANN index when it exists), the first K of them become the list of the new
+image and the new image is inserted into lists of the candidates it's closer to than their farthest neighbour.
+Work done per image is bounded, but images farther than the candidates are not updated and images processed
+at the same time by other jobs don't see each other, so lists drift slowly from the exact ones.
+Full rebuild calculates exact lists of all images in parallel jobs, it should be run after enabling the lists,
+after a bulk import and from time to time: python -m similarities.neighbours rebuild
+"""
+import argparse
+import logging
+from collections import defaultdict
+from uuid import UUID
+
+from decouple import config
+from pgvector.sqlalchemy import HALFVEC
+from sqlalchemy import cast, text, true
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
+from sqlmodel import Session, func, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from similarities.db import get_session_instance
+from similarities.indexes import VECTOR_INDEX_PRECISION
+from similarities.jobs import enqueue_neighbour_lists_builds
+from similarities.metrics import SEARCH_DURATION, SEARCH_ROWS
+from similarities.models import Image, NeighbourList, histogram_dimensions
+from similarities.search import HALF_PRECISION_CANDIDATES_FACTOR, MAX_HNSW_EF_SEARCH, SimilarImage
+from similarities.serializers import SearchType, SEARCH_TYPE_TO_COLUMN_NAME
+
+
+logger = logging.getLogger(__name__)
+
+NEIGHBOUR_LISTS_SIZE = config("NEIGHBOUR_LISTS_SIZE", default=0, cast=int)  # 0 disables the lists
+NEIGHBOUR_UPDATE_CANDIDATES = config("NEIGHBOUR_UPDATE_CANDIDATES", default=200, cast=int)
+NEIGHBOUR_REBUILD_CHUNK_SIZE = config("NEIGHBOUR_REBUILD_CHUNK_SIZE", default=100, cast=int)
+
+
+async def get_neighbour_list(
+        session: AsyncSession,
+        search_type: SearchType,
+        image_id: UUID,
+        limit: int = 10,
+        max_distance: float | None = None,
+) -> list[SimilarImage] | None:
+    """
+    Nearest images from the list of the image. None when the list can't answer the search (it doesn't exist
+    or `limit` is above its size), then a live search has to be done.
+    """
+
+    if limit > NEIGHBOUR_LISTS_SIZE:
+        return None
+
+    with SEARCH_DURATION.labels("neighbour_lists", search_type.value, "search").time():
+        row = (await session.exec(
+            select(NeighbourList.neighbour_ids, NeighbourList.distances)
+            .where(NeighbourList.image_id == image_id, NeighbourList.search_type == search_type.value)
+        )).first()
+        if row is None:
+            return None
+
+        neighbours = [
+            (neighbour_id, distance)
+            for neighbour_id, distance in zip(*row)
+            if max_distance is None or distance <= max_distance
+        ][:limit]
+        paths = dict((await session.exec(
+            select(Image.id, Image.path).where(Image.id.in_([neighbour_id for neighbour_id, _ in neighbours]))
+        )).all()) if neighbours else {}
+
+    SEARCH_ROWS.labels("neighbour_lists", search_type.value, "returned").observe(len(neighbours))
+    return [
+        SimilarImage(neighbour_id, paths[neighbour_id], distance)
+        for neighbour_id, distance in neighbours
+        if neighbour_id in paths
+    ]
+
+
+def update_neighbour_lists(session: Session, search_type: SearchType, image_ids: list[UUID]):
+    """
+    Adds images with newly stored histograms of `search_type`: creates their lists and inserts them into lists
+    of their nearest images. Changes are committed together with the histograms by the caller.
+    """
+
+    if not NEIGHBOUR_LISTS_SIZE or not image_ids:
+        return
+
+    candidates = _nearest_images(session, search_type, image_ids, NEIGHBOUR_UPDATE_CANDIDATES, exact=False)
+    _upsert_lists(session, search_type, {
+        image_id: image_candidates[:NEIGHBOUR_LISTS_SIZE] for image_id, image_candidates in candidates.items()
+    })
+
+    # New images in the same batch already found each other, only lists of older images are updated
+    new_neighbours = defaultdict(list)
+    for image_id, image_candidates in candidates.items():
+        for candidate_id, distance in image_candidates:
+            if candidate_id not in candidates:
+                new_neighbours[candidate_id].append((image_id, distance))
+    if not new_neighbours:
+        return
+
+    # Locked in the same order by all the jobs, so concurrent updates of a list are not lost and don't deadlock
+    lists = session.exec(
+        select(NeighbourList.image_id, NeighbourList.neighbour_ids, NeighbourList.distances)
+        .where(NeighbourList.search_type == search_type.value, NeighbourList.image_id.in_(list(new_neighbours)))
+        .order_by(NeighbourList.image_id)
+        .with_for_update()
+    ).all()
+    updates = []
+    for image_id, neighbour_ids, distances in lists:
+        merged = merge_neighbours(neighbour_ids, distances, new_neighbours[image_id], NEIGHBOUR_LISTS_SIZE)
+        if merged:
+            neighbour_ids, distances = merged
+            updates.append({
+                "image_id": image_id,
+                "search_type": search_type.value,
+                "neighbour_ids": neighbour_ids,
+                "distances": distances,
+            })
+    if updates:
+        session.exec(update(NeighbourList), params=updates)
+    logger.info("Added %d images to %d %s neighbour lists", len(image_ids), len(updates), search_type.value)
+
+
+def merge_neighbours(
+        neighbour_ids: list[UUID], distances: list[float], new_neighbours: list[tuple[UUID, float]], size: int
+) -> tuple[list[UUID], list[float]] | None:
+    """
+    List with `new_neighbours` inserted by distance and cut to `size`. None when none of them gets into it.
+    """
+
+    present = set(neighbour_ids)
+    new_neighbours = [
+        (neighbour_id, distance)
+        for neighbour_id, distance in new_neighbours
+        if neighbour_id not in present and (len(neighbour_ids) < size or distance < distances[-1])
+    ]
+    if not new_neighbours:
+        return None
+
+    merged = sorted([*zip(neighbour_ids, distances), *new_neighbours], key=lambda neighbour: neighbour[1])[:size]
+    return [neighbour_id for neighbour_id, _ in merged], [distance for _, distance in merged]
+
+
+def build_neighbour_lists(image_ids: list[str], search_type: str):
+    """
+    Job calculating exact lists of the images. Every image is compared with all the others,
+    the index is not used.
+    """
+
+    search_type = SearchType(search_type)
+    session = get_session_instance()
+    lists = _nearest_images(session, search_type, image_ids, NEIGHBOUR_LISTS_SIZE, exact=True)
+    _upsert_lists(session, search_type, lists)
+    session.commit()
+    logger.info("Built %d %s neighbour lists", len(lists), search_type.value)
+
+
+def rebuild_neighbour_lists(search_types: list[SearchType], chunk_size: int = NEIGHBOUR_REBUILD_CHUNK_SIZE) -> int:
+    """
+    Enqueues jobs building lists of all processed images, `chunk_size` images each, so many workers build
+    them in parallel. Returns the number of jobs.
+    """
+
+    session = get_session_instance()
+    jobs = 0
+    for search_type in search_types:
+        image_column = getattr(Image, SEARCH_TYPE_TO_COLUMN_NAME[search_type])
+        image_ids = [
+            str(image_id)
+            for image_id in session.exec(select(Image.id).where(image_column.is_not(None)).order_by(Image.id))
+        ]
+        session.rollback()
+        chunks = [image_ids[start:start + chunk_size] for start in range(0, len(image_ids), chunk_size)]
+        if chunks:
+            enqueue_neighbour_lists_builds(chunks, search_type)
+        jobs += len(chunks)
+    return jobs
+
+
+def _nearest_images(
+        session: Session, search_type: SearchType, image_ids: list, limit: int, exact: bool
+) -> dict[UUID, list[tuple[UUID, float]]]:
+    """
+    Nearest images of every image, all of them found with one query joining the table with itself.
+    """
+
+    column_name = SEARCH_TYPE_TO_COLUMN_NAME[search_type]
+    query_image = aliased(Image, name="query_image")
+    query_histogram = getattr(query_image, column_name)
+    distance = getattr(Image, column_name).l2_distance(query_histogram)
+    index_distance, candidates = distance, limit + 1  # One more row for the image itself
+    exact = exact or candidates > MAX_HNSW_EF_SEARCH  # hnsw can't return more rows
+    if exact:
+        session.exec(text("SET LOCAL enable_indexscan = off"))
+    elif VECTOR_INDEX_PRECISION == "half" and candidates * HALF_PRECISION_CANDIDATES_FACTOR <= MAX_HNSW_EF_SEARCH:
+        # Same expression as the one indexed in `similarities.indexes`, candidates are reranked with full vectors
+        half_vector = HALFVEC(histogram_dimensions(column_name))
+        index_distance = cast(getattr(Image, column_name), half_vector).l2_distance(
+            cast(query_histogram, half_vector)
+        )
+        candidates *= HALF_PRECISION_CANDIDATES_FACTOR
+    session.exec(select(func.set_config("hnsw.ef_search", str(candidates), True)))
+
+    nearest = (
+        select(Image.id, distance.label("distance"))
+        .order_by(index_distance)
+        .limit(candidates)
+        .lateral("nearest")
+    )
+    query = (
+        select(query_image.id, nearest.c.id, nearest.c.distance)
+        .select_from(query_image)
+        .join(nearest, true())
+        .where(
+            query_image.id.in_(image_ids),
+            query_histogram.is_not(None),
+            nearest.c.id != query_image.id,
+            nearest.c.distance.is_not(None),
+        )
+        .order_by(query_image.id, nearest.c.distance)
+    )
+    rows = session.exec(query).all()
+    if exact:
+        session.exec(text("SET LOCAL enable_indexscan = on"))
+    results = defaultdict(list)
+    for image_id, neighbour_id, neighbour_distance in rows:
+        if len(results[image_id]) < limit:
+            results[image_id].append((neighbour_id, neighbour_distance))
+    return results
+
+
+def _upsert_lists(session: Session, search_type: SearchType, lists: dict[UUID, list[tuple[UUID, float]]]):
+    if not lists:
+        return
+
+    statement = insert(NeighbourList).values([
+        {
+            "image_id": image_id,
+            "search_type": search_type.value,
+            "neighbour_ids": [neighbour_id for neighbour_id, _ in neighbours],
+            "distances": [distance for _, distance in neighbours],
+        }
+        for image_id, neighbours in lists.items()
+    ])
+    session.exec(statement.on_conflict_do_update(
+        index_elements=[NeighbourList.image_id, NeighbourList.search_type],
+        set_={"neighbour_ids": statement.excluded.neighbour_ids, "distances": statement.excluded.distances},
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="Enqueue jobs building lists of all images")
+    rebuild_parser.add_argument(
+        "--search-types", type=lambda value: [SearchType(search_type) for search_type in value.split(",")],
+        default=list(SearchType),
+    )
+    rebuild_parser.add_argument("--chunk-size", type=int, default=NEIGHBOUR_REBUILD_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if not NEIGHBOUR_LISTS_SIZE:
+        parser.error("Neighbour lists are disabled, set NEIGHBOUR_LISTS_SIZE")
+    print(f"Enqueued {rebuild_neighbour_lists(args.search_types, args.chunk_size)} jobs")
+
+
+if __name__ == "__main__":
+    main()
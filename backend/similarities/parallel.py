@@ -0,0 +1,158 @@
+import atexit
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Iterable, Iterator, NamedTuple
+
+import cv2
+import numpy as np
+from decouple import config
+
+from similarities.histograms import (
+    DESCRIPTORS,
+    ImageHistograms,
+    TextureFilter,
+    calculate_color_histogram,
+    calculate_hog_histogram,
+    calculate_texture_histogram,
+)
+
+
+HISTOGRAM_POOL_SIZE = config("HISTOGRAM_POOL_SIZE", default=0, cast=int)
+
+
+class SharedImage(NamedTuple):
+    """
+    Reference to a decoded image placed in shared memory, cheap to send to the pool processes.
+    """
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+
+class HistogramPool:
+    """
+    Calculates histograms in a pool of processes.
+    Every descriptor of every image is a separate task, so both a single big image
+    and a batch of images keep all the processes busy.
+    Decoded images are passed to the processes through shared memory instead of being pickled.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=init_pool_process,
+        )
+
+    def calculate(
+            self,
+            image: np.ndarray,
+            texture_max_side: int | None = None,
+            texture_filter: TextureFilter = TextureFilter.SPATIAL,
+    ) -> ImageHistograms:
+        [(_, histograms)] = self.calculate_many([(None, image)], texture_max_side, texture_filter)
+        return histograms
+
+    def calculate_many(
+            self,
+            images: Iterable[tuple[Any, np.ndarray]],
+            texture_max_side: int | None = None,
+            texture_filter: TextureFilter = TextureFilter.SPATIAL,
+            descriptors: Iterable[str] = DESCRIPTORS,
+    ) -> Iterator[tuple[Any, ImageHistograms]]:
+        """
+        Takes (key, image) pairs and yields (key, histograms of `descriptors`) pairs in the same order.
+        At most twice as many images as there are processes are kept in shared memory at once.
+        """
+
+        descriptors = [descriptor for descriptor in DESCRIPTORS if descriptor in set(descriptors)]
+        in_flight: deque[tuple[Any, SharedMemory, dict[str, Future]]] = deque()
+        try:
+            for key, image in images:
+                shared_memory = _share_image(image)
+                shared_image = SharedImage(shared_memory.name, image.shape, image.dtype.str)
+                futures = {
+                    descriptor: self._executor.submit(
+                        _calculate_descriptor, shared_image, descriptor, texture_max_side, texture_filter
+                    )
+                    for descriptor in descriptors
+                }
+                in_flight.append((key, shared_memory, futures))
+
+                if len(in_flight) >= 2 * self.max_workers:
+                    yield _collect(*in_flight.popleft())
+
+            while in_flight:
+                yield _collect(*in_flight.popleft())
+        finally:
+            for _, shared_memory, futures in in_flight:
+                for future in futures.values():
+                    future.cancel()
+                _release(shared_memory, futures)
+
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+_pool: HistogramPool | None = None
+
+
+def get_histogram_pool() -> HistogramPool | None:
+    """
+    Pool shared by all jobs run in the process, created on first use. None when HISTOGRAM_POOL_SIZE is 0.
+    """
+
+    global _pool
+    if _pool is None and HISTOGRAM_POOL_SIZE > 0:
+        _pool = HistogramPool(HISTOGRAM_POOL_SIZE)
+        atexit.register(_pool.shutdown)
+    return _pool
+
+
+def init_pool_process():
+    # Parallelism comes from the pool, OpenCV threads would only compete with other processes
+    cv2.setNumThreads(1)
+
+
+def _calculate_descriptor(
+        shared_image: SharedImage, descriptor: str, texture_max_side: int | None, texture_filter: TextureFilter
+) -> np.ndarray:
+    shared_memory = SharedMemory(name=shared_image.name)
+    try:
+        image = np.ndarray(shared_image.shape, dtype=np.dtype(shared_image.dtype), buffer=shared_memory.buf)
+        if descriptor == "color":
+            result = calculate_color_histogram(image)
+        elif descriptor == "hog":
+            result = calculate_hog_histogram(image)
+        else:
+            result = calculate_texture_histogram(image, texture_max_side, texture_filter)
+        del image  # Shared memory can't be closed while there are views on it
+        return result
+    finally:
+        shared_memory.close()
+
+
+def _share_image(image: np.ndarray) -> SharedMemory:
+    shared_memory = SharedMemory(create=True, size=max(image.nbytes, 1))
+    np.ndarray(image.shape, dtype=image.dtype, buffer=shared_memory.buf)[:] = image
+    return shared_memory
+
+
+def _collect(key: Any, shared_memory: SharedMemory, futures: dict[str, Future]) -> tuple[Any, ImageHistograms]:
+    try:
+        results = {descriptor: future.result() for descriptor, future in futures.items()}
+    finally:
+        _release(shared_memory, futures)
+    return key, ImageHistograms(results.get("color"), results.get("hog"), results.get("texture"))
+
+
+def _release(shared_memory: SharedMemory, futures: dict[str, Future]):
+    # Waiting for running tasks, so memory is not unlinked while a process still reads it
+    for future in futures.values():
+        if not future.cancelled():
+            future.exception()
+    shared_memory.close()
+    shared_memory.unlink()
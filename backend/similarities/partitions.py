@@ -0,0 +1,123 @@
+"""
+Hash partitioning of the image table by image id.
+
+With `IMAGE_PARTITIONS` (N) above 0 the table is created partitioned into N tables `image_p0`...`image_p<N-1>`.
+Rows are spread evenly by the hash of their id, the database routes inserts and updates of `image` to them.
+`SEARCH_BACKEND=partitioned` searches all the partitions at once, each one in its own connection, so a search
+is done by N database processes instead of one (see `PartitionedSearchBackend`). Partitions can be moved to other
+disks (tablespaces) or other servers (postgres_fdw foreign tables attached as partitions).
+
+The table is created partitioned only when it doesn't exist yet. Existing table is converted, or repartitioned
+after `IMAGE_PARTITIONS` was changed, with: python -m similarities.partitions migrate
+All rows are copied in one transaction, which blocks the table, and ANN indexes are dropped, the worker
+builds them again.
+"""
+import argparse
+import logging
+
+from sqlalchemy import Connection, MetaData, func, select, text
+
+from similarities.models import IMAGE_PARTITIONS, Image
+
+
+logger = logging.getLogger(__name__)
+
+# New table is built there and moved in place of the old one
+MIGRATION_SCHEMA = "image_migration"
+
+# Partitions of the image table in the current schema, none when it's not partitioned
+PARTITIONS_QUERY = text(
+    "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+    "WHERE i.inhparent = to_regclass('image') ORDER BY c.relname"
+)
+
+
+def partition_name(remainder: int) -> str:
+    return f"image_p{remainder}"
+
+
+def get_partitions(connection: Connection) -> list[str]:
+    return list(connection.scalars(PARTITIONS_QUERY))
+
+
+def create_missing_partitions(connection: Connection, partitions: int = IMAGE_PARTITIONS):
+    """
+    Creates partitions of the table created partitioned. Table with other partitioning has to be migrated.
+    """
+
+    if not partitions:
+        return
+
+    is_partitioned = connection.scalar(text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('image')"))
+    existing = get_partitions(connection)
+    if not is_partitioned or existing and len(existing) != partitions:
+        logger.warning(
+            "Image table doesn't have %d partitions (it has %d), run: python -m similarities.partitions migrate",
+            partitions, len(existing),
+        )
+        return
+
+    for remainder in range(partitions):
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(remainder)} PARTITION OF image "
+            f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+        ))
+
+
+def migrate(connection: Connection, partitions: int) -> int:
+    """
+    Recreates the image table with `partitions` hash partitions (0 makes it a single table) and copies
+    all the rows there. Returns the number of copied rows.
+    """
+
+    schema = connection.scalar(
+        text("SELECT relnamespace::regnamespace::text FROM pg_class WHERE oid = 'image'::regclass")
+    )
+    table = Image.__table__.to_metadata(MetaData())
+    table.dialect_options["postgresql"]["partition_by"] = "HASH (id)" if partitions else None
+
+    connection.execute(text(f"DROP SCHEMA IF EXISTS {MIGRATION_SCHEMA} CASCADE"))  # Leftover of failed migration
+    connection.execute(text(f"CREATE SCHEMA {MIGRATION_SCHEMA}"))
+    # Created in the first schema of the search path, not with the schema in their names, so indexes get the same
+    # names as the ones created by `create_all`. Types of extensions are found in the rest of the path.
+    search_path = connection.scalar(text("SELECT current_setting('search_path')"))
+    connection.execute(select(func.set_config("search_path", f"{MIGRATION_SCHEMA}, {search_path}", True)))
+    table.create(connection)
+    partition_names = [partition_name(remainder) for remainder in range(partitions)]
+    for remainder, name in enumerate(partition_names):
+        connection.execute(text(
+            f"CREATE TABLE {name} PARTITION OF image FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"
+        ))
+    connection.execute(select(func.set_config("search_path", search_path, True)))
+
+    # Columns added by upgrades are at the end of the old table, they're listed to match them by name
+    columns = ", ".join(column.name for column in table.columns)
+    rows = connection.execute(
+        text(f"INSERT INTO {MIGRATION_SCHEMA}.image ({columns}) SELECT {columns} FROM image")
+    ).rowcount
+
+    # Indexes (and partitions) of the old table are dropped with it, so the new ones can take their names
+    connection.execute(text("DROP TABLE image"))
+    for name in ["image", *partition_names]:
+        connection.execute(text(f"ALTER TABLE {MIGRATION_SCHEMA}.{name} SET SCHEMA {schema}"))
+    connection.execute(text(f"DROP SCHEMA {MIGRATION_SCHEMA}"))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="Recreate the image table with --partitions partitions")
+    migrate_parser.add_argument("--partitions", type=int, default=IMAGE_PARTITIONS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    from similarities.db import engine  # The database module creates partitions on startup with this module
+
+    with engine.begin() as connection:
+        rows = migrate(connection, args.partitions)
+    print(f"Copied {rows} images to the table with {args.partitions} partitions")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,197 @@
 import logging
 from datetime import datetime, UTC
+from typing import Iterable, Iterator
+from uuid import UUID
 
-import cv2
+import numpy as np
+from decouple import config
+from sqlalchemy import or_
+from sqlalchemy.orm import aliased
+from sqlmodel import Session, select, update
 
+from similarities.cache import result_cache
 from similarities.db import get_session_instance
+from similarities.derivatives import read_working_image
 from similarities.models import Image
-from similarities.histograms import (
-    calculate_color_histogram, calculate_hog_histogram, calculate_texture_histogram
-)
+from similarities.histograms import ImageHistograms, TextureFilter, calculate_file_perceptual_hash, calculate_histograms
+from similarities.metrics import PROCESSING_DURATION
+from similarities.neighbours import update_neighbour_lists
+from similarities.parallel import get_histogram_pool
+from similarities.serializers import SEARCH_TYPE_TO_COLUMN_NAME, SEARCH_TYPE_TO_DESCRIPTOR, SearchType
+from similarities.storage import storage
 
 
 logger = logging.getLogger(__name__)
 
+TEXTURE_MAX_SIDE = config("TEXTURE_MAX_SIDE", default=0, cast=int)
+TEXTURE_FILTER = config("TEXTURE_FILTER", default=TextureFilter.SPATIAL.value, cast=TextureFilter)
+PERCEPTUAL_DEDUPLICATION = config("PERCEPTUAL_DEDUPLICATION", default=False, cast=bool)
 
-def update_image_histograms(image_id: str):
-    logger.info("Processing image", image_id)
+
+class UnreadableImages(Exception):
+    pass
+
+
+def update_image_histograms(image_id: str, search_types: list[str] | None = None):
+    update_images_histograms([image_id], search_types)
+
+
+def update_images_histograms(image_ids: list[str], search_types: list[str] | None = None):
+    """
+    Batch job calculating histograms of `search_types` (all of them by default) for many images at once.
+    Images are loaded with a single query and results of every search type are stored with their own bulk UPDATE
+    and commit. Histograms already stored (e.g. by an earlier attempt of a retried job or by a job requested
+    on demand) are not calculated again. Images which can't be read fail the job after the others are stored,
+    so only they are processed by its retries.
+    """
+
+    search_types = [SearchType(search_type) for search_type in search_types or SearchType]
+    columns = {search_type: getattr(Image, SEARCH_TYPE_TO_COLUMN_NAME[search_type]) for search_type in search_types}
+    logger.info("Processing %d images, %s", len(image_ids), ", ".join(search_type.value for search_type in columns))
 
     session = get_session_instance()
-    image_obj = session.get(Image, image_id)
+    images = session.exec(
+        select(Image.id, Image.path, Image.perceptual_hash)
+        .where(Image.id.in_(image_ids), or_(*(column.is_(None) for column in columns.values())))
+    ).all()
+
+    if PERCEPTUAL_DEDUPLICATION:
+        images = _reuse_perceptual_duplicates(session, images, search_types)
+
+    descriptors = [SEARCH_TYPE_TO_DESCRIPTOR[search_type] for search_type in search_types]
+    updates = {search_type: [] for search_type in search_types}
+    unreadable_ids = []
+    try:
+        for image_id, histograms in _calculate_histograms(_read_images(images, unreadable_ids), descriptors):
+            for search_type, descriptor in zip(search_types, descriptors):
+                updates[search_type].append({
+                    "id": image_id,
+                    SEARCH_TYPE_TO_COLUMN_NAME[search_type]: getattr(histograms, descriptor),
+                    "processed_at": datetime.now(UTC),
+                })
+    finally:
+        # Histograms calculated before a failure are kept, a retried job calculates only the rest
+        for search_type, search_type_updates in updates.items():
+            _store_histograms(session, search_type, search_type_updates)
+
+    if unreadable_ids:
+        raise UnreadableImages(", ".join(str(image_id) for image_id in unreadable_ids))
+
+
+def _store_histograms(session: Session, search_type: SearchType, updates: list[dict]):
+    if not updates:
+        return
+
+    with PROCESSING_DURATION.labels("store").time():
+        session.exec(update(Image), params=updates)
+        image_ids = [entry["id"] for entry in updates]
+        image_ids += _copy_histograms_to_pending_duplicates(session, search_type, image_ids)
+        update_neighbour_lists(session, search_type, image_ids)
+        session.commit()
+    result_cache.invalidate()
+
+
+def _reuse_perceptual_duplicates(session: Session, images: list, search_types: list[SearchType]) -> list:
+    """
+    Finds images looking the same as the given ones, which already have histograms of `search_types`,
+    and stores their histograms for the given ones. Returns images which still need processing.
+    Perceptual hash is calculated once and stored for all the images.
+    """
+
+    perceptual_hashes, hash_updates = {}, []
+    for image_id, image_path, perceptual_hash in images:
+        if perceptual_hash is None:
+            with PROCESSING_DURATION.labels("perceptual_hash").time():
+                try:
+                    perceptual_hash = calculate_file_perceptual_hash(storage.local_path(image_path).read_bytes())
+                except FileNotFoundError:
+                    perceptual_hash = None
+            if perceptual_hash is None:
+                continue
+            hash_updates.append({"id": image_id, "perceptual_hash": perceptual_hash})
+        perceptual_hashes[image_id] = perceptual_hash
+
+    if hash_updates:
+        session.exec(update(Image), params=hash_updates)
+        session.commit()
+
+    columns = [getattr(Image, SEARCH_TYPE_TO_COLUMN_NAME[search_type]) for search_type in search_types]
+    duplicates = {
+        duplicate.perceptual_hash: duplicate
+        for duplicate in session.exec(
+            select(Image)
+            .where(
+                Image.perceptual_hash.in_(set(perceptual_hashes.values())),
+                Image.id.not_in(list(perceptual_hashes)),
+                *(column.is_not(None) for column in columns),
+            )
+            .distinct(Image.perceptual_hash)
+        )
+    }
+
+    images_to_process = []
+    updates = {search_type: [] for search_type in search_types}
+    for image in images:
+        duplicate = duplicates.get(perceptual_hashes.get(image.id))
+        if duplicate is None:
+            images_to_process.append(image)
+            continue
+
+        logger.info("Reusing histograms of image %s for image %s", duplicate.id, image.id)
+        for search_type in search_types:
+            column_name = SEARCH_TYPE_TO_COLUMN_NAME[search_type]
+            updates[search_type].append(
+                {"id": image.id, column_name: getattr(duplicate, column_name), "processed_at": datetime.now(UTC)}
+            )
+
+    for search_type, search_type_updates in updates.items():
+        _store_histograms(session, search_type, search_type_updates)
+    return images_to_process
+
+
+def _copy_histograms_to_pending_duplicates(
+        session: Session, search_type: SearchType, image_ids: list[UUID]
+) -> list[UUID]:
+    """
+    Uploads of the same content as an image still being processed are not processed on their own.
+    They get histograms of the image when they're stored. Returns ids of the updated duplicates.
+    """
+
+    column_name = SEARCH_TYPE_TO_COLUMN_NAME[search_type]
+    source = aliased(Image)
+    return session.exec(
+        update(Image)
+        .where(
+            source.id.in_(image_ids),
+            Image.content_hash == source.content_hash,
+            Image.id != source.id,
+            getattr(Image, column_name).is_(None),
+        )
+        .values({column_name: getattr(source, column_name), "processed_at": source.processed_at})
+        .returning(Image.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
 
-    image = cv2.imread(image_obj.path)
 
-    color_histogram = calculate_color_histogram(image)
-    hog_histogram = calculate_hog_histogram(image)
-    texture_histogram = calculate_texture_histogram(image)
+def _read_images(images: list, unreadable_ids: list[UUID]) -> Iterator[tuple[UUID, np.ndarray]]:
+    # Derivatives (working copy and thumbnail) are written when the original is read for the first time
+    for image_id, image_path, *_ in images:
+        with PROCESSING_DURATION.labels("read").time():
+            image = read_working_image(image_path)
+        if image is None:
+            logger.error("Could not read image %s from %s", image_id, image_path)
+            unreadable_ids.append(image_id)
+            continue
+        yield image_id, image
 
 
-    image_obj.color_hist = color_histogram
-    image_obj.hog_hist = hog_histogram
-    image_obj.texture_hist = texture_histogram
-    image_obj.processed_at = datetime.now(UTC)
+def _calculate_histograms(
+        images: Iterable[tuple[UUID, np.ndarray]], descriptors: list[str]
+) -> Iterator[tuple[UUID, ImageHistograms]]:
+    pool = get_histogram_pool()
+    if pool:
+        yield from pool.calculate_many(images, TEXTURE_MAX_SIDE, TEXTURE_FILTER, descriptors)
+        return
 
-    session.add(image_obj)
-    session.commit()
+    for image_id, image in images:
+        yield image_id, calculate_histograms(image, TEXTURE_MAX_SIDE, TEXTURE_FILTER, descriptors)
@@ -0,0 +1,77 @@
+"""
+Histograms of query images sent with a search request. They're calculated in the API process, not stored anywhere.
+OpenCV and scikit-image are imported with the first query image, API replicas not getting any don't load them.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+from decouple import config
+
+from similarities.serializers import SearchType
+
+
+QUERY_IMAGE_WORKERS = config("QUERY_IMAGE_WORKERS", default=2, cast=int)
+QUERY_IMAGE_MAX_PENDING = config("QUERY_IMAGE_MAX_PENDING", default=8, cast=int)
+QUERY_IMAGE_MAX_BYTES = config("QUERY_IMAGE_MAX_BYTES", default=20 * 1024 * 1024, cast=int)
+
+
+class ExecutorBusy(Exception):
+    pass
+
+
+class BoundedExecutor:
+    """
+    Thread pool accepting at most `max_pending` tasks (running and queued) at once, so requests sent faster
+    than they're calculated are rejected instead of piling up with their images in memory.
+    OpenCV and numpy release the GIL, so the threads don't block the event loop.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query-image")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    async def run(self, function: Callable, *args):
+        if not self._slots.acquire(blocking=False):
+            raise ExecutorBusy()
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # Released when the task ends, not when the request waiting for it is cancelled and the thread still runs
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def calculate_query_histogram(content: bytes, search_type: SearchType) -> np.ndarray | None:
+    """
+    Histogram of `search_type` calculated the same way as by the worker (from the image downscaled like
+    its working copy). None when the image can't be decoded.
+    """
+
+    from similarities.derivatives import WORKING_COPY_MAX_SIDE, decode_image
+    from similarities.histograms import (
+        calculate_color_histogram,
+        calculate_hog_histogram,
+        calculate_texture_histogram,
+    )
+    from similarities.processing import TEXTURE_FILTER, TEXTURE_MAX_SIDE
+
+    image = decode_image(content, WORKING_COPY_MAX_SIDE)
+    if image is None:
+        return None
+
+    if search_type == SearchType.COLORS:
+        return calculate_color_histogram(image)
+    if search_type == SearchType.OBJECTS:
+        return calculate_hog_histogram(image)
+    return calculate_texture_histogram(image, TEXTURE_MAX_SIDE, TEXTURE_FILTER)
+
+
+query_image_executor = BoundedExecutor(QUERY_IMAGE_WORKERS, QUERY_IMAGE_MAX_PENDING)
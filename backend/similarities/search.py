@@ -0,0 +1,679 @@
+import asyncio
+import heapq
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Awaitable, Callable, NamedTuple
+from uuid import UUID
+
+import numpy as np
+from decouple import config
+from pgvector.sqlalchemy import HALFVEC
+from sqlalchemy import ColumnElement, MetaData, Table, bindparam, cast, text, true
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import aliased
+from sqlalchemy.pool import QueuePool
+from sqlmodel import func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from similarities.indexes import HALF_PRECISION_OPERATOR_CLASS, INDEX_NAMES
+from similarities.metrics import SEARCH_DURATION, SEARCH_PARTITION_FAILURES, SEARCH_ROWS
+from similarities.models import Image, histogram_dimensions
+from similarities.partitions import PARTITIONS_QUERY
+from similarities.serializers import SearchType, SEARCH_TYPE_TO_COLUMN_NAME
+from similarities.timing import StageTimings
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HNSW_EF_SEARCH = 40
+# Searches needing more rows than hnsw can return scan the whole table instead of using the index
+MAX_HNSW_EF_SEARCH = 1000
+
+# Rows found with half precision indexes are reranked with full vectors, more of them are taken to keep the recall
+HALF_PRECISION_CANDIDATES_FACTOR = config("HALF_PRECISION_CANDIDATES_FACTOR", default=4, cast=int)
+COMBINED_SEARCH_CANDIDATES_FACTOR = config("COMBINED_SEARCH_CANDIDATES_FACTOR", default=5, cast=int)
+
+MAX_DISTANCE_MATRIX_SIZE = 2**24  # Limits memory used by a batch search in memory backend to 64MB
+
+
+class SimilarImage(NamedTuple):
+    id: UUID
+    path: str
+    distance: float
+
+
+class PartialResults(list):
+    """
+    Results of a search which didn't get answers from all partitions of the table. They shouldn't be cached.
+    """
+
+    def __init__(self, results: list[SimilarImage], missing_partitions: int):
+        super().__init__(results)
+        self.missing_partitions = missing_partitions
+
+
+class SearchBackend(ABC):
+    @abstractmethod
+    async def search(
+            self,
+            session: AsyncSession,
+            search_type: SearchType,
+            histogram,
+            exclude_id: UUID | None = None,
+            limit: int = 10,
+            max_distance: float | None = None,
+            probes: int | None = None,
+            ef_search: int | None = None,
+    ) -> list[SimilarImage]:
+        """
+        Images with histograms of `search_type` closest (L2 distance) to `histogram`, ordered by distance.
+        `probes` (ivfflat) and `ef_search` (hnsw) trade recall for speed of approximate searches.
+        """
+
+    @abstractmethod
+    async def search_many(
+            self,
+            session: AsyncSession,
+            search_type: SearchType,
+            queries: list[tuple[UUID, list[float]]],
+            limit: int = 10,
+            max_distance: float | None = None,
+            probes: int | None = None,
+            ef_search: int | None = None,
+    ) -> dict[UUID, list[SimilarImage]]:
+        """
+        Searches for many (image id, histogram) pairs at once. Image itself is excluded from its results.
+        """
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    Search done by the database with pgvector.
+    Uses ANN index when it exists (see `similarities.indexes`), otherwise scans the whole table.
+    """
+
+    def __init__(self, index_check_interval: float = 60):
+        self.index_check_interval = index_check_interval
+        self._half_precision_types: set[SearchType] = set()
+        self._indexes_checked_at: float | None = None
+
+    async def search(
+            self, session, search_type, histogram, exclude_id=None, limit=10, max_distance=None, probes=None,
+            ef_search=None,
+    ):
+        with SEARCH_DURATION.labels("postgres", search_type.value, "search").time():
+            results = await self._search_table(
+                session, Image.__table__, search_type, histogram, exclude_id, limit, max_distance, probes, ef_search
+            )
+        SEARCH_ROWS.labels("postgres", search_type.value, "returned").observe(len(results))
+        return results
+
+    async def search_many(
+            self, session, search_type, queries, limit=10, max_distance=None, probes=None, ef_search=None
+    ):
+        with SEARCH_DURATION.labels("postgres", search_type.value, "search_many").time():
+            results = await self._search_many_table(
+                session, Image.__table__, search_type, queries, limit, max_distance, probes, ef_search
+            )
+        SEARCH_ROWS.labels("postgres", search_type.value, "returned").observe(sum(map(len, results.values())))
+        return results
+
+    async def _search_table(
+            self,
+            session: AsyncSession,
+            table: Table,
+            search_type: SearchType,
+            histogram,
+            exclude_id: UUID | None,
+            limit: int,
+            max_distance: float | None,
+            probes: int | None,
+            ef_search: int | None,
+    ) -> list[SimilarImage]:
+        image_column = table.c[SEARCH_TYPE_TO_COLUMN_NAME[search_type]]
+        distance = image_column.l2_distance(histogram)
+        index_distance, candidates = await self._index_distance(
+            session, search_type, image_column, histogram, limit + 1
+        )
+        # Index scan returns only nearest rows and filters are applied on them afterwards,
+        # so they're applied outside of the query using the index (https://github.com/pgvector/pgvector/issues/719).
+        # One more row is taken for the excluded image.
+        nearest = (
+            select(table.c.id, table.c.path, distance.label("distance"))
+            .order_by(index_distance)
+            .limit(candidates)
+            .subquery()
+        )
+        query = (
+            select(nearest.c.id, nearest.c.path, nearest.c.distance)
+            .where(nearest.c.distance.is_not(None))
+            .order_by(nearest.c.distance)
+            .limit(limit)
+        )
+        if exclude_id:
+            query = query.where(nearest.c.id != exclude_id)
+        if max_distance:
+            query = query.where(nearest.c.distance <= max_distance)
+
+        async with self._index_options(session, candidates, probes, ef_search):
+            return [SimilarImage(image_id, path, distance) for image_id, path, distance in await session.exec(query)]
+
+    async def _search_many_table(
+            self,
+            session: AsyncSession,
+            table: Table,
+            search_type: SearchType,
+            queries: list[tuple[UUID, list[float]]],
+            limit: int,
+            max_distance: float | None,
+            probes: int | None,
+            ef_search: int | None,
+    ) -> dict[UUID, list[SimilarImage]]:
+        # Histograms of queried images are in the table already, they're joined there instead of being sent back
+        column_name = SEARCH_TYPE_TO_COLUMN_NAME[search_type]
+        query_image = aliased(Image, name="query_image")
+        query_histogram = getattr(query_image, column_name)
+        image_column = table.c[column_name]
+        distance = image_column.l2_distance(query_histogram)
+        index_distance, candidates = await self._index_distance(
+            session, search_type, image_column, query_histogram, limit + 1
+        )
+        nearest = (
+            select(table.c.id, table.c.path, distance.label("distance"))
+            .order_by(index_distance)
+            .limit(candidates)
+            .lateral("nearest")
+        )
+        query = (
+            select(query_image.id, nearest.c.id, nearest.c.path, nearest.c.distance)
+            .select_from(query_image)
+            .join(nearest, true())
+            .where(
+                query_image.id.in_([image_id for image_id, _ in queries]),
+                nearest.c.id != query_image.id,
+                nearest.c.distance.is_not(None),
+            )
+            .order_by(query_image.id, nearest.c.distance)
+        )
+        if max_distance:
+            query = query.where(nearest.c.distance <= max_distance)
+
+        async with self._index_options(session, candidates, probes, ef_search):
+            rows = await session.exec(query)
+        results = {image_id: [] for image_id, _ in queries}
+        for query_image_id, image_id, path, image_distance in rows:
+            if len(results[query_image_id]) < limit:
+                results[query_image_id].append(SimilarImage(image_id, path, image_distance))
+        return results
+
+    async def _index_distance(
+            self, session: AsyncSession, search_type: SearchType, image_column: ColumnElement, histogram, rows: int
+    ) -> tuple[ColumnElement, int]:
+        """
+        Distance ordering the nearest rows, so the existing index is used, and the number of rows to take.
+        Rows found with a half precision index are reranked with full vectors, so more of them are taken.
+        When there'd be more of them than hnsw can return, full vectors are compared without the index.
+        """
+
+        if (
+            rows * HALF_PRECISION_CANDIDATES_FACTOR > MAX_HNSW_EF_SEARCH
+            or search_type not in await self._half_precision_search_types(session)
+        ):
+            return image_column.l2_distance(histogram), rows
+
+        # Same expression as the one indexed in `similarities.indexes`
+        half_vector = HALFVEC(histogram_dimensions(SEARCH_TYPE_TO_COLUMN_NAME[search_type]))
+        distance = cast(image_column, half_vector).l2_distance(cast(histogram, half_vector))
+        return distance, rows * HALF_PRECISION_CANDIDATES_FACTOR
+
+    async def _half_precision_search_types(self, session: AsyncSession) -> set[SearchType]:
+        # Precision follows the indexes built by the worker, so changing `VECTOR_INDEX_PRECISION` doesn't require
+        # restarting the API and searches don't lose the old index before the new one is built
+        if (
+            self._indexes_checked_at is None
+            or time.monotonic() - self._indexes_checked_at >= self.index_check_interval
+        ):
+            index_names = {index_name: search_type for search_type, index_name in INDEX_NAMES.items()}
+            rows = await session.exec(
+                text(
+                    "SELECT c.relname FROM pg_class c "
+                    "JOIN pg_index i ON i.indexrelid = c.oid "
+                    "JOIN pg_opclass opc ON opc.oid = i.indclass[0] "
+                    "WHERE c.relname IN :names AND opc.opcname = :operator_class AND i.indisvalid"
+                ).bindparams(
+                    bindparam("names", list(index_names), expanding=True),
+                    operator_class=HALF_PRECISION_OPERATOR_CLASS,
+                )
+            )
+            self._half_precision_types = {index_names[index_name] for (index_name,) in rows}
+            self._indexes_checked_at = time.monotonic()
+        return self._half_precision_types
+
+    @staticmethod
+    @asynccontextmanager
+    async def _index_options(session: AsyncSession, rows: int, probes: int | None, ef_search: int | None):
+        if rows > MAX_HNSW_EF_SEARCH:
+            # Exact scan, other queries of the transaction can use indexes again
+            await session.exec(select(func.set_config("enable_indexscan", "off", True)))
+            yield
+            await session.exec(select(func.set_config("enable_indexscan", "on", True)))
+            return
+
+        # hnsw returns at most `ef_search` rows, it has to be at least the number of requested rows
+        ef_search = min(max(ef_search or DEFAULT_HNSW_EF_SEARCH, rows), MAX_HNSW_EF_SEARCH)
+        await session.exec(select(func.set_config("hnsw.ef_search", str(ef_search), True)))
+        if probes:
+            await session.exec(select(func.set_config("ivfflat.probes", str(probes), True)))
+        yield
+
+
+class PartitionedSearchBackend(PostgresSearchBackend):
+    """
+    Search of a partitioned image table (see `similarities.partitions`) done on all its partitions at once, each one
+    in its own connection of the engine of the search session, so they're scanned by many database processes
+    in parallel. Every partition returns
+    its nearest rows, they're merged by distance. Partitions not answering within `partition_timeout` seconds
+    are left out and results are marked partial. Not partitioned table is searched as by the postgres backend.
+
+    Transaction of the search session is rolled back before the partitions are searched, so a search holds
+    as many pool connections as there are partitions, not one more. The pool should have at least
+    partitions x concurrent searches connections, searches waiting for a free one fail after the pool timeout.
+    """
+
+    def __init__(self, partition_timeout: float, index_check_interval: float = 60):
+        super().__init__(index_check_interval)
+        self.partition_timeout = partition_timeout
+        self._partition_tables: list[Table] = []
+        self._partitions_checked_at: float | None = None
+
+    async def search(
+            self, session, search_type, histogram, exclude_id=None, limit=10, max_distance=None, probes=None,
+            ef_search=None,
+    ):
+        partition_tables = await self._get_partition_tables(session)
+        if not partition_tables:
+            return await super().search(
+                session, search_type, histogram, exclude_id, limit, max_distance, probes, ef_search
+            )
+
+        async def search_partition(partition_session: AsyncSession, table: Table) -> list[SimilarImage]:
+            return await self._search_table(
+                partition_session, table, search_type, histogram, exclude_id, limit, max_distance, probes, ef_search
+            )
+
+        with SEARCH_DURATION.labels("partitioned", search_type.value, "search").time():
+            partition_results = await self._on_partitions(session, partition_tables, search_type, search_partition)
+        results = list(islice(heapq.merge(*partition_results, key=lambda result: result.distance), limit))
+        SEARCH_ROWS.labels("partitioned", search_type.value, "returned").observe(len(results))
+
+        missing_partitions = len(partition_tables) - len(partition_results)
+        return PartialResults(results, missing_partitions) if missing_partitions else results
+
+    async def search_many(
+            self, session, search_type, queries, limit=10, max_distance=None, probes=None, ef_search=None
+    ):
+        partition_tables = await self._get_partition_tables(session)
+        if not partition_tables:
+            return await super().search_many(
+                session, search_type, queries, limit, max_distance, probes, ef_search
+            )
+
+        async def search_many_partition(partition_session: AsyncSession, table: Table) -> dict:
+            return await self._search_many_table(
+                partition_session, table, search_type, queries, limit, max_distance, probes, ef_search
+            )
+
+        with SEARCH_DURATION.labels("partitioned", search_type.value, "search_many").time():
+            partition_results = await self._on_partitions(
+                session, partition_tables, search_type, search_many_partition
+            )
+        missing_partitions = len(partition_tables) - len(partition_results)
+        results = {}
+        for image_id, _ in queries:
+            image_results = list(islice(
+                heapq.merge(
+                    *(partition[image_id] for partition in partition_results), key=lambda result: result.distance
+                ),
+                limit,
+            ))
+            if missing_partitions:
+                image_results = PartialResults(image_results, missing_partitions)
+            results[image_id] = image_results
+        SEARCH_ROWS.labels("partitioned", search_type.value, "returned").observe(sum(map(len, results.values())))
+        return results
+
+    async def _on_partitions(
+            self,
+            session: AsyncSession,
+            partition_tables: list[Table],
+            search_type: SearchType,
+            search_partition: Callable[[AsyncSession, Table], Awaitable],
+    ) -> list:
+        """
+        Results of `search_partition` run on all the partitions at once. Partitions which timed out or failed
+        are left out.
+        """
+
+        async def run(table: Table):
+            async with AsyncSession(session.bind, expire_on_commit=False) as partition_session:
+                # Timeout starts when the connection is checked out, waiting for the pool is limited by its timeout
+                await partition_session.connection()
+                # Database stops the query too, not only the client waiting for it
+                await partition_session.exec(select(func.set_config(
+                    "statement_timeout", str(int(self.partition_timeout * 1000)), True
+                )))
+                return await asyncio.wait_for(search_partition(partition_session, table), self.partition_timeout)
+
+        await session.rollback()  # Returns the connection of the search session to the pool
+        outcomes = await asyncio.gather(*(run(table) for table in partition_tables), return_exceptions=True)
+        results = []
+        for table, outcome in zip(partition_tables, outcomes):
+            if not isinstance(outcome, Exception):
+                results.append(outcome)
+                continue
+            if isinstance(outcome, PoolTimeoutError):
+                reason = "pool"
+            else:
+                reason = "timeout" if isinstance(outcome, TimeoutError) else "error"
+            SEARCH_PARTITION_FAILURES.labels(search_type.value, reason).inc()
+            logger.warning(
+                "Partition %s left out of %s search (%s): %r", table.name, search_type.value, reason, outcome
+            )
+        return results
+
+    async def _get_partition_tables(self, session: AsyncSession) -> list[Table]:
+        # Checked from time to time like indexes, the table can be migrated while the API is running
+        if (
+            self._partitions_checked_at is None
+            or time.monotonic() - self._partitions_checked_at >= self.index_check_interval
+        ):
+            partitions = (await session.exec(PARTITIONS_QUERY)).scalars().all()
+            pool = session.bind.sync_engine.pool
+            if isinstance(pool, QueuePool) and pool.size() < len(partitions):
+                logger.warning(
+                    "Database pool size %d is lower than the number of partitions %d, searches wait for connections",
+                    pool.size(), len(partitions),
+                )
+            metadata = MetaData()
+            self._partition_tables = [Image.__table__.to_metadata(metadata, name=name) for name in partitions]
+            self._partitions_checked_at = time.monotonic()
+        return self._partition_tables
+
+
+class MemorySearchBackend(SearchBackend):
+    """
+    Keeps histograms of all processed images in memory, one contiguous float32 matrix per search type.
+    Matrices are loaded on the first search and then refreshed incrementally with newly processed images.
+    """
+
+    def __init__(self, refresh_interval: float, refresh_overlap: float):
+        self.refresh_interval = refresh_interval
+        self.refresh_overlap = timedelta(seconds=refresh_overlap)
+        self._indexes: dict[SearchType, VectorIndex] = {}
+        self._lock = asyncio.Lock()
+
+    async def search(
+            self, session, search_type, histogram, exclude_id=None, limit=10, max_distance=None, probes=None,
+            ef_search=None,
+    ):
+        # Search is exact, index options are ignored
+        index = await self.get_index(session, search_type)
+        # numpy releases the GIL, so scanning the matrix in a thread doesn't block other requests
+        with SEARCH_DURATION.labels("memory", search_type.value, "search").time():
+            results = await asyncio.to_thread(
+                index.search, np.asarray(histogram, dtype=np.float32), exclude_id, limit, max_distance
+            )
+        SEARCH_ROWS.labels("memory", search_type.value, "scanned").observe(len(index))
+        SEARCH_ROWS.labels("memory", search_type.value, "returned").observe(len(results))
+        return results
+
+    async def search_many(
+            self, session, search_type, queries, limit=10, max_distance=None, probes=None, ef_search=None
+    ):
+        if not queries:
+            return {}
+
+        index = await self.get_index(session, search_type)
+        image_ids = [image_id for image_id, _ in queries]
+        histograms = np.stack([np.asarray(histogram, dtype=np.float32) for _, histogram in queries])
+        with SEARCH_DURATION.labels("memory", search_type.value, "search_many").time():
+            results = await asyncio.to_thread(index.search_many, histograms, image_ids, limit, max_distance)
+        SEARCH_ROWS.labels("memory", search_type.value, "scanned").observe(len(index) * len(image_ids))
+        SEARCH_ROWS.labels("memory", search_type.value, "returned").observe(sum(map(len, results)))
+        return dict(zip(image_ids, results))
+
+    async def get_index(self, session: AsyncSession, search_type: SearchType) -> "VectorIndex":
+        async with self._lock:
+            index = self._indexes.get(search_type)
+            if index is None:
+                index = self._indexes[search_type] = VectorIndex()
+
+            if index.refreshed_at is None or time.monotonic() - index.refreshed_at >= self.refresh_interval:
+                await self._refresh(session, search_type, index)
+            return index
+
+    async def _refresh(self, session: AsyncSession, search_type: SearchType, index: "VectorIndex"):
+        image_column = getattr(Image, SEARCH_TYPE_TO_COLUMN_NAME[search_type])
+        query = (
+            select(Image.id, Image.path, Image.processed_at, image_column)
+            .where(image_column.is_not(None))
+            .order_by(Image.processed_at)
+            .execution_options(yield_per=10000)
+        )
+        if index.processed_until:
+            # Jobs commit some time after `processed_at` is set, so recent images are re-read to not miss any
+            query = query.where(Image.processed_at >= index.processed_until - self.refresh_overlap)
+
+        loaded = 0
+        async for image_id, path, processed_at, histogram in await session.stream(query):
+            index.upsert(image_id, path, histogram)
+            index.processed_until = processed_at
+            loaded += 1
+
+        index.publish()
+        index.refreshed_at = time.monotonic()
+        logger.debug("Loaded %d %s histograms, %d in memory", loaded, search_type.value, len(index))
+
+
+class _PublishedRows(NamedTuple):
+    size: int
+    vectors: np.ndarray | None
+    squared_norms: np.ndarray
+
+
+class VectorIndex:
+    """
+    Exact nearest neighbours search over a growing float32 matrix.
+    Searches run in threads while the index is refreshed, so they see only rows published by `publish`.
+    New rows are written past the published ones and changed rows are written to copies of the matrix,
+    all of them become visible at once when the new arrays and size are published with a single assignment.
+    """
+
+    def __init__(self, initial_capacity: int = 1024):
+        self.ids: list[UUID] = []
+        self.paths: list[str] = []
+        self.processed_until: datetime | None = None
+        self.refreshed_at: float | None = None
+        self._rows: dict[UUID, int] = {}
+        self._vectors: np.ndarray | None = None
+        self._squared_norms = np.empty(initial_capacity, dtype=np.float32)
+        self._published = _PublishedRows(0, None, self._squared_norms)
+
+    def __len__(self):
+        return self._published.size
+
+    def upsert(self, image_id: UUID, path: str, histogram):
+        vector = np.asarray(histogram, dtype=np.float32)
+        row = self._rows.get(image_id)
+        if row is None:
+            row = len(self.ids)
+            self._ensure_capacity(row + 1, vector.shape[0])
+            self._rows[image_id] = row
+            self.ids.append(image_id)
+            self.paths.append(path)
+        elif row < self._published.size:
+            if np.array_equal(self._vectors[row], vector):
+                return  # Re-read by the overlap of refreshes
+            if self._vectors is self._published.vectors:
+                self._vectors, self._squared_norms = self._vectors.copy(), self._squared_norms.copy()
+
+        self._vectors[row] = vector
+        self._squared_norms[row] = vector @ vector
+
+    def publish(self):
+        self._published = _PublishedRows(len(self.ids), self._vectors, self._squared_norms)
+
+    def search(
+            self, histogram: np.ndarray, exclude_id: UUID | None, limit: int, max_distance: float | None
+    ) -> list[SimilarImage]:
+        [results] = self.search_many(histogram[np.newaxis], [exclude_id], limit, max_distance)
+        return results
+
+    def search_many(
+            self, histograms: np.ndarray, exclude_ids: list[UUID | None], limit: int, max_distance: float | None
+    ) -> list[list[SimilarImage]]:
+        """
+        Nearest neighbours of every row of `histograms`. Distances to all the vectors are calculated
+        with a single matrix product for as many rows at once as fit in `MAX_DISTANCE_MATRIX_SIZE`.
+        """
+
+        size, vectors, squared_norms = self._published
+        if size == 0 or limit <= 0:
+            return [[] for _ in histograms]
+
+        vectors = vectors[:size]
+        squared_norms = squared_norms[:size]
+        rows_per_step = max(1, MAX_DISTANCE_MATRIX_SIZE // size)
+        results = []
+        for start in range(0, len(histograms), rows_per_step):
+            step_histograms = histograms[start:start + rows_per_step]
+            # |a - b|^2 = |a|^2 - 2ab + |b|^2 needs only one matrix product
+            squared_distances = (
+                squared_norms[np.newaxis] - 2 * (step_histograms @ vectors.T)
+                + np.einsum("ij,ij->i", step_histograms, step_histograms)[:, np.newaxis]
+            )
+            for histogram, row_distances, exclude_id in zip(
+                    step_histograms, squared_distances, exclude_ids[start:start + rows_per_step]
+            ):
+                results.append(self._nearest(vectors, histogram, row_distances, exclude_id, limit, max_distance))
+        return results
+
+    def _nearest(
+            self,
+            vectors: np.ndarray,
+            histogram: np.ndarray,
+            squared_distances: np.ndarray,
+            exclude_id: UUID | None,
+            limit: int,
+            max_distance: float | None,
+    ) -> list[SimilarImage]:
+        exclude_row = self._rows.get(exclude_id)
+        if exclude_row is not None and exclude_row < len(squared_distances):
+            squared_distances[exclude_row] = np.inf
+
+        candidates_count = min(limit, len(squared_distances))
+        candidates = np.argpartition(squared_distances, candidates_count - 1)[:candidates_count]
+        candidates = candidates[np.isfinite(squared_distances[candidates])]
+
+        # Exact distances for the few candidates, the expansion above loses precision for close vectors
+        distances = np.linalg.norm(vectors[candidates] - histogram, axis=1)
+        order = np.argsort(distances, kind="stable")
+        if max_distance:
+            order = order[distances[order] <= max_distance]
+
+        return [
+            SimilarImage(self.ids[candidates[position]], self.paths[candidates[position]], float(distances[position]))
+            for position in order
+        ]
+
+    def _ensure_capacity(self, size: int, dimensions: int):
+        if self._vectors is None:
+            self._vectors = np.empty((len(self._squared_norms), dimensions), dtype=np.float32)
+        if size <= len(self._vectors):
+            return
+
+        # Published arrays are left as they are for searches running with them
+        capacity = max(size, 2 * len(self._vectors))
+        vectors = np.empty((capacity, dimensions), dtype=np.float32)
+        vectors[:len(self._vectors)] = self._vectors
+        squared_norms = np.empty(capacity, dtype=np.float32)
+        squared_norms[:len(self._squared_norms)] = self._squared_norms
+        self._vectors, self._squared_norms = vectors, squared_norms
+
+
+async def search_combined(
+        backend: SearchBackend,
+        session: AsyncSession,
+        histograms: dict[SearchType, list[float]],
+        weights: dict[SearchType, float],
+        exclude_id: UUID | None = None,
+        limit: int = 10,
+        max_distance: float | None = None,
+        probes: int | None = None,
+        ef_search: int | None = None,
+        timings: StageTimings | None = None,
+) -> list[SimilarImage]:
+    """
+    Images closest to `histograms` of many search types at once, ordered by the weighted mean of their distances.
+
+    Candidates are the nearest `limit * COMBINED_SEARCH_CANDIDATES_FACTOR` images of every weighted search type
+    (found with ANN indexes when they exist). Only the candidates are reranked: all their distances are calculated
+    in one query and each distance is divided by the largest distance of its search type among the candidates,
+    so search types with bigger distances don't dominate. `max_distance` applies to the combined 0..1 distance.
+    """
+
+    timings = timings or StageTimings()
+    weights = {search_type: weight for search_type, weight in weights.items() if weight > 0}
+    candidates_limit = limit * COMBINED_SEARCH_CANDIDATES_FACTOR
+
+    candidate_ids = set()
+    for search_type in weights:
+        with timings.stage(f"candidates-{search_type.value}"):
+            candidates = await backend.search(
+                session, search_type, histograms[search_type], exclude_id, candidates_limit,
+                probes=probes, ef_search=ef_search,
+            )
+        candidate_ids.update(candidate.id for candidate in candidates)
+
+    if not candidate_ids:
+        return []
+
+    with timings.stage("rerank"):
+        distances = [
+            getattr(Image, SEARCH_TYPE_TO_COLUMN_NAME[search_type]).l2_distance(histograms[search_type])
+            for search_type in weights
+        ]
+        rows = (await session.exec(select(Image.id, Image.path, *distances).where(Image.id.in_(candidate_ids)))).all()
+
+        # Missing histograms (not processed yet) count as the largest distance
+        matrix = np.array([row[2:] for row in rows], dtype=np.float64)
+        scales = np.nanmax(matrix, axis=0)
+        scales[~(scales > 0)] = 1
+        normalized = np.nan_to_num(matrix / scales, nan=1.0)
+        weights_vector = np.array(list(weights.values()))
+        scores = normalized @ weights_vector / weights_vector.sum()
+
+        order = np.argsort(scores, kind="stable")
+        if max_distance:
+            order = order[scores[order] <= max_distance]
+        return [SimilarImage(rows[row][0], rows[row][1], float(scores[row])) for row in order[:limit]]
+
+
+def create_search_backend(name: str) -> SearchBackend:
+    if name == "postgres":
+        return PostgresSearchBackend()
+    if name == "partitioned":
+        return PartitionedSearchBackend(partition_timeout=config("SEARCH_PARTITION_TIMEOUT", default=5.0, cast=float))
+    if name == "memory":
+        return MemorySearchBackend(
+            refresh_interval=config("MEMORY_SEARCH_REFRESH_INTERVAL", default=5.0, cast=float),
+            refresh_overlap=config("MEMORY_SEARCH_REFRESH_OVERLAP", default=300.0, cast=float),
+        )
+    raise ValueError(f"Unknown search backend: {name}")
+
+
+search_backend = create_search_backend(config("SEARCH_BACKEND", default="postgres"))
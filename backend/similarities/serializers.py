@@ -1,20 +1,32 @@
 from enum import Enum
 from uuid import UUID
 
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, Field, HttpUrl
 
 
 class ImageCreationResponse(BaseModel):
     id: UUID
 
 
+class BatchImageCreationEntry(BaseModel):
+    filename: str | None
+    id: UUID | None = None
+    error: str | None = None
+
+
+class BatchImageCreationResponse(BaseModel):
+    images: list[BatchImageCreationEntry]
+
+
 class SimilarResponseStatus(str, Enum):
     OK = "ok"
     PROCESSING = "processing"
+    NOT_FOUND = "not_found"
 
 
 class SimilarImageEntry(BaseModel):
     url: HttpUrl
+    thumbnail_url: HttpUrl
     distance: float
 
 
@@ -24,14 +36,41 @@ class SimilarImagesResponse(BaseModel):
     similar_images: list[SimilarImageEntry]
 
 
+class QueryImageSimilarImagesResponse(BaseModel):
+    similar_images: list[SimilarImageEntry]
+
+
 class SearchType(str, Enum):
     COLORS = "colors"
     OBJECTS = "objects"
     TEXTURE = "texture"
 
 
+class SimilarImagesBatchRequest(BaseModel):
+    image_ids: list[UUID] = Field(min_length=1)
+    search_types: list[SearchType] = Field(min_length=1)
+    limit: int = 10
+    max_distance: float | None = None
+    probes: int | None = None
+    ef_search: int | None = None
+
+
+class SimilarImagesBatchEntry(BaseModel):
+    image_id: UUID
+    search_type: SearchType
+    status: SimilarResponseStatus
+    similar_images: list[SimilarImageEntry]
+
+
 SEARCH_TYPE_TO_COLUMN_NAME = {
     SearchType.COLORS: "color_hist",
     SearchType.OBJECTS: "hog_hist",
     SearchType.TEXTURE: "texture_hist",
 }
+
+# Names of the descriptors in `similarities.histograms`
+SEARCH_TYPE_TO_DESCRIPTOR = {
+    SearchType.COLORS: "color",
+    SearchType.OBJECTS: "hog",
+    SearchType.TEXTURE: "texture",
+}
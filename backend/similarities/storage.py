@@ -1,30 +1,526 @@
+"""
+Storage of image files and their derivatives. Files are addressed by keys - paths relative to the storage root
+(e.g. `uploaded_images/ab/cd/<id>.jpg`) kept in `Image.path`.
+
+`STORAGE_BACKEND` selects where they're stored:
+- local - `STORAGE_DIR` on the local disk (default), the API and the workers have to share it
+- s3 - S3 compatible bucket (AWS S3, MinIO), so the API and the workers don't need a shared volume
+- memory - memory of the process, a stand-in for tests
+
+Workers read files with OpenCV, which needs them on the local disk. Remote files are downloaded once
+to a read-through cache (`STORAGE_CACHE_DIR`) limited to `STORAGE_CACHE_MAX_BYTES`.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, NamedTuple
 from urllib.parse import urljoin
+from uuid import uuid4
 
-import aiofiles
+from anyio import to_thread
 from decouple import config
 from fastapi import UploadFile
-from pydantic import HttpUrl
-
-from similarities.models import Image
 
 IMAGES_DIRECTORY = "uploaded_images"
+TEMPORARY_DIRECTORY = "tmp"
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class StorageWriter(ABC):
+    """
+    Streams a file to the storage. It's visible under its key only after `commit`, `abort` discards it.
+    """
+
+    @abstractmethod
+    def write(self, chunk: bytes):
+        pass
+
+    @abstractmethod
+    def commit(self):
+        pass
+
+    @abstractmethod
+    def abort(self):
+        pass
+
+
+class Storage(ABC):
+    @abstractmethod
+    def open_writer(self, key: str) -> StorageWriter:
+        pass
+
+    @abstractmethod
+    def read(self, key: str, start: int = 0, end: int | None = None) -> bytes:
+        """
+        Bytes from `start` to `end` (exclusive, None reads to the end of the file).
+        Raises FileNotFoundError when there's no file under the key.
+        """
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def move(self, source_key: str, destination_key: str):
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        """
+        Removes the file, missing files are ignored.
+        """
+
+    @abstractmethod
+    def public_url(self, key: str) -> str:
+        pass
+
+    @abstractmethod
+    def local_path(self, key: str) -> Path:
+        """
+        Path of the file on the local disk, e.g. to be read by OpenCV. Raises FileNotFoundError like `read`.
+        """
+
+    @contextmanager
+    def writer(self, key: str) -> Iterator[StorageWriter]:
+        writer = self.open_writer(key)
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def write_bytes(self, key: str, content: bytes):
+        with self.writer(key) as writer:
+            writer.write(content)
+
+
+class LocalFileWriter(StorageWriter):
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Renaming is atomic, so the file is never visible half written
+        self.temporary_path = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+        self.file = open(self.temporary_path, "wb")
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        self.temporary_path.replace(self.path)
+
+    def abort(self):
+        self.file.close()
+        self.temporary_path.unlink(missing_ok=True)
+
+
+class LocalStorage(Storage):
+    """
+    Keys are paths relative to `root`. Images stored before keys were introduced have absolute paths
+    as their keys, they resolve to themselves.
+    """
+
+    def __init__(self, root: str, service_url: str):
+        self.root = Path(root)
+        self.service_url = service_url
+        # Search results have many URLs, they're built by appending keys instead of joining every one of them
+        self.public_url_prefix = urljoin(service_url, f"{self.root}/")
+
+    def _path(self, key: str) -> Path:
+        return self.root / key
+
+    def open_writer(self, key: str) -> StorageWriter:
+        return LocalFileWriter(self._path(key))
+
+    def read(self, key: str, start: int = 0, end: int | None = None) -> bytes:
+        with open(self._path(key), "rb") as file:
+            file.seek(start)
+            return file.read(-1 if end is None else end - start)
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def move(self, source_key: str, destination_key: str):
+        destination_path = self._path(destination_key)
+        destination_path.parent.mkdir(parents=True, exist_ok=True)
+        self._path(source_key).replace(destination_path)
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def public_url(self, key: str) -> str:
+        # Served by the proxy from the storage directory
+        if key.startswith("/"):  # Absolute path of an image stored before keys were introduced
+            return urljoin(self.service_url, key)
+        return self.public_url_prefix + key
+
+    def local_path(self, key: str) -> Path:
+        path = self._path(key)
+        if not path.exists():
+            raise FileNotFoundError(path)
+        return path
+
+
+class ReadThroughCache:
+    """
+    Local copies of remote files. Least recently used ones are removed when the cache grows over `max_bytes`.
+    Many worker processes may share the directory, files are written under temporary names and renamed.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._size: int | None = None
+        self._lock = threading.Lock()
+
+    def get(self, key: str, download: Callable[[BinaryIO], None]) -> Path:
+        path = self.directory / key.lstrip("/")
+        if path.exists():
+            os.utime(path)  # Marks it recently used
+            return path
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = path.with_name(f".{path.name}.{uuid4().hex}.tmp")
+        try:
+            with open(temporary_path, "wb") as file:
+                download(file)
+            temporary_path.replace(path)
+        finally:
+            temporary_path.unlink(missing_ok=True)
+
+        self._added(path)
+        return path
+
+    def discard(self, key: str):
+        # Copy of a deleted file, `get` would keep returning it
+        (self.directory / key.lstrip("/")).unlink(missing_ok=True)
+
+    def _added(self, path: Path):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += path.stat().st_size
+            if self._size > self.max_bytes:
+                self._evict(keep=path)
+
+    def _files(self) -> list[tuple[float, int, Path]]:
+        files = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith("."):  # Still being downloaded
+                    continue
+                file_path = Path(root) / filename
+                try:
+                    stat = file_path.stat()
+                except FileNotFoundError:  # Removed by another process
+                    continue
+                files.append((stat.st_mtime, stat.st_size, file_path))
+        return files
+
+    def _evict(self, keep: Path):
+        files = sorted(self._files())
+        self._size = sum(size for _, size, _ in files)
+        for _, size, file_path in files:
+            if self._size <= self.max_bytes:
+                break
+            if file_path == keep:  # Just downloaded, it's about to be read
+                continue
+            file_path.unlink(missing_ok=True)
+            self._size -= size
+
+
+class S3Writer(StorageWriter):
+    """
+    Multipart upload sending a part whenever `part_size` bytes are buffered, so memory usage doesn't depend
+    on the file size. Files smaller than a single part are sent with one request.
+    """
+
+    def __init__(self, client, bucket: str, key: str, part_size: int):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id: str | None = None
+        self.parts: list[dict] = []
+
+    def write(self, chunk: bytes):
+        self.buffer += chunk
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def _upload_part(self, data: bytes):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=data
+        )
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+
+    def commit(self):
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            return
+        if self.buffer:
+            self._upload_part(bytes(self.buffer))
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": self.parts}
+        )
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class S3Storage(Storage):
+    """
+    One client with a pool of `max_connections` connections is shared by all threads of the process.
+    Forked processes (rq work horses) create their own, connections of the parent can't be reused.
+    """
+
+    def __init__(
+            self,
+            bucket: str,
+            endpoint_url: str | None,
+            region: str | None,
+            public_url: str | None,
+            max_connections: int,
+            part_size: int,
+            cache: ReadThroughCache,
+    ):
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.base_public_url = (public_url or (
+            f"{endpoint_url}/{bucket}" if endpoint_url else f"https://{bucket}.s3.amazonaws.com"
+        )).rstrip("/") + "/"
+        self.max_connections = max_connections
+        self.part_size = part_size
+        self.cache = cache
+        self._client = None
+        self._client_pid: int | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None or self._client_pid != os.getpid():
+                # Imported here, so it's not loaded by processes using other backends
+                import boto3
+                from botocore.config import Config
+
+                self._client = boto3.session.Session().client(
+                    "s3",
+                    endpoint_url=self.endpoint_url,
+                    region_name=self.region,
+                    config=Config(max_pool_connections=self.max_connections, retries={"mode": "standard"}),
+                )
+                self._client_pid = os.getpid()
+            return self._client
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return key.lstrip("/")
+
+    @contextmanager
+    def _not_found_error(self, key: str):
+        from botocore.exceptions import ClientError
+
+        try:
+            yield
+        except ClientError as error:
+            if error.response["Error"]["Code"] in {"404", "NoSuchKey", "NotFound"}:
+                raise FileNotFoundError(key) from error
+            raise
+
+    def open_writer(self, key: str) -> StorageWriter:
+        return S3Writer(self.client, self.bucket, self._key(key), self.part_size)
+
+    def read(self, key: str, start: int = 0, end: int | None = None) -> bytes:
+        options = {}
+        if start or end is not None:
+            options["Range"] = f"bytes={start}-{'' if end is None else end - 1}"
+        with self._not_found_error(key):
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(key), **options)
+        return response["Body"].read()
+
+    def exists(self, key: str) -> bool:
+        try:
+            with self._not_found_error(key):
+                self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def move(self, source_key: str, destination_key: str):
+        # Copied by the server, the content is not transferred through the API
+        with self._not_found_error(source_key):
+            self.client.copy_object(
+                Bucket=self.bucket,
+                Key=self._key(destination_key),
+                CopySource={"Bucket": self.bucket, "Key": self._key(source_key)},
+            )
+        self.delete(source_key)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+        self.cache.discard(self._key(key))
+
+    def public_url(self, key: str) -> str:
+        return self.base_public_url + self._key(key)
+
+    def local_path(self, key: str) -> Path:
+        def download(file: BinaryIO):
+            # Big files are downloaded with many concurrent ranged requests
+            with self._not_found_error(key):
+                self.client.download_fileobj(self.bucket, self._key(key), file)
+
+        return self.cache.get(self._key(key), download)
+
+
+class MemoryWriter(StorageWriter):
+    def __init__(self, files: dict[str, bytes], key: str):
+        self.files = files
+        self.key = key
+        self.buffer = bytearray()
+
+    def write(self, chunk: bytes):
+        self.buffer += chunk
+
+    def commit(self):
+        self.files[self.key] = bytes(self.buffer)
+
+    def abort(self):
+        self.buffer.clear()
+
+
+class MemoryStorage(Storage):
+    """
+    Files kept in memory of the process. Used in place of a remote storage in tests.
+    """
+
+    def __init__(self, service_url: str, cache: ReadThroughCache):
+        self.service_url = service_url
+        self.cache = cache
+        self.files: dict[str, bytes] = {}
+
+    def _content(self, key: str) -> bytes:
+        try:
+            return self.files[key]
+        except KeyError:
+            raise FileNotFoundError(key) from None
+
+    def open_writer(self, key: str) -> StorageWriter:
+        return MemoryWriter(self.files, key)
+
+    def read(self, key: str, start: int = 0, end: int | None = None) -> bytes:
+        return self._content(key)[start:end]
+
+    def exists(self, key: str) -> bool:
+        return key in self.files
+
+    def move(self, source_key: str, destination_key: str):
+        self.files[destination_key] = self._content(source_key)
+        del self.files[source_key]
+
+    def delete(self, key: str):
+        self.files.pop(key, None)
+        self.cache.discard(key)
+
+    def public_url(self, key: str) -> str:
+        return urljoin(self.service_url, key)
+
+    def local_path(self, key: str) -> Path:
+        content = self._content(key)
+        return self.cache.get(key, lambda file: file.write(content))
+
+
+def create_storage(name: str) -> Storage:
+    if name == "local":
+        return LocalStorage(config("STORAGE_DIR"), config("SERVICE_URL"))
+
+    cache = ReadThroughCache(
+        config("STORAGE_CACHE_DIR", default=os.path.join(tempfile.gettempdir(), "similarities-storage-cache")),
+        config("STORAGE_CACHE_MAX_BYTES", default=1024 ** 3, cast=int),
+    )
+    if name == "s3":
+        return S3Storage(
+            bucket=config("STORAGE_S3_BUCKET"),
+            endpoint_url=config("STORAGE_S3_ENDPOINT_URL", default=None),
+            region=config("STORAGE_S3_REGION", default=None),
+            public_url=config("STORAGE_S3_PUBLIC_URL", default=None),
+            max_connections=config("STORAGE_S3_MAX_CONNECTIONS", default=20, cast=int),
+            part_size=config("STORAGE_S3_PART_SIZE", default=8 * 1024 * 1024, cast=int),
+            cache=cache,
+        )
+    if name == "memory":
+        return MemoryStorage(config("SERVICE_URL"), cache)
+    raise ValueError(f"Unknown storage backend: {name}")
+
+
+storage = create_storage(config("STORAGE_BACKEND", default="local"))
+
+
+class SavedUpload(NamedTuple):
+    temporary_key: str
+    content_hash: str
+
+
+async def save_uploaded_file(image: UploadFile) -> SavedUpload:
+    """
+    Streams the upload to a temporary file in the storage chunk by chunk, calculating its SHA-256 on the way.
+    Memory usage doesn't depend on the file size.
+    The file should be then moved to its place with `move_uploaded_file` or removed with `discard_uploaded_file`.
+    """
+
+    temporary_key = f"{TEMPORARY_DIRECTORY}/{uuid4().hex}"
+    writer = await to_thread.run_sync(storage.open_writer, temporary_key)
+    content_hash = hashlib.sha256()
+    try:
+        while chunk := await image.read(READ_CHUNK_SIZE):
+            content_hash.update(chunk)
+            await to_thread.run_sync(writer.write, chunk)
+    except BaseException:
+        await to_thread.run_sync(writer.abort)
+        raise
+    await to_thread.run_sync(writer.commit)
+
+    return SavedUpload(temporary_key, content_hash.hexdigest())
+
+
+def get_image_key(unique_id: str, filename: str) -> str:
+    extension = Path(filename).suffix
+    return f"{IMAGES_DIRECTORY}/{unique_id[:2]}/{unique_id[2:4]}/{unique_id}{extension}"
+
+
+async def move_uploaded_file(unique_id: str, filename: str, upload: SavedUpload) -> str:
+    """
+    Moves the saved upload under its final key. Returns the key.
+    """
 
+    key = get_image_key(unique_id, filename)
+    await to_thread.run_sync(storage.move, upload.temporary_key, key)
+    return key
 
-async def save_uploaded_file(unique_id: str, image: UploadFile) -> Path:
-    base_dir = Path(config("STORAGE_DIR"))
-    extension = Path(image.filename).suffix
-    filename = f'{unique_id}{extension}'
-    destination_directory = base_dir / IMAGES_DIRECTORY / unique_id[:2] / unique_id[2:4]
-    destination_directory.mkdir(parents=True, exist_ok=True)
 
-    destination_path = destination_directory / filename
-    async with aiofiles.open(destination_path, "wb") as out_file:
-        content = await image.read()
-        await out_file.write(content)
+def save_image_file(unique_id: str, filename: str, content: bytes) -> str:
+    """
+    Synchronous version of saving a file, which content is already in memory (e.g. in bulk import).
+    """
 
-    return destination_path
+    key = get_image_key(unique_id, filename)
+    storage.write_bytes(key, content)
+    return key
 
 
-def get_image_public_url(image: Image) -> HttpUrl:
-    return HttpUrl(urljoin(config("SERVICE_URL"), image.path))
+async def discard_uploaded_file(upload: SavedUpload):
+    # Nothing is removed after the file was moved
+    await to_thread.run_sync(storage.delete, upload.temporary_key)
@@ -0,0 +1,22 @@
+import time
+from contextlib import contextmanager
+
+
+class StageTimings:
+    """
+    Durations of named stages of a request, reported to clients in the `Server-Timing` header.
+    """
+
+    def __init__(self):
+        self.durations: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0.0) + time.perf_counter() - start
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={duration * 1000:.2f}" for name, duration in self.durations.items())
@@ -0,0 +1,85 @@
+"""
+Long-lived worker running jobs in its own process, without forking a work horse for every job.
+
+Forking rq worker starts every job in a fresh copy of itself, so each job imports OpenCV, scikit-image and the app
+again, opens a new database connection and calculates Gabor kernels from scratch. `WarmWorker` loads all of it
+once, before the first job, and keeps it between jobs. It's meant to be run by rq worker pool, which limits
+the number of jobs run at once to the number of its workers and starts a new worker when one of them dies:
+
+    rq worker-pool high default -n 2 -c queue_settings -w similarities.worker.WarmWorker
+
+An exception raised by a job fails only the job. A crash of the whole process (e.g. in native code) or a stop
+requested by the memory watchdog ends the worker, the pool replaces it with a fresh one.
+"""
+import logging
+import os
+import resource
+
+from decouple import config
+from prometheus_client import start_http_server
+from rq.job import Job
+from rq.queue import Queue
+
+from similarities.db import engine, get_session_instance
+from similarities.metrics import WORKER_METRICS_PORT, MetricsSimpleWorker, metrics_registry
+
+
+logger = logging.getLogger(__name__)
+
+# Worker stops after the job which made its resident memory grow above the limit, 0 disables the watchdog
+WORKER_MAX_RSS_MB = config("WORKER_MAX_RSS_MB", default=2048, cast=int)
+
+
+def warm_up():
+    """
+    Imports the modules of the jobs and opens a database connection, so the first job doesn't wait for them.
+    """
+
+    import similarities.indexes  # noqa: F401
+    import similarities.neighbours  # noqa: F401
+    import similarities.processing  # noqa: F401
+
+    with engine.connect():
+        pass  # Connection is kept in the pool
+
+
+def resident_memory_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak usage, only Linux has the current one
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class WarmWorker(MetricsSimpleWorker):
+    def work(self, *args, **kwargs):
+        warm_up()
+        return super().work(*args, **kwargs)
+
+    def start_metrics_server(self):
+        # Workers of a pool can't clear the directory, other workers are writing there. It's empty when the pool
+        # starts in a new container. One of the workers serves aggregated metrics of all of them.
+        if multiprocess_directory := os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            os.makedirs(multiprocess_directory, exist_ok=True)
+        try:
+            start_http_server(WORKER_METRICS_PORT, registry=metrics_registry())
+        except OSError:
+            logger.info("Metrics port %d is used, metrics are served by another worker", WORKER_METRICS_PORT)
+
+    def execute_job(self, job: Job, queue: Queue):
+        try:
+            return super().execute_job(job, queue)
+        finally:
+            # Session is shared by the jobs run in the process. Closing it returns the connection to the pool
+            # and drops loaded objects, so a failed job doesn't leave a broken transaction to the next one.
+            get_session_instance().close()
+            self._check_memory()
+
+    def _check_memory(self):
+        rss_mb = resident_memory_bytes() / 2**20
+        if WORKER_MAX_RSS_MB and rss_mb > WORKER_MAX_RSS_MB:
+            logger.warning(
+                "Worker %s uses %.0fMB of memory (limit %dMB), stopping", self.name, rss_mb, WORKER_MAX_RSS_MB
+            )
+            self._stop_requested = True
@@ -1,41 +1,73 @@
 import os
 from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+# Set before the storage is created on import of the app
+os.environ["STORAGE_DIR"] = TemporaryDirectory(prefix='storagetest').name
 
 import pytest
 from decouple import config
 from fastapi.testclient import TestClient
-from sqlalchemy.orm import sessionmaker
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlmodel import Session, SQLModel, create_engine, delete
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app import app
-from similarities.db import get_session
+from similarities.db import get_session, get_session_maker
+from similarities.jobs import histogram_job_buffer
+from similarities.metrics import instrument_engine
+from similarities.models import Image, NeighbourList
 
 
 test_db_url = config("DATABASE_URL").rsplit("/", 1)[0] + "/test_db"
 engine = create_engine(test_db_url)
+# TestClient runs every request in a new event loop and pooled connections can't be shared between loops
+async_engine = create_async_engine(test_db_url, poolclass=NullPool)
+async_session_maker = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+instrument_engine(async_engine.sync_engine)
 
 SQLModel.metadata.create_all(engine)
 
-os.environ["STORAGE_DIR"] = TemporaryDirectory(prefix='storagetest').name
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def unbuffered_histogram_jobs():
+    # Buffer is shared by the whole process, ids left pending by one test would be flushed by the next one
+    with patch.multiple(histogram_job_buffer, max_size=1, _pending=[], _oldest_pending_at=None):
+        yield
+
 
 @pytest.fixture(scope="function", name="session")
 def db_session():
-    connection = engine.connect()
-    transaction = connection.begin()
-    TestSessionLocal = sessionmaker(class_=Session, autocommit=False, autoflush=False, bind=engine)
-    session = TestSessionLocal(bind=connection)
+    # API uses its own connections, so data created in tests is committed and removed afterwards
+    session = Session(engine)
     yield session
+    session.rollback()
+    session.exec(delete(Image))
+    session.exec(delete(NeighbourList))
+    session.commit()
     session.close()
-    transaction.rollback()
-    connection.close()
+
+
+@pytest.fixture(scope="function", name="async_session")
+async def db_async_session(session: Session):
+    async with async_session_maker() as async_session:
+        yield async_session
 
 
 @pytest.fixture(scope="function", name="client")
 def test_client(session: Session):
-    def get_session_override():
-        return session
+    async def get_session_override():
+        async with async_session_maker() as async_session:
+            yield async_session
 
     app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_session_maker] = lambda: async_session_maker
 
     test_client = TestClient(app)
     yield test_client
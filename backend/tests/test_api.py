@@ -1,16 +1,28 @@
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+from pathlib import Path
 from tempfile import NamedTemporaryFile
 from unittest.mock import patch
+from uuid import uuid4
 
 import cv2
 import numpy as np
+import pytest
+from decouple import config
 from fastapi.testclient import TestClient
 from sqlalchemy import func
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app import app
 from similarities.models import Image
 from similarities.processing import update_image_histograms
-from similarities.serializers import SearchType
+from similarities.query_image import BoundedExecutor, ExecutorBusy
+from similarities.serializers import SearchType, SimilarImagesResponse
+from similarities.storage import TEMPORARY_DIRECTORY
 from tests import assets
 
 
@@ -30,7 +42,7 @@ def get_temp_corrupted_image() -> NamedTemporaryFile:
     return tmp_file
 
 
-@patch("similarities.api.queue.enqueue")
+@patch("similarities.jobs.queue.enqueue_many")
 def test_successful_image_upload(mocked_queue, session: Session, client: TestClient):
     assert session.scalar(select(func.count(Image.id))) == 0
 
@@ -51,7 +63,7 @@ def test_successful_image_upload(mocked_queue, session: Session, client: TestCli
     assert mocked_queue.assert_called_once
 
 
-@patch("similarities.api.queue.enqueue")
+@patch("similarities.jobs.queue.enqueue_many")
 def test_if_returns_error_when_no_image_send(mocked_queue, session: Session, client: TestClient):
     assert session.scalar(select(func.count(Image.id))) == 0
 
@@ -66,7 +78,7 @@ def test_if_returns_error_when_no_image_send(mocked_queue, session: Session, cli
     assert mocked_queue.assert_not_called
 
 
-@patch("similarities.api.queue.enqueue")
+@patch("similarities.jobs.queue.enqueue_many")
 def test_returning_unsupported_media_type_when_uploaded_file_has_no_image_content(
         mocked_queue, session: Session, client: TestClient
 ):
@@ -81,6 +93,95 @@ def test_returning_unsupported_media_type_when_uploaded_file_has_no_image_conten
     assert mocked_queue.assert_not_called
 
 
+@patch("similarities.models.MAX_IMAGE_PIXELS", 100 * 100 - 1)
+@patch("similarities.jobs.queue.enqueue_many")
+def test_returning_error_when_uploaded_image_dimensions_are_too_large(
+        mocked_queue, session: Session, client: TestClient
+):
+    response = client.post("/upload", files={"image": get_temp_image()})
+
+    assert response.status_code == 413
+    assert "Image dimensions too large" in response.json()["detail"]
+    assert session.scalar(select(func.count(Image.id))) == 0
+    mocked_queue.assert_not_called()
+
+
+@patch("similarities.processing.get_session_instance")
+@patch("similarities.jobs.queue.enqueue_many")
+def test_reusing_file_and_histograms_of_already_uploaded_image(
+        mocked_queue, mock_get_session, session: Session, client: TestClient
+):
+    mock_get_session.return_value = session
+    image_file = get_temp_image()
+
+    first_response = client.post("/upload", files={"image": open(image_file.name, "rb")})
+    first_image_obj = session.get(Image, first_response.json()["id"])
+    update_image_histograms(str(first_image_obj.id))
+    second_response = client.post("/upload", files={"image": open(image_file.name, "rb")})
+
+    assert second_response.status_code == 201
+    mocked_queue.assert_called_once()
+    second_image_obj = session.get(Image, second_response.json()["id"])
+    assert second_image_obj.id != first_image_obj.id
+    assert second_image_obj.path == first_image_obj.path
+    assert second_image_obj.content_hash == first_image_obj.content_hash
+    assert second_image_obj.color_hist is not None
+    assert np.array_equal(second_image_obj.hog_hist, first_image_obj.hog_hist)
+    assert second_image_obj.processed_at is not None
+    assert list((Path(config("STORAGE_DIR")) / TEMPORARY_DIRECTORY).iterdir()) == []
+
+
+@patch("similarities.processing.get_session_instance")
+@patch("similarities.jobs.queue.enqueue_many")
+def test_processing_upload_of_duplicate_processed_before_upload_is_committed(
+        mocked_queue, mock_get_session, session: Session, client: TestClient
+):
+    mock_get_session.return_value = session
+    image_file = get_temp_image()
+    first_response = client.post("/upload", files={"image": open(image_file.name, "rb")})
+    first_image_id = first_response.json()["id"]
+    commit = AsyncSession.commit
+
+    async def process_duplicate_and_commit(self):
+        update_image_histograms(first_image_id)  # Worker doesn't see the new image yet
+        await commit(self)
+
+    with patch.object(AsyncSession, "commit", process_duplicate_and_commit):
+        second_response = client.post("/upload", files={"image": open(image_file.name, "rb")})
+
+    second_image_id = second_response.json()["id"]
+    assert session.get(Image, second_image_id).color_hist is None
+    assert mocked_queue.call_count == 2
+    assert all(job_data.args[0] == [second_image_id] for job_data in mocked_queue.call_args.args[0])
+
+
+@patch("similarities.jobs.queue.enqueue_many")
+def test_uploading_batch_of_images(mocked_queue, session: Session, client: TestClient):
+    image_file = get_temp_image()
+    other_image_file = get_temp_image("png")
+
+    response = client.post("/upload/batch", files=[
+        ("images", ("first.jpg", open(image_file.name, "rb"), "image/jpeg")),
+        ("images", ("corrupted.jpg", get_temp_corrupted_image(), "image/jpeg")),
+        ("images", ("other.png", open(other_image_file.name, "rb"), "image/png")),
+        ("images", ("first_again.jpg", open(image_file.name, "rb"), "image/jpeg")),
+    ])
+
+    assert response.status_code == 201
+    entries = response.json()["images"]
+    assert [entry["filename"] for entry in entries] == ["first.jpg", "corrupted.jpg", "other.png", "first_again.jpg"]
+    assert entries[1]["id"] is None
+    assert "Unsupported content type or corrupted image" in entries[1]["error"]
+    assert session.scalar(select(func.count(Image.id))) == 3
+
+    first_image_obj = session.get(Image, entries[0]["id"])
+    duplicate_image_obj = session.get(Image, entries[3]["id"])
+    assert duplicate_image_obj.path == first_image_obj.path
+    assert session.get(Image, entries[2]["id"]).path != first_image_obj.path
+    # Duplicate gets histograms of the first image when it's processed
+    assert {job_data.args[0][0] for job_data in mocked_queue.call_args.args[0]} == {entries[0]["id"], entries[2]["id"]}
+
+
 def test_returning_redirection_for_existing_image(session: Session, client: TestClient):
     unique_id = "a17b8434-a467-46d3-8f36-0c5863781f75"
     image = Image(id=unique_id, path="/storage/ab/cd/a17b8434-a467-46d3-8f36-0c5863781f75.jpg")
@@ -119,6 +220,9 @@ def test_returning_similar_images(mock_get_session, session: Session, client: Te
     assert response_json["status"] == "ok"
     assert response_json["image_url"].endswith(requested_kiwi["path"])
     assert len(response_json["similar_images"]) == 8
+    assert all("/derivatives/thumbnail/" in image["thumbnail_url"] for image in response_json["similar_images"])
+    # Response is serialized without the model, but it still matches it
+    assert SimilarImagesResponse.model_validate(response_json).model_dump(mode="json") == response_json
 
     response = client.get(f"/similar/{requested_kiwi['id']}/{SearchType.OBJECTS.value}")
 
@@ -166,8 +270,139 @@ def test_limiting_similar_images_to_requested_max_distance(mock_get_session, ses
     assert len(response_json["similar_images"]) == len(images_under_max_distance)
 
 
-def test_returning_processing_status_when_requested_histogram_not_ready(session: Session, client: TestClient):
-    image_id = "77777777-4444-4444-1111-222263781f75"
+@patch("similarities.jobs.priority_queue.enqueue")
+@patch("similarities.processing.get_session_instance")
+def test_returning_similar_images_of_batch_as_ndjson(
+        mock_get_session, mocked_enqueue, session: Session, client: TestClient
+):
+    mock_get_session.return_value = session
+
+    images_to_load = _load_images(session)
+    processing_id = "77777777-4444-4444-1111-222263781f75"
+    session.add(Image(id=processing_id, path=str(assets.IMAGES["apples"][0])))
+    session.commit()
+    nonexistent_id = "77777777-4444-4444-1111-0c5863781f75"
+
+    requested_ids = [images_to_load[0]["id"], images_to_load[-1]["id"], processing_id, nonexistent_id]
+    response = client.post(
+        "/similar/batch",
+        json={"image_ids": requested_ids, "search_types": [SearchType.COLORS.value, SearchType.TEXTURE.value]},
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    entries = [json.loads(line) for line in response.text.splitlines()]
+    assert [(entry["image_id"], entry["search_type"]) for entry in entries] == [
+        (image_id, search_type.value)
+        for search_type in [SearchType.COLORS, SearchType.TEXTURE]
+        for image_id in requested_ids
+    ]
+    assert [entry["status"] for entry in entries[:4]] == ["ok", "ok", "processing", "not_found"]
+    for entry in entries[:2] + entries[4:6]:
+        single_response = client.get(f"/similar/{entry['image_id']}/{entry['search_type']}").json()
+        assert entry["similar_images"] == single_response["similar_images"]
+
+
+def test_returning_similar_images_of_batch_when_too_many_images_requested(session: Session, client: TestClient):
+    with patch("similarities.api.SIMILAR_BATCH_MAX_IMAGES", 1):
+        response = client.post(
+            "/similar/batch",
+            json={"image_ids": [str(uuid4()), str(uuid4())], "search_types": [SearchType.COLORS.value]},
+        )
+
+    assert response.status_code == 422
+
+
+@patch("similarities.processing.get_session_instance")
+def test_returning_similar_images_by_combined_search_types(mock_get_session, session: Session, client: TestClient):
+    mock_get_session.return_value = session
+
+    images_to_load = _load_images(session)
+
+    requested_kiwi = images_to_load[-1]
+    response = client.get(f"/similar/{requested_kiwi['id']}/combined", params={"colors": 1, "objects": 0.5})
+
+    assert response.status_code == 200
+    response_json = response.json()
+    assert response_json["status"] == "ok"
+    assert len(response_json["similar_images"]) == 8
+    assert all(0 <= image["distance"] <= 1 for image in response_json["similar_images"])
+    assert "candidates-colors;dur=" in response.headers["server-timing"]
+    assert "candidates-texture" not in response.headers["server-timing"]
+
+    response = client.get(f"/similar/{requested_kiwi['id']}/combined", params={"colors": -1})
+
+    assert response.status_code == 422
+
+
+@patch("similarities.processing.get_session_instance")
+def test_returning_similar_images_of_query_image_without_storing_it(
+        mock_get_session, session: Session, client: TestClient
+):
+    mock_get_session.return_value = session
+
+    images_to_load = _load_images(session)
+    requested_kiwi = images_to_load[-1]
+    expected = client.get(f"/similar/{requested_kiwi['id']}/{SearchType.TEXTURE.value}").json()
+
+    with open(requested_kiwi["path"], "rb") as image_file:
+        response = client.post(
+            f"/similar/query/{SearchType.TEXTURE.value}",
+            files={"image": ("kiwi.jpg", image_file, "image/jpeg")},
+            params={"limit": 9},
+        )
+
+    assert response.status_code == 200
+    assert "histogram;dur=" in response.headers["server-timing"]
+    similar_images = response.json()["similar_images"]
+    # Stored copy of the query image is the closest one
+    assert similar_images[0]["url"].endswith(requested_kiwi["path"])
+    assert similar_images[0]["distance"] < 1e-4
+    assert [image["url"] for image in similar_images[1:]] == [image["url"] for image in expected["similar_images"]]
+    assert session.exec(select(func.count()).select_from(Image)).one() == len(images_to_load)
+
+
+def test_returning_service_unavailable_when_too_many_query_images_processed(session: Session, client: TestClient):
+    with (
+        get_temp_image() as tmp_file,
+        patch("similarities.query_image.query_image_executor._slots", threading.BoundedSemaphore(0)),
+    ):
+        response = client.post(
+            f"/similar/query/{SearchType.COLORS.value}", files={"image": ("image.jpg", tmp_file, "image/jpeg")}
+        )
+
+    assert response.status_code == 503
+
+
+@pytest.mark.anyio
+async def test_query_image_slot_is_kept_until_cancelled_task_ends():
+    executor = BoundedExecutor(max_workers=1, max_pending=1)
+    task_started, task_release = threading.Event(), threading.Event()
+
+    def blocking_task():
+        task_started.set()
+        task_release.wait(5)
+
+    request = asyncio.create_task(executor.run(blocking_task))
+    await asyncio.to_thread(task_started.wait, 5)
+    request.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await request
+
+    # Thread of the cancelled request still runs
+    with pytest.raises(ExecutorBusy):
+        await executor.run(len, [])
+    task_release.set()
+    await asyncio.sleep(0.1)
+    assert await executor.run(len, []) == 0
+    executor.shutdown()
+
+
+@patch("similarities.jobs.priority_queue.enqueue")
+def test_returning_processing_status_when_requested_histogram_not_ready(
+        mocked_enqueue, session: Session, client: TestClient
+):
+    image_id = str(uuid4())
     image = Image(id=image_id, path=str(assets.IMAGES["apples"][0]))
     session.add(image)
     session.commit()
@@ -179,6 +414,9 @@ def test_returning_processing_status_when_requested_histogram_not_ready(session:
     assert response_json["status"] == "processing"
     assert response_json["image_url"].endswith(image.path)
     assert response_json["similar_images"] == []
+    # Histogram is calculated on demand, before images waiting in the default queue
+    mocked_enqueue.assert_called_once()
+    assert mocked_enqueue.call_args.args[1:] == ([image_id], [SearchType.COLORS.value])
 
 
 def test_similar_image_when_nonexistent_id_passed(session: Session, client: TestClient):
@@ -238,3 +476,14 @@ def _load_images(session: Session) -> list:
         update_image_histograms(entry["id"])
 
     return images_to_load
+
+
+def test_api_does_not_import_image_processing_libraries():
+    # Fresh process, this one has them imported by other tests
+    loaded = subprocess.run(
+        [sys.executable, "-c", "import sys, app; print(*sorted({name.split('.')[0] for name in sys.modules}))"],
+        check=True, capture_output=True, text=True,
+    ).stdout.split()
+
+    assert "cv2" not in loaded
+    assert "skimage" not in loaded
@@ -0,0 +1,81 @@
+import shutil
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+from uuid import uuid4
+
+import cv2
+import numpy as np
+import pytest
+from sqlmodel import Session, func, select
+
+from similarities.bulk_import import _import_file, import_images, read_directory, read_manifest
+from similarities.histograms import calculate_histograms
+from similarities.models import Image
+from similarities.processing import TEXTURE_FILTER, TEXTURE_MAX_SIDE, update_image_histograms
+from similarities.storage import storage
+from tests import assets
+from tests.conftest import engine
+
+
+def test_importing_directory_with_checkpoint(session: Session):
+    source_directory = TemporaryDirectory()
+    source = Path(source_directory.name)
+    (source / "fruit").mkdir()
+    shutil.copy(assets.IMAGES["apples"][0], source / "apple.jpg")
+    shutil.copy(assets.IMAGES["kiwi"][0], source / "fruit" / "kiwi.jpg")
+    shutil.copy(assets.IMAGES["apples"][0], source / "fruit" / "same_apple.jpg")
+    (source / "corrupted.png").write_bytes(b"qweqweqwe")
+    (source / "notes.txt").write_text("Not an image")
+    checkpoint_path = str(source / "checkpoint")
+
+    stats = import_images(read_directory(str(source)), checkpoint_path, workers=1, batch_size=2, engine=engine)
+
+    assert (stats.processed, stats.imported, stats.duplicates, stats.errors) == (4, 2, 1, 1)
+    assert session.scalar(select(func.count(Image.id))) == 2
+    imported_images = {storage.read(image.path): image for image in session.exec(select(Image))}
+    assert assets.IMAGES["apples"][0].read_bytes() in imported_images
+    kiwi = imported_images[assets.IMAGES["kiwi"][0].read_bytes()]
+    expected = calculate_histograms(cv2.imread(str(assets.IMAGES["kiwi"][0])), TEXTURE_MAX_SIDE, TEXTURE_FILTER)
+    assert np.allclose(kiwi.hog_hist, expected.hog)
+    assert np.allclose(kiwi.texture_hist, expected.texture)
+    assert kiwi.processed_at is not None
+
+    # Everything is done according to the checkpoint, new files sorted after the last imported one are imported
+    # when the import is continued. Files sorted before it don't shift the position it continues from.
+    (source / "more_fruit").mkdir()
+    shutil.copy(assets.IMAGES["bananas"][0], source / "more_fruit" / "banana.jpg")
+    shutil.copy(assets.IMAGES["bananas"][1], source / "fruit" / "banana.jpg")
+    manifest_path = source / "manifest.txt"
+    # Manifest lines are sorted when it's read, repeated ones are imported once
+    manifest_lines = list(read_directory(str(source)))
+    manifest_path.write_text("\n".join(reversed(manifest_lines + manifest_lines[-1:])))
+
+    stats = import_images(read_manifest(str(manifest_path)), checkpoint_path, workers=1, engine=engine)
+
+    assert (stats.processed, stats.imported) == (1, 1)
+    assert session.scalar(select(func.count(Image.id))) == 3
+
+
+def test_importing_unsorted_paths_fails():
+    paths = [str(assets.IMAGES["kiwi"][0]), str(assets.IMAGES["apples"][0])]
+
+    with pytest.raises(ValueError, match="not sorted"):
+        import_images(sorted(paths, reverse=True), workers=1, engine=engine)
+
+
+@patch("similarities.processing.PERCEPTUAL_DEDUPLICATION", True)
+@patch("similarities.processing.get_session_instance")
+def test_imported_and_uploaded_files_get_same_perceptual_hash(mock_get_session, session: Session):
+    mock_get_session.return_value = session
+    paths = [path for collection in assets.IMAGES.values() for path in collection]
+    images = [Image(id=uuid4(), path=str(path)) for path in paths]
+    session.add_all(images)
+    session.commit()
+
+    for path, image in zip(paths, images):
+        imported_file = _import_file(str(path), TEXTURE_MAX_SIDE, TEXTURE_FILTER)
+        update_image_histograms(str(image.id))
+
+        session.refresh(image)
+        assert imported_file.row[3] == image.perceptual_hash, path
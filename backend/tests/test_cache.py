@@ -0,0 +1,67 @@
+from unittest.mock import MagicMock
+from uuid import uuid4
+
+import pytest
+import redis
+
+from similarities.cache import SimilarityResultCache
+from similarities.jobs import redis_conn
+from similarities.search import SimilarImage
+from similarities.serializers import SearchType
+
+
+def get_cache(**kwargs) -> SimilarityResultCache:
+    options = {"ttl": 60, "local_size": 10, "generation_check_interval": 60, "prefix": f"test-similar-{uuid4()}"}
+    options.update(kwargs)
+    return SimilarityResultCache(redis_conn, **options)
+
+
+@pytest.mark.anyio
+async def test_cached_results_are_returned_from_redis_and_then_from_local_cache():
+    image_id = uuid4()
+    results = [SimilarImage(uuid4(), "/storage/a.jpg", 0.5), SimilarImage(uuid4(), "/storage/b.jpg", 0.75)]
+    cache = get_cache()
+    key = await cache.key(image_id, SearchType.COLORS, 10, None)
+    assert await cache.get(key) is None
+
+    await cache.set(key, results)
+    other_process_cache = get_cache(prefix=cache.prefix)
+    other_key = await other_process_cache.key(image_id, SearchType.COLORS, 10, None)
+    assert other_key == key
+    assert await other_process_cache.get(other_key) == results
+    assert await other_process_cache.get(other_key) == results
+
+    assert await other_process_cache.key(image_id, SearchType.COLORS, 5, None) != key
+    assert await other_process_cache.key(image_id, SearchType.TEXTURE, 10, None) != key
+    assert await other_process_cache.key(image_id, SearchType.COLORS, 10, 1.5) != key
+    assert cache.stats["misses"] == 1
+    assert other_process_cache.stats["redis_hits"] == 1
+    assert other_process_cache.stats["local_hits"] == 1
+
+
+@pytest.mark.anyio
+async def test_invalidation_makes_results_of_all_processes_stale():
+    image_id = uuid4()
+    cache = get_cache(generation_check_interval=0)
+    other_process_cache = get_cache(prefix=cache.prefix, generation_check_interval=0)
+    key = await cache.key(image_id, SearchType.COLORS, 10, None)
+    await cache.set(key, [])
+    await other_process_cache.get(await other_process_cache.key(image_id, SearchType.COLORS, 10, None))
+
+    other_process_cache.invalidate()
+
+    assert await cache.get(await cache.key(image_id, SearchType.COLORS, 10, None)) is None
+    assert await other_process_cache.get(await other_process_cache.key(image_id, SearchType.COLORS, 10, None)) is None
+
+
+@pytest.mark.anyio
+async def test_cache_is_skipped_when_redis_is_not_available():
+    connection = MagicMock()
+    connection.get.side_effect = redis.ConnectionError
+    cache = SimilarityResultCache(connection, ttl=60, local_size=10, generation_check_interval=0)
+
+    key = await cache.key(uuid4(), SearchType.COLORS, 10, None)
+    assert key is None
+    assert await cache.get(key) is None
+    await cache.set(key, [])
+    assert cache.stats["errors"] == 1
@@ -0,0 +1,66 @@
+from unittest.mock import patch
+
+import cv2
+import numpy as np
+from sqlmodel import Session
+
+from similarities.derivatives import DerivativeKind, decode_image, get_derivative_key, read_working_image
+from similarities.derivatives import reduced_read_flag
+from similarities.models import Image
+from similarities.processing import update_image_histograms
+from similarities.storage import storage
+from tests import assets
+
+
+def test_reduced_read_flag_keeps_longer_side_at_least_max_side():
+    assert reduced_read_flag(4000, 3000, 1024) == cv2.IMREAD_REDUCED_COLOR_2
+    assert reduced_read_flag(3000, 9000, 1024) == cv2.IMREAD_REDUCED_COLOR_8
+    assert reduced_read_flag(1500, 1000, 1024) == cv2.IMREAD_COLOR
+    assert reduced_read_flag(4000, 3000, 0) == cv2.IMREAD_COLOR
+
+
+def test_decoding_image_limits_its_longer_side():
+    content = assets.IMAGES["kiwi"][0].read_bytes()
+    original = decode_image(content, 0)
+
+    image = decode_image(content, 100)
+
+    assert max(image.shape[:2]) == 100
+    assert abs(image.shape[0] / image.shape[1] - original.shape[0] / original.shape[1]) < 0.02
+
+
+@patch("similarities.derivatives.THUMBNAIL_MAX_SIDE", 64)
+@patch("similarities.derivatives.WORKING_COPY_MAX_SIDE", 200)
+def test_reading_working_image_writes_derivatives_and_reads_working_copy_later():
+    image_key = str(assets.IMAGES["apples"][1])
+    working_key = get_derivative_key(image_key, DerivativeKind.WORKING)
+    thumbnail_key = get_derivative_key(image_key, DerivativeKind.THUMBNAIL)
+    storage.delete(working_key)
+    storage.delete(thumbnail_key)
+
+    image = read_working_image(image_key)
+
+    assert max(image.shape[:2]) == 200
+    assert max(cv2.imread(str(storage.local_path(working_key))).shape[:2]) == 200
+    assert max(cv2.imread(str(storage.local_path(thumbnail_key))).shape[:2]) == 64
+
+    with patch("similarities.derivatives.read_image") as mock_read_image:
+        # Working copy is lossless, later jobs of the image calculate its histograms from the same pixels
+        assert np.array_equal(read_working_image(image_key), image)
+    mock_read_image.assert_not_called()
+    assert np.array_equal(decode_image(assets.IMAGES["apples"][1].read_bytes(), 200), image)
+
+
+@patch("similarities.processing.get_session_instance")
+def test_processing_image_writes_its_thumbnail(mock_get_session, session: Session):
+    mock_get_session.return_value = session
+    image_id = "cee6e8b5-6c21-47f8-8dc9-ea4bfcf07bfd"
+    image_key = str(assets.IMAGES["kiwi"][1])
+    thumbnail_key = get_derivative_key(image_key, DerivativeKind.THUMBNAIL)
+    storage.delete(thumbnail_key)
+    session.add(Image(id=image_id, path=image_key))
+    session.commit()
+
+    update_image_histograms(image_id)
+
+    assert storage.exists(thumbnail_key)
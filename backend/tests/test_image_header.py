@@ -0,0 +1,37 @@
+import struct
+
+import cv2
+import numpy as np
+
+from similarities.image_header import ImageHeader, read_image_header
+
+
+def encode_image(extension: str, width: int = 120, height: int = 80) -> bytes:
+    return cv2.imencode(extension, np.zeros((height, width, 3), np.uint8))[1].tobytes()
+
+
+def test_reading_png_header():
+    assert read_image_header(encode_image(".png")) == ImageHeader("png", 120, 80)
+
+
+def test_reading_jpeg_header():
+    progressive_jpeg = cv2.imencode(".jpg", np.zeros((80, 120, 3), np.uint8), [cv2.IMWRITE_JPEG_PROGRESSIVE, 1])[1]
+
+    assert read_image_header(encode_image(".jpg")) == ImageHeader("jpeg", 120, 80)
+    assert read_image_header(progressive_jpeg.tobytes()) == ImageHeader("jpeg", 120, 80)
+
+
+def test_reading_jpeg_header_after_metadata_segments():
+    jpeg = encode_image(".jpg")
+    exif_segment = b"\xff\xe1" + struct.pack(">H", 60002) + b"Exif\x00\x00" + bytes(59994)
+    jpeg_with_metadata = jpeg[:2] + exif_segment + jpeg[2:]
+
+    assert read_image_header(jpeg_with_metadata) == ImageHeader("jpeg", 120, 80)
+    assert read_image_header(jpeg_with_metadata[:1000]) is None
+
+
+def test_reading_header_of_unsupported_or_corrupted_file():
+    assert read_image_header(b"qweqweqwe") is None
+    assert read_image_header(b"") is None
+    assert read_image_header(encode_image(".bmp")) is None
+    assert read_image_header(encode_image(".png")[:20]) is None
@@ -0,0 +1,47 @@
+from unittest.mock import patch
+
+from similarities.indexes import IndexDefinition, desired_index, needs_rebuild
+
+
+@patch("similarities.indexes.VECTOR_INDEX_MIN_ROWS", 1000)
+@patch("similarities.indexes.VECTOR_INDEX_TYPE", "ivfflat")
+def test_desired_ivfflat_index_depends_on_rows_count():
+    assert desired_index(999) is None
+    assert desired_index(1000) == IndexDefinition("ivfflat", {"lists": "1"})
+    assert desired_index(500_000) == IndexDefinition("ivfflat", {"lists": "500"})
+    assert desired_index(4_000_000) == IndexDefinition("ivfflat", {"lists": "2000"})
+
+
+@patch("similarities.indexes.VECTOR_INDEX_MIN_ROWS", 1000)
+@patch("similarities.indexes.VECTOR_INDEX_TYPE", "hnsw")
+def test_desired_hnsw_index():
+    assert desired_index(999) is None
+    assert desired_index(1000) == IndexDefinition("hnsw", {"m": "16", "ef_construction": "64"})
+
+
+@patch("similarities.indexes.VECTOR_INDEX_MIN_ROWS", 1000)
+@patch("similarities.indexes.VECTOR_INDEX_TYPE", "hnsw")
+@patch("similarities.indexes.VECTOR_INDEX_PRECISION", "half")
+def test_desired_half_precision_index():
+    assert desired_index(1000) == IndexDefinition("hnsw halfvec_l2_ops", {"m": "16", "ef_construction": "64"})
+
+
+def test_index_rebuild_conditions():
+    hnsw = IndexDefinition("hnsw", {"m": "16", "ef_construction": "64"})
+    ivfflat = IndexDefinition("ivfflat", {"lists": "100"})
+
+    assert not needs_rebuild(None, None)
+    assert needs_rebuild(None, hnsw)
+    assert needs_rebuild(hnsw, None)
+    assert not needs_rebuild(hnsw, hnsw)
+    assert needs_rebuild(hnsw, IndexDefinition("hnsw", {"m": "32", "ef_construction": "64"}))
+    assert needs_rebuild(ivfflat, hnsw)
+    assert needs_rebuild(IndexDefinition("ivfflat vector_cosine_ops", {"lists": "100"}), ivfflat)
+    assert not needs_rebuild(ivfflat, IndexDefinition("ivfflat", {"lists": "150"}))
+    assert needs_rebuild(ivfflat, IndexDefinition("ivfflat", {"lists": "200"}))
+    assert needs_rebuild(ivfflat, IndexDefinition("ivfflat", {"lists": "50"}))
+    # Index created by older versions of the app without parameters has 100 lists
+    assert needs_rebuild(IndexDefinition("ivfflat", {}), IndexDefinition("ivfflat", {"lists": "300"}))
+    # Switching precision
+    assert needs_rebuild(hnsw, IndexDefinition("hnsw halfvec_l2_ops", {"m": "16", "ef_construction": "64"}))
+    assert needs_rebuild(IndexDefinition("ivfflat halfvec_l2_ops", {"lists": "100"}), ivfflat)
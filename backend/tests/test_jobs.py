@@ -0,0 +1,117 @@
+from unittest.mock import patch
+from uuid import uuid4
+
+import pytest
+
+from similarities.jobs import (
+    HistogramJobBuffer,
+    VECTOR_INDEXES_MAINTENANCE_KEY,
+    is_current_vector_indexes_maintenance,
+    redis_conn,
+    request_histograms,
+    schedule_vector_indexes_maintenance,
+)
+from similarities.serializers import SearchType
+
+
+def _enqueued_jobs(mocked_enqueue_many) -> list[tuple]:
+    return [job_data.args for job_data in mocked_enqueue_many.call_args.args[0]]
+
+
+@patch("similarities.jobs.queue.enqueue_many")
+def test_buffer_enqueues_job_per_search_type_when_full(mocked_enqueue_many):
+    buffer = HistogramJobBuffer(max_size=3, max_wait=60)
+
+    buffer.add("1")
+    buffer.add("2")
+    mocked_enqueue_many.assert_not_called()
+
+    buffer.add("3")
+    mocked_enqueue_many.assert_called_once()
+    assert _enqueued_jobs(mocked_enqueue_many) == [
+        (["1", "2", "3"], ["colors"]),
+        (["1", "2", "3"], ["objects"]),
+        (["1", "2", "3"], ["texture"]),
+    ]
+
+
+@patch("similarities.jobs.queue.enqueue_many")
+def test_buffer_splits_ids_added_at_once_into_jobs_of_max_size(mocked_enqueue_many):
+    buffer = HistogramJobBuffer(max_size=2, max_wait=60, search_types=[SearchType.COLORS])
+
+    buffer.add("1", "2", "3")
+
+    mocked_enqueue_many.assert_called_once()
+    assert _enqueued_jobs(mocked_enqueue_many) == [(["1", "2"], ["colors"]), (["3"], ["colors"])]
+
+
+@patch("similarities.jobs.queue.enqueue_many")
+def test_buffer_enqueues_pending_ids_after_max_wait(mocked_enqueue_many):
+    buffer = HistogramJobBuffer(max_size=100, max_wait=0, search_types=[SearchType.COLORS])
+
+    buffer.flush_expired()
+    mocked_enqueue_many.assert_not_called()
+
+    buffer.add("1")
+    buffer.add("2")
+    buffer.flush_expired()
+
+    mocked_enqueue_many.assert_called_once()
+    assert _enqueued_jobs(mocked_enqueue_many) == [(["1", "2"], ["colors"])]
+
+
+@patch("similarities.jobs.queue.enqueue_many", side_effect=ConnectionError)
+def test_buffer_keeps_pending_ids_when_enqueue_fails(mocked_enqueue_many):
+    buffer = HistogramJobBuffer(max_size=2, max_wait=60, search_types=[SearchType.COLORS])
+    buffer.add("1")
+    buffer.add("2")  # Failure is logged, the upload calling it succeeds
+
+    with pytest.raises(ConnectionError):
+        buffer.flush()
+
+    mocked_enqueue_many.side_effect = None
+    buffer.flush()
+    assert _enqueued_jobs(mocked_enqueue_many) == [(["1", "2"], ["colors"])]
+
+
+@patch("similarities.jobs.queue.enqueue_many")
+def test_buffer_without_eager_search_types_enqueues_nothing(mocked_enqueue_many):
+    buffer = HistogramJobBuffer(max_size=1, max_wait=0, search_types=[])
+
+    buffer.add("1")
+    buffer.flush()
+
+    mocked_enqueue_many.assert_not_called()
+
+
+@patch("similarities.jobs.priority_queue.enqueue")
+def test_requesting_histograms_enqueues_priority_job_once(mocked_enqueue):
+    image_ids = [uuid4(), uuid4()]
+
+    request_histograms(image_ids, SearchType.TEXTURE)
+    request_histograms([image_ids[0]], SearchType.TEXTURE)
+
+    mocked_enqueue.assert_called_once()
+    assert mocked_enqueue.call_args.args[1:] == ([str(image_id) for image_id in image_ids], ["texture"])
+
+
+@patch("similarities.jobs.queue.enqueue_in")
+@patch("similarities.jobs.queue.enqueue")
+def test_only_one_chain_of_vector_indexes_maintenance_jobs_is_started(mocked_enqueue, mocked_enqueue_in):
+    redis_conn.delete(VECTOR_INDEXES_MAINTENANCE_KEY)
+
+    schedule_vector_indexes_maintenance()
+    schedule_vector_indexes_maintenance()
+
+    mocked_enqueue.assert_called_once()
+    first_job_id = mocked_enqueue.call_args.kwargs["job_id"]
+    assert is_current_vector_indexes_maintenance(first_job_id)
+
+    schedule_vector_indexes_maintenance(next_run=True)
+
+    mocked_enqueue_in.assert_called_once()
+    next_job_id = mocked_enqueue_in.call_args.kwargs["job_id"]
+    assert next_job_id != first_job_id
+    assert is_current_vector_indexes_maintenance(next_job_id)
+    assert not is_current_vector_indexes_maintenance(first_job_id)
+    redis_conn.delete(VECTOR_INDEXES_MAINTENANCE_KEY)
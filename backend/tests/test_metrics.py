@@ -0,0 +1,39 @@
+from unittest.mock import patch
+from uuid import uuid4
+
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from rq import Queue
+
+from similarities.jobs import redis_conn
+from similarities.metrics import MetricsSimpleWorker
+from similarities.serializers import SearchType
+
+
+def test_exposing_request_and_database_metrics(client: TestClient):
+    client.get(f"/similar/{uuid4()}/{SearchType.TEXTURE.value}")
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert (
+        'similarities_request_duration_seconds_count{method="GET",route="/similar/{image_id}/{search_type}",'
+        'search_type="texture",status="404"}'
+    ) in response.text
+    assert 'similarities_db_query_duration_seconds_count{statement="select"}' in response.text
+
+
+def test_worker_measures_queue_wait_and_job_duration():
+    queue = Queue(f"test-metrics-{uuid4()}", connection=redis_conn)
+    queue.enqueue("similarities.histograms.calculate_perceptual_hash", None)  # Fails on missing image
+    labels = {"function": "similarities.histograms.calculate_perceptual_hash"}
+    waits_before = REGISTRY.get_sample_value("similarities_queue_wait_seconds_count", labels) or 0
+
+    with patch("similarities.metrics.WORKER_METRICS_PORT", 0):
+        MetricsSimpleWorker([queue], connection=redis_conn).work(burst=True)
+
+    assert REGISTRY.get_sample_value("similarities_queue_wait_seconds_count", labels) == waits_before + 1
+    assert REGISTRY.get_sample_value(
+        "similarities_job_duration_seconds_count", {**labels, "status": "failed"}
+    ) >= 1
+    queue.delete(delete_jobs=True)
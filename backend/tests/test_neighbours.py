@@ -0,0 +1,114 @@
+from unittest.mock import patch
+from uuid import UUID, uuid4
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from similarities.models import Image, NeighbourList, histogram_dimensions
+from similarities.neighbours import (
+    build_neighbour_lists,
+    get_neighbour_list,
+    merge_neighbours,
+    rebuild_neighbour_lists,
+    update_neighbour_lists,
+)
+from similarities.serializers import SearchType
+
+
+def _add_images(session: Session, positions: list[float]) -> list[UUID]:
+    # Images on a line, distance between two of them is the difference of their positions
+    image_ids = sorted(uuid4() for _ in positions)
+    for image_id, position in zip(image_ids, positions):
+        histogram = np.zeros(histogram_dimensions("color_hist"))
+        histogram[0] = position
+        session.add(Image(id=image_id, path=f"{image_id}.jpg", color_hist=histogram))
+    session.commit()
+    return image_ids
+
+
+def _neighbour_list(session: Session, image_id: UUID) -> list[tuple[UUID, float]]:
+    neighbour_list = session.exec(
+        select(NeighbourList).where(NeighbourList.image_id == image_id, NeighbourList.search_type == "colors")
+    ).one()
+    session.refresh(neighbour_list)
+    return list(zip(neighbour_list.neighbour_ids, neighbour_list.distances))
+
+
+def test_merging_new_neighbours_into_list():
+    assert merge_neighbours(["a", "b"], [1.0, 3.0], [("c", 2.0), ("d", 4.0)], size=2) == (["a", "c"], [1.0, 2.0])
+    assert merge_neighbours(["a", "b"], [1.0, 3.0], [("d", 4.0)], size=2) is None
+    assert merge_neighbours(["a"], [1.0], [("d", 4.0)], size=2) == (["a", "d"], [1.0, 4.0])
+    assert merge_neighbours(["a", "b"], [1.0, 3.0], [("a", 0.5)], size=2) is None  # Already in the list
+
+
+@patch("similarities.neighbours.NEIGHBOUR_LISTS_SIZE", 2)
+def test_new_image_gets_its_list_and_is_inserted_into_lists_of_images_it_beats(session: Session):
+    first, second, far = _add_images(session, [0.0, 1.5, 10.0])
+    with patch("similarities.neighbours.get_session_instance", return_value=session):
+        build_neighbour_lists([str(first), str(second), str(far)], SearchType.COLORS.value)
+
+    assert _neighbour_list(session, first) == [(second, 1.5), (far, 10.0)]
+    assert _neighbour_list(session, far) == [(second, 8.5), (first, 10.0)]
+
+    new_image = Image(id=uuid4(), path="new.jpg", color_hist=np.zeros(histogram_dimensions("color_hist")))
+    new_image.color_hist[0] = 0.5
+    session.add(new_image)
+    session.flush()
+    update_neighbour_lists(session, SearchType.COLORS, [new_image.id])
+    session.commit()
+
+    assert _neighbour_list(session, new_image.id) == [(first, 0.5), (second, 1.0)]
+    assert _neighbour_list(session, first) == [(new_image.id, 0.5), (second, 1.5)]
+    assert _neighbour_list(session, second) == [(new_image.id, 1.0), (first, 1.5)]
+    assert _neighbour_list(session, far) == [(second, 8.5), (new_image.id, 9.5)]
+
+
+@pytest.mark.anyio
+@patch("similarities.neighbours.NEIGHBOUR_LISTS_SIZE", 2)
+async def test_reading_neighbour_list(session: Session, async_session: AsyncSession):
+    first, second, far = _add_images(session, [0.0, 1.0, 10.0])
+    with patch("similarities.neighbours.get_session_instance", return_value=session):
+        build_neighbour_lists([str(first)], SearchType.COLORS.value)
+
+    results = await get_neighbour_list(async_session, SearchType.COLORS, first, limit=2)
+    assert [(result.id, result.path, result.distance) for result in results] == [
+        (second, f"{second}.jpg", 1.0), (far, f"{far}.jpg", 10.0)
+    ]
+    results = await get_neighbour_list(async_session, SearchType.COLORS, first, limit=2, max_distance=5)
+    assert [result.id for result in results] == [second]
+    # Lists can't answer searches of more images than they have or of images without a list
+    assert await get_neighbour_list(async_session, SearchType.COLORS, first, limit=3) is None
+    assert await get_neighbour_list(async_session, SearchType.COLORS, second, limit=2) is None
+
+
+@patch("similarities.neighbours.NEIGHBOUR_LISTS_SIZE", 2)
+def test_similar_images_are_served_from_neighbour_list(session: Session, client: TestClient):
+    first, second, far = _add_images(session, [0.0, 1.0, 10.0])
+    # List made up on purpose, to tell it apart from a live search
+    session.add(NeighbourList(image_id=first, search_type="colors", neighbour_ids=[far], distances=[0.1]))
+    session.commit()
+
+    response = client.get(f"/similar/{first}/colors", params={"limit": 2})
+
+    assert [image["distance"] for image in response.json()["similar_images"]] == [0.1]
+
+    response = client.get(f"/similar/{first}/colors", params={"limit": 3})
+
+    assert [image["distance"] for image in response.json()["similar_images"]] == [1.0, 10.0]
+
+
+@patch("similarities.jobs.queue.enqueue_many")
+def test_rebuild_enqueues_chunks_of_images(mocked_enqueue_many, session: Session):
+    image_ids = _add_images(session, [0.0, 1.0, 10.0])
+
+    with patch("similarities.neighbours.get_session_instance", return_value=session):
+        jobs = rebuild_neighbour_lists([SearchType.COLORS, SearchType.TEXTURE], chunk_size=2)
+
+    assert jobs == 2  # Images have no texture histograms
+    [job_data] = mocked_enqueue_many.call_args.args
+    assert [job.args for job in job_data] == [
+        ([str(image_ids[0]), str(image_ids[1])], "colors"), ([str(image_ids[2])], "colors")
+    ]
@@ -0,0 +1,197 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+from uuid import uuid4
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlmodel import Session, SQLModel, create_engine, func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from similarities.indexes import maintain_vector_indexes
+from similarities.models import Image, histogram_dimensions
+from similarities.partitions import create_missing_partitions, get_partitions, migrate
+from similarities.search import PartialResults, PartitionedSearchBackend, PostgresSearchBackend
+from similarities.serializers import SearchType
+from tests.conftest import test_db_url
+
+
+SCHEMA = "partitions_test"
+CONNECT_ARGS = {"options": f"-c search_path={SCHEMA},public"}
+
+
+@pytest.fixture(name="engine")
+def schema_engine():
+    # Separate schema, tables of the other tests are not partitioned
+    engine = create_engine(test_db_url, connect_args=CONNECT_ARGS)
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+    SQLModel.metadata.create_all(engine, checkfirst=False)
+
+    rng = np.random.default_rng(0)
+    with Session(engine) as session:
+        for index in range(60):
+            session.add(Image(
+                id=uuid4(),
+                path=f"{index}.jpg",
+                color_hist=rng.random(histogram_dimensions("color_hist")),
+                texture_hist=rng.random(histogram_dimensions("texture_hist")),
+            ))
+        session.commit()
+    with engine.begin() as connection:
+        migrate(connection, 3)
+
+    yield engine
+
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+    engine.dispose()
+
+
+@pytest.fixture(name="session_maker")
+async def schema_session_maker(engine):
+    async_engine = create_async_engine(test_db_url, poolclass=NullPool, connect_args=CONNECT_ARGS)
+    yield async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+    await async_engine.dispose()
+
+
+def test_migration_keeps_images_and_partitions_them(engine):
+    with engine.begin() as connection:
+        assert get_partitions(connection) == ["image_p0", "image_p1", "image_p2"]
+        partition_rows = dict(connection.execute(
+            text("SELECT tableoid::regclass::text, count(*) FROM image GROUP BY 1")
+        ).all())
+        assert partition_rows.keys() == {"image_p0", "image_p1", "image_p2"}
+        assert sum(partition_rows.values()) == 60
+
+        migrate(connection, 0)
+        assert get_partitions(connection) == []
+        assert connection.scalar(select(func.count()).select_from(Image)) == 60
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE image"))
+        Image.__table__.create(connection)  # Not partitioned, `IMAGE_PARTITIONS` is 0 in tests
+        with patch("similarities.partitions.logger") as logger:
+            create_missing_partitions(connection, 2)
+        assert logger.warning.called
+        assert get_partitions(connection) == []
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("search_type", [SearchType.COLORS, SearchType.TEXTURE])
+async def test_partitioned_search_returns_same_results_as_search_of_whole_table(search_type, session_maker):
+    backend = PartitionedSearchBackend(partition_timeout=5)
+    async with session_maker() as session:
+        images = (await session.exec(select(Image.id, Image.color_hist, Image.texture_hist).limit(3))).all()
+        histograms = {
+            image_id: {SearchType.COLORS: color, SearchType.TEXTURE: texture} for image_id, color, texture in images
+        }
+        for image_id, histogram in histograms.items():
+            for limit, max_distance in [(5, None), (100, None), (10, 1.0)]:
+                expected = await PostgresSearchBackend().search(
+                    session, search_type, histogram[search_type], image_id, limit, max_distance
+                )
+                results = await backend.search(
+                    session, search_type, histogram[search_type], image_id, limit, max_distance
+                )
+
+                assert not isinstance(results, PartialResults)
+                assert [result.id for result in results] == [result.id for result in expected]
+
+        queries = [(image_id, histogram[search_type]) for image_id, histogram in histograms.items()]
+        expected = await PostgresSearchBackend().search_many(session, search_type, queries, limit=7)
+        results = await backend.search_many(session, search_type, queries, limit=7)
+
+    assert {
+        image_id: [result.id for result in image_results] for image_id, image_results in results.items()
+    } == {
+        image_id: [result.id for result in image_results] for image_id, image_results in expected.items()
+    }
+
+
+@pytest.mark.anyio
+async def test_partitioned_search_returns_partial_results_when_partition_times_out(session_maker):
+    backend = PartitionedSearchBackend(partition_timeout=0.5)
+    search_table = PartitionedSearchBackend._search_table
+
+    async def slow_first_partition(self, session, table, *args):
+        if table.name == "image_p0":
+            await asyncio.sleep(5)
+        return await search_table(self, session, table, *args)
+
+    async with session_maker() as session:
+        histogram = (await session.exec(select(Image.color_hist).limit(1))).one()
+        first_partition_ids = set((await session.exec(text("SELECT id FROM image_p0"))).scalars())
+        with patch.object(PartitionedSearchBackend, "_search_table", slow_first_partition):
+            results = await backend.search(session, SearchType.COLORS, histogram, limit=100)
+
+    assert isinstance(results, PartialResults)
+    assert results.missing_partitions == 1
+    assert len(results) == 60 - len(first_partition_ids)
+    assert not first_partition_ids & {result.id for result in results}
+
+
+@pytest.mark.anyio
+async def test_partitioned_search_needs_one_pool_connection_per_partition(engine):
+    async_engine = create_async_engine(
+        test_db_url, pool_size=3, max_overflow=0, pool_timeout=1, connect_args=CONNECT_ARGS
+    )
+    backend = PartitionedSearchBackend(partition_timeout=5)
+    search_table = PartitionedSearchBackend._search_table
+    all_partitions_connected = asyncio.Barrier(3)
+
+    async def search_when_all_partitions_connected(self, session, table, *args):
+        await all_partitions_connected.wait()
+        return await search_table(self, session, table, *args)
+
+    try:
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            histogram = (await session.exec(select(Image.color_hist).limit(1))).one()
+            with patch.object(PartitionedSearchBackend, "_search_table", search_when_all_partitions_connected):
+                results = await backend.search(session, SearchType.COLORS, histogram, limit=100)
+    finally:
+        await async_engine.dispose()
+
+    assert not isinstance(results, PartialResults)
+    assert len(results) == 60
+
+
+@patch("similarities.api.result_cache.set")
+def test_partial_results_are_marked_and_not_cached(mocked_cache_set, session: Session, client: TestClient):
+    image = Image(id=uuid4(), path="image.jpg", color_hist=np.ones(histogram_dimensions("color_hist")))
+    session.add(image)
+    session.commit()
+
+    with patch("similarities.api.search_backend.search", AsyncMock(return_value=PartialResults([], 2))):
+        response = client.get(f"/similar/{image.id}/colors")
+
+    assert response.status_code == 200
+    assert response.headers["Search-Missing-Partitions"] == "2"
+    assert not mocked_cache_set.called
+
+
+@patch("similarities.indexes.VECTOR_INDEX_MIN_ROWS", 1)
+@patch("similarities.indexes.VECTOR_INDEX_TYPE", "hnsw")
+def test_indexes_are_built_on_all_partitions(engine):
+    valid_indexes = text(
+        "SELECT c.relname, c.reloptions FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+        "WHERE c.relname LIKE 'ix_image_color%' AND i.indisvalid ORDER BY 1"
+    )
+    index_names = ["ix_image_color", "ix_image_color_image_p0", "ix_image_color_image_p1", "ix_image_color_image_p2"]
+    with patch("similarities.indexes.engine", engine):
+        maintain_vector_indexes()
+        with engine.connect() as connection:
+            assert [name for name, _ in connection.execute(valid_indexes)] == index_names
+
+        with patch("similarities.indexes.HNSW_M", 8):
+            maintain_vector_indexes()
+        with engine.connect() as connection:
+            indexes = connection.execute(valid_indexes).all()
+
+    # Rebuilt index takes names of the old one
+    assert [name for name, _ in indexes] == index_names
+    assert all("m=8" in options for _, options in indexes)
@@ -1,18 +1,26 @@
+from tempfile import NamedTemporaryFile
 from unittest.mock import patch
 
 import cv2
+import numpy as np
+import pytest
 from sqlmodel import Session
 
 from similarities.histograms import(
     calculate_color_histogram,
+    calculate_histograms,
+    calculate_histograms_batch,
     calculate_hog_histogram,
     calculate_texture_histogram,
     COLOR_HISTOGRAM_VECTOR_SIZE,
     HOG_HISTOGRAM_VECTOR_SIZE,
     TEXTURE_HISTOGRAM_VECTOR_SIZE,
+    TextureFilter,
 )
 from similarities.models import Image
-from similarities.processing import update_image_histograms
+from similarities.parallel import HistogramPool
+from similarities.processing import UnreadableImages, update_image_histograms, update_images_histograms
+from similarities.serializers import SearchType
 from tests import assets
 
 
@@ -41,6 +49,135 @@ def test_if_histograms_calculation_updates_fields_in_db(mock_get_session, sessio
     assert image_obj.processed_at is not None
 
 
+@patch("similarities.processing.get_session_instance")
+def test_if_batch_histograms_calculation_updates_all_readable_images(mock_get_session, session: Session):
+    mock_get_session.return_value = session
+
+    image_ids = [
+        "00000000-6c21-47f8-8dc9-ea4bfcf07bfc",
+        "11111111-6c21-47f8-8dc9-ea4bfcf07bfc",
+        "22222222-6c21-47f8-8dc9-ea4bfcf07bfc",
+    ]
+    session.add(Image(id=image_ids[0], path=str(assets.IMAGES["apples"][0])))
+    session.add(Image(id=image_ids[1], path=str(assets.IMAGES["kiwi"][0])))
+    session.add(Image(id=image_ids[2], path="/nonexistent/image.png"))
+    session.commit()
+
+    with pytest.raises(UnreadableImages, match=image_ids[2]):
+        update_images_histograms(image_ids)
+
+    for image_id in image_ids[:2]:
+        image_obj = session.get(Image, image_id)
+        assert image_obj.color_hist is not None
+        assert image_obj.hog_hist is not None
+        assert image_obj.texture_hist is not None
+        assert image_obj.processed_at is not None
+
+    unreadable_image_obj = session.get(Image, image_ids[2])
+    assert unreadable_image_obj.color_hist is None
+    assert unreadable_image_obj.processed_at is None
+
+
+@patch("similarities.processing.get_session_instance")
+def test_calculating_histograms_of_single_search_type(mock_get_session, session: Session):
+    mock_get_session.return_value = session
+    image_id = "00000000-6c21-47f8-8dc9-ea4bfcf07bfc"
+    session.add(Image(id=image_id, path=str(assets.IMAGES["apples"][0])))
+    session.commit()
+
+    update_image_histograms(image_id, [SearchType.TEXTURE.value])
+
+    image_obj = session.get(Image, image_id)
+    assert image_obj.texture_hist is not None
+    assert image_obj.color_hist is None
+    assert image_obj.hog_hist is None
+    assert image_obj.processed_at is not None
+
+
+@patch("similarities.processing.get_session_instance")
+def test_retried_histograms_calculation_keeps_stored_histograms(mock_get_session, session: Session):
+    mock_get_session.return_value = session
+    image_id = "00000000-6c21-47f8-8dc9-ea4bfcf07bfc"
+    other_image_id = "11111111-6c21-47f8-8dc9-ea4bfcf07bfc"
+    session.add(Image(id=image_id, path=str(assets.IMAGES["apples"][0])))
+    session.add(Image(id=other_image_id, path=str(assets.IMAGES["kiwi"][0])))
+    session.commit()
+
+    def read_image_and_fail(images, unreadable_ids):
+        yield image_id, cv2.imread(str(assets.IMAGES["apples"][0]))
+        raise RuntimeError("Worker failed")
+
+    with patch("similarities.processing._read_images", side_effect=read_image_and_fail):
+        with pytest.raises(RuntimeError):
+            update_images_histograms([image_id, other_image_id], [SearchType.COLORS.value])
+
+    session.expire_all()
+    stored_histogram = session.get(Image, image_id).color_hist
+    assert stored_histogram is not None
+    assert session.get(Image, other_image_id).color_hist is None
+
+    with patch("similarities.processing.calculate_histograms", side_effect=calculate_histograms) as mock_calculate:
+        update_images_histograms([image_id, other_image_id], [SearchType.COLORS.value])
+
+    assert mock_calculate.call_count == 1  # Only the image which failed
+    session.expire_all()
+    assert np.array_equal(session.get(Image, image_id).color_hist, stored_histogram)
+    assert session.get(Image, other_image_id).color_hist is not None
+
+
+@patch("similarities.processing.get_session_instance")
+def test_if_histograms_calculation_updates_pending_duplicates(mock_get_session, session: Session):
+    mock_get_session.return_value = session
+
+    image_path = str(assets.IMAGES["apples"][0])
+    image_id = "00000000-6c21-47f8-8dc9-ea4bfcf07bfc"
+    duplicate_id = "11111111-6c21-47f8-8dc9-ea4bfcf07bfc"
+    other_image_id = "22222222-6c21-47f8-8dc9-ea4bfcf07bfc"
+    session.add(Image(id=image_id, path=image_path, content_hash="apple"))
+    session.add(Image(id=duplicate_id, path=image_path, content_hash="apple"))
+    session.add(Image(id=other_image_id, path=str(assets.IMAGES["kiwi"][0]), content_hash="kiwi"))
+    session.commit()
+
+    update_image_histograms(image_id)
+
+    image_obj = session.get(Image, image_id)
+    duplicate_obj = session.get(Image, duplicate_id)
+    assert np.array_equal(duplicate_obj.color_hist, image_obj.color_hist)
+    assert np.array_equal(duplicate_obj.hog_hist, image_obj.hog_hist)
+    assert np.array_equal(duplicate_obj.texture_hist, image_obj.texture_hist)
+    assert duplicate_obj.processed_at is not None
+    assert session.get(Image, other_image_id).processed_at is None
+
+
+@patch("similarities.processing.PERCEPTUAL_DEDUPLICATION", True)
+@patch("similarities.processing.calculate_histograms")
+@patch("similarities.processing.get_session_instance")
+def test_reusing_histograms_of_perceptually_same_image(mock_get_session, mock_calculate_histograms, session: Session):
+    mock_get_session.return_value = session
+    mock_calculate_histograms.side_effect = calculate_histograms
+
+    image_path = str(assets.IMAGES["apples"][0])
+    recompressed_image_file = NamedTemporaryFile(suffix=".jpg")
+    cv2.imwrite(recompressed_image_file.name, cv2.imread(image_path), [cv2.IMWRITE_JPEG_QUALITY, 80])
+
+    image_id = "00000000-6c21-47f8-8dc9-ea4bfcf07bfc"
+    recompressed_image_id = "11111111-6c21-47f8-8dc9-ea4bfcf07bfc"
+    session.add(Image(id=image_id, path=image_path))
+    session.add(Image(id=recompressed_image_id, path=recompressed_image_file.name))
+    session.commit()
+
+    update_image_histograms(image_id)
+    update_image_histograms(recompressed_image_id)
+
+    image_obj = session.get(Image, image_id)
+    recompressed_image_obj = session.get(Image, recompressed_image_id)
+    assert image_obj.perceptual_hash is not None
+    assert recompressed_image_obj.perceptual_hash == image_obj.perceptual_hash
+    assert np.array_equal(recompressed_image_obj.color_hist, image_obj.color_hist)
+    assert recompressed_image_obj.processed_at is not None
+    assert mock_calculate_histograms.call_count == 1
+
+
 def test_color_histogram_returns_expected_vector_size():
     image_size_1 = cv2.imread(str(assets.IMAGES["apples"][0]))
 
@@ -81,3 +218,60 @@ def test_hog_histogram_returns_right_vector_size():
     result = calculate_hog_histogram(image_size_2)
 
     assert len(result) == HOG_HISTOGRAM_VECTOR_SIZE
+
+
+def test_batch_histograms_are_identical_to_single_image_histograms():
+    images = [cv2.imread(str(path)) for path in assets.IMAGES["apples"] + assets.IMAGES["kiwi"]]
+
+    result = calculate_histograms_batch(images)
+
+    assert result.color.shape == (len(images), COLOR_HISTOGRAM_VECTOR_SIZE)
+    assert result.hog.shape == (len(images), HOG_HISTOGRAM_VECTOR_SIZE)
+    assert result.texture.shape == (len(images), TEXTURE_HISTOGRAM_VECTOR_SIZE)
+    for row, image in enumerate(images):
+        assert np.array_equal(result.color[row], calculate_color_histogram(image).astype(np.float32))
+        assert np.array_equal(result.hog[row], calculate_hog_histogram(image).astype(np.float32))
+        assert np.array_equal(result.texture[row], calculate_texture_histogram(image).astype(np.float32))
+
+
+def test_fft_texture_histogram_is_within_tolerance_of_spatial_one():
+    for path in assets.IMAGES["apples"] + assets.IMAGES["kiwi"]:
+        image = cv2.imread(str(path))
+
+        spatial_result = calculate_texture_histogram(image)
+        fft_result = calculate_texture_histogram(image, texture_filter=TextureFilter.FFT)
+
+        assert len(fft_result) == TEXTURE_HISTOGRAM_VECTOR_SIZE
+        assert np.allclose(fft_result, spatial_result, rtol=0, atol=1e-4)
+
+
+def test_downscaled_texture_histogram():
+    small_image = cv2.imread(str(assets.IMAGES["apples"][3]))
+    big_image = cv2.imread(str(assets.IMAGES["apples"][0]))
+    max_side = max(small_image.shape[:2])
+
+    not_downscaled_result = calculate_texture_histogram(small_image, max_side=max_side)
+    assert np.array_equal(not_downscaled_result, calculate_texture_histogram(small_image))
+
+    spatial_result = calculate_texture_histogram(big_image, max_side=max_side)
+    fft_result = calculate_texture_histogram(big_image, max_side=max_side, texture_filter=TextureFilter.FFT)
+    assert len(spatial_result) == TEXTURE_HISTOGRAM_VECTOR_SIZE
+    assert np.isclose(np.sum(spatial_result), 1)
+    assert np.allclose(fft_result, spatial_result, rtol=0, atol=1e-4)
+
+
+def test_histogram_pool_returns_same_histograms_as_single_process():
+    images = [(str(path), cv2.imread(str(path))) for path in assets.IMAGES["apples"]]
+    pool = HistogramPool(max_workers=2)
+    try:
+        results = list(pool.calculate_many(images, texture_filter=TextureFilter.FFT))
+        single_image_result = pool.calculate(images[0][1])
+    finally:
+        pool.shutdown()
+
+    assert [key for key, _ in results] == [key for key, _ in images]
+    for (_, image), (_, histograms) in zip(images, results):
+        assert np.array_equal(histograms.color, calculate_color_histogram(image))
+        assert np.array_equal(histograms.hog, calculate_hog_histogram(image))
+        assert np.array_equal(histograms.texture, calculate_texture_histogram(image, texture_filter=TextureFilter.FFT))
+    assert np.array_equal(single_image_result.texture, calculate_texture_histogram(images[0][1]))
@@ -0,0 +1,249 @@
+from unittest.mock import patch
+from uuid import uuid4
+
+import numpy as np
+import pytest
+from sqlalchemy import text
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from similarities.models import Image
+from similarities.processing import update_images_histograms
+from similarities.search import MemorySearchBackend, PostgresSearchBackend, VectorIndex, search_combined
+from similarities.serializers import SearchType, SEARCH_TYPE_TO_COLUMN_NAME
+from similarities.timing import StageTimings
+from tests import assets
+
+
+IMAGE_PATHS = assets.IMAGES["apples"] + assets.IMAGES["bananas"] + assets.IMAGES["kiwi"]
+
+
+@pytest.fixture(name="images")
+def processed_images(session: Session) -> list[Image]:
+    image_ids = [f"{index}{index}{index}{index}0000-a467-46d3-8f36-0c5863781f75" for index in range(len(IMAGE_PATHS))]
+    for image_id, path in zip(image_ids, IMAGE_PATHS):
+        session.add(Image(id=image_id, path=str(path)))
+    session.commit()
+
+    with patch("similarities.processing.get_session_instance", return_value=session):
+        update_images_histograms(image_ids)
+
+    return [session.get(Image, image_id) for image_id in image_ids]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("search_type", list(SearchType))
+async def test_memory_backend_returns_same_results_as_postgres_backend(
+        search_type, images: list[Image], async_session: AsyncSession
+):
+    query_image = images[-1]
+    histogram = getattr(query_image, SEARCH_TYPE_TO_COLUMN_NAME[search_type])
+    memory_backend = MemorySearchBackend(refresh_interval=60, refresh_overlap=60)
+
+    for limit, max_distance in [(5, None), (100, None), (100, 0.8)]:
+        expected = await PostgresSearchBackend().search(
+            async_session, search_type, histogram, query_image.id, limit, max_distance
+        )
+        result = await memory_backend.search(async_session, search_type, histogram, query_image.id, limit, max_distance)
+
+        assert [entry.id for entry in result] == [entry.id for entry in expected]
+        assert [entry.path for entry in result] == [entry.path for entry in expected]
+        assert np.allclose([entry.distance for entry in result], [entry.distance for entry in expected], atol=1e-5)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "backend", [PostgresSearchBackend(), MemorySearchBackend(refresh_interval=60, refresh_overlap=60)]
+)
+async def test_searching_many_images_returns_same_results_as_searching_one_by_one(
+        backend, images: list[Image], async_session: AsyncSession
+):
+    queries = [(image.id, image.texture_hist) for image in images]
+
+    results = await backend.search_many(async_session, SearchType.TEXTURE, queries, limit=3)
+
+    assert list(results) == [image.id for image in images]
+    for image_id, histogram in queries:
+        expected = await backend.search(async_session, SearchType.TEXTURE, histogram, image_id, limit=3)
+        assert [entry.id for entry in results[image_id]] == [entry.id for entry in expected]
+        assert np.allclose([entry.distance for entry in results[image_id]], [entry.distance for entry in expected])
+
+
+@pytest.mark.anyio
+async def test_memory_backend_loads_newly_processed_images(
+        images: list[Image], session: Session, async_session: AsyncSession
+):
+    memory_backend = MemorySearchBackend(refresh_interval=0, refresh_overlap=60)
+    query_image = images[0]
+    result = await memory_backend.search(async_session, SearchType.COLORS, query_image.color_hist, limit=100)
+    assert len(result) == len(images)
+
+    new_image_id = "cee6e8b5-6c21-47f8-8dc9-ea4bfcf07bfc"
+    session.add(Image(id=new_image_id, path=str(IMAGE_PATHS[0])))
+    session.commit()
+    with patch("similarities.processing.get_session_instance", return_value=session):
+        update_images_histograms([new_image_id])
+
+    result = await memory_backend.search(
+        async_session, SearchType.COLORS, query_image.color_hist, query_image.id, limit=100
+    )
+    assert len(result) == len(images)
+    assert result[0].id == session.get(Image, new_image_id).id
+    assert result[0].distance == pytest.approx(0, abs=1e-6)
+
+
+def test_vector_index_changes_are_not_visible_to_searches_until_published():
+    index = VectorIndex(initial_capacity=2)
+    image_ids = [uuid4() for _ in range(3)]
+    index.upsert(image_ids[0], "0.jpg", [0, 0])
+    index.upsert(image_ids[1], "1.jpg", [1, 0])
+    index.publish()
+    published_vectors = index._published.vectors
+    expected_vectors = published_vectors[:2].copy()
+
+    index.upsert(image_ids[1], "1.jpg", [5, 0])
+    index.upsert(image_ids[2], "2.jpg", [0.5, 0])
+
+    assert len(index) == 2
+    assert [result.id for result in index.search(np.zeros(2, np.float32), None, 10, None)] == image_ids[:2]
+    assert np.array_equal(published_vectors[:2], expected_vectors)  # Changed row is written to a copy
+
+    index.publish()
+
+    results = index.search(np.zeros(2, np.float32), image_ids[0], 10, None)
+    assert [result.id for result in results] == [image_ids[2], image_ids[1]]
+    assert [result.distance for result in results] == [0.5, 5]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("index_method", ["hnsw", "ivfflat"])
+async def test_postgres_backend_filters_results_when_index_is_used(
+        index_method, images: list[Image], async_session: AsyncSession
+):
+    # Index exists only in the transaction rolled back at the end of the test
+    await async_session.exec(
+        text(f"CREATE INDEX ix_test_color ON image USING {index_method} (color_hist vector_l2_ops)")
+    )
+    await async_session.exec(text("SET LOCAL enable_seqscan = off"))
+    query_image = images[0]
+    backend = PostgresSearchBackend()
+
+    result = await backend.search(
+        async_session, SearchType.COLORS, query_image.color_hist, query_image.id, limit=3, probes=10
+    )
+    assert len(result) == 3
+    assert query_image.id not in [entry.id for entry in result]
+
+    all_results = await backend.search(
+        async_session, SearchType.COLORS, query_image.color_hist, query_image.id, limit=100
+    )
+    max_distance = all_results[2].distance
+    result = await backend.search(
+        async_session, SearchType.COLORS, query_image.color_hist, query_image.id, limit=100,
+        max_distance=max_distance, ef_search=10,
+    )
+    await async_session.rollback()
+    assert [entry.id for entry in result] == [entry.id for entry in all_results[:3]]
+
+
+@pytest.mark.anyio
+@patch("similarities.search.MAX_HNSW_EF_SEARCH", 4)
+async def test_postgres_backend_scans_table_when_more_rows_requested_than_hnsw_returns(
+        images: list[Image], async_session: AsyncSession
+):
+    query_image = images[0]
+    exact_results = await PostgresSearchBackend().search(
+        async_session, SearchType.COLORS, query_image.color_hist, query_image.id, limit=100
+    )
+    # Index exists only in the transaction rolled back at the end of the test
+    await async_session.exec(text("CREATE INDEX ix_test_color ON image USING hnsw (color_hist vector_l2_ops)"))
+    await async_session.exec(text("SET LOCAL enable_seqscan = off"))
+
+    result = await PostgresSearchBackend().search(
+        async_session, SearchType.COLORS, query_image.color_hist, query_image.id, limit=100
+    )
+    index_scan = await async_session.scalar(text("SELECT current_setting('enable_indexscan')"))
+    await async_session.rollback()
+
+    assert len(exact_results) == len(images) - 1
+    assert [entry.id for entry in result] == [entry.id for entry in exact_results]
+    assert index_scan == "on"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("index_method", ["hnsw", "ivfflat"])
+async def test_postgres_backend_reranks_results_found_with_half_precision_index(
+        index_method, images: list[Image], async_session: AsyncSession
+):
+    vector_version = await async_session.scalar(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'"))
+    if tuple(map(int, vector_version.split("."))) < (0, 7):
+        pytest.skip(f"halfvec is not supported by pgvector {vector_version}")
+
+    query_image = images[0]
+    exact_results = await PostgresSearchBackend().search(
+        async_session, SearchType.OBJECTS, query_image.hog_hist, query_image.id, limit=3
+    )
+    # Index exists only in the transaction rolled back at the end of the test
+    await async_session.exec(text(
+        f"CREATE INDEX ix_image_hog ON image USING {index_method} ((hog_hist::halfvec(1764)) halfvec_l2_ops)"
+    ))
+    await async_session.exec(text("SET LOCAL enable_seqscan = off"))
+    backend = PostgresSearchBackend(index_check_interval=0)
+
+    result = await backend.search(
+        async_session, SearchType.OBJECTS, query_image.hog_hist, query_image.id, limit=3, probes=10
+    )
+    await async_session.rollback()
+
+    assert [entry.id for entry in result] == [entry.id for entry in exact_results]
+    # Distances are calculated with full vectors
+    assert [entry.distance for entry in result] == [entry.distance for entry in exact_results]
+
+
+@pytest.mark.anyio
+async def test_combined_search_ranks_candidates_by_weighted_normalized_distances(
+        images: list[Image], async_session: AsyncSession
+):
+    query_image = images[0]
+    weights = {SearchType.COLORS: 2.0, SearchType.TEXTURE: 1.0}
+    histograms = {
+        search_type: getattr(query_image, SEARCH_TYPE_TO_COLUMN_NAME[search_type]) for search_type in weights
+    }
+    timings = StageTimings()
+
+    # All the images are candidates, so the result is the same as ranking them directly
+    result = await search_combined(
+        PostgresSearchBackend(), async_session, histograms, weights, query_image.id, limit=100, timings=timings
+    )
+
+    others = images[1:]
+    distances = {
+        search_type: np.array([
+            np.linalg.norm(np.array(getattr(image, SEARCH_TYPE_TO_COLUMN_NAME[search_type])) - histograms[search_type])
+            for image in others
+        ])
+        for search_type in weights
+    }
+    expected_scores = sum(
+        weight * distances[search_type] / distances[search_type].max() for search_type, weight in weights.items()
+    ) / sum(weights.values())
+    expected_order = np.argsort(expected_scores, kind="stable")
+    assert [entry.id for entry in result] == [others[position].id for position in expected_order]
+    assert np.allclose([entry.distance for entry in result], expected_scores[expected_order], atol=1e-5)
+    assert set(timings.durations) == {"candidates-colors", "candidates-texture", "rerank"}
+
+
+@pytest.mark.anyio
+async def test_combined_search_with_single_search_type_returns_same_order_as_its_search(
+        images: list[Image], async_session: AsyncSession
+):
+    query_image = images[-1]
+    backend = PostgresSearchBackend()
+
+    expected = await backend.search(async_session, SearchType.OBJECTS, query_image.hog_hist, query_image.id, limit=5)
+    result = await search_combined(
+        backend, async_session, {SearchType.OBJECTS: query_image.hog_hist}, {SearchType.OBJECTS: 1.0},
+        query_image.id, limit=5,
+    )
+
+    assert [entry.id for entry in result] == [entry.id for entry in expected]
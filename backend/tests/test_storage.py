@@ -0,0 +1,206 @@
+import os
+import re
+import time
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from unittest.mock import PropertyMock, patch
+
+import pytest
+from botocore.exceptions import ClientError
+
+from similarities.storage import LocalStorage, MemoryStorage, ReadThroughCache, S3Storage, Storage
+
+
+class FakeS3Client:
+    """
+    In-memory bucket answering the calls made by `S3Storage` like S3 does.
+    """
+
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+        self.uploads: dict[str, dict[int, bytes]] = {}
+        self.calls: list[tuple[str, dict]] = []
+
+    def _content(self, operation: str, key: str, code: str = "NoSuchKey") -> bytes:
+        if key not in self.objects:
+            raise ClientError({"Error": {"Code": code, "Message": "Not Found"}}, operation)
+        return self.objects[key]
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append(("put_object", {"Key": Key, "size": len(Body)}))
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append(("upload_part", {"Key": Key, "PartNumber": PartNumber, "size": len(Body)}))
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append(("abort_multipart_upload", {"Key": Key}))
+        del self.uploads[UploadId]
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.calls.append(("get_object", {"Key": Key, "Range": Range}))
+        content = self._content("GetObject", Key)
+        if Range:
+            start, end = re.fullmatch(r"bytes=(\d+)-(\d*)", Range).groups()
+            content = content[int(start):int(end) + 1 if end else None]  # Range end is inclusive
+        return {"Body": BytesIO(content)}
+
+    def head_object(self, Bucket, Key):
+        self._content("HeadObject", Key, code="404")  # HEAD responses have no body with the error code
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self.calls.append(("copy_object", {"Key": Key, "CopySource": CopySource["Key"]}))
+        self.objects[Key] = self._content("CopyObject", CopySource["Key"])
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def download_fileobj(self, Bucket, Key, file):
+        file.write(self._content("HeadObject", Key, code="404"))
+
+
+def get_s3_storage(cache_directory: str, part_size: int = 5) -> tuple[S3Storage, FakeS3Client]:
+    client = FakeS3Client()
+    s3_storage = S3Storage(
+        "bucket", None, None, None, max_connections=1, part_size=part_size,
+        cache=ReadThroughCache(cache_directory, 1024 ** 2),
+    )
+    return s3_storage, client
+
+
+@pytest.fixture(params=["local", "memory", "s3"])
+def storage(request) -> Storage:
+    directory = TemporaryDirectory()
+    if request.param == "local":
+        yield LocalStorage(directory.name, "http://localhost")
+    elif request.param == "memory":
+        yield MemoryStorage("http://localhost", ReadThroughCache(directory.name, 1024 ** 2))
+    else:
+        s3_storage, client = get_s3_storage(directory.name)
+        with patch.object(S3Storage, "client", new_callable=PropertyMock, return_value=client):
+            yield s3_storage
+    directory.cleanup()
+
+
+def test_streamed_file_is_visible_only_after_commit(storage: Storage):
+    writer = storage.open_writer("images/a.jpg")
+    writer.write(b"first ")
+    writer.write(b"second")
+
+    assert not storage.exists("images/a.jpg")
+    writer.commit()
+    assert storage.read("images/a.jpg") == b"first second"
+
+    with pytest.raises(ValueError):
+        with storage.writer("images/b.jpg") as writer:
+            writer.write(b"partial")
+            raise ValueError()
+    assert not storage.exists("images/b.jpg")
+
+
+def test_reading_ranges_moving_and_deleting_files(storage: Storage):
+    storage.write_bytes("tmp/a", b"0123456789")
+
+    assert storage.read("tmp/a", 0, 4) == b"0123"
+    assert storage.read("tmp/a", 8) == b"89"
+
+    storage.move("tmp/a", "images/a.jpg")
+    assert not storage.exists("tmp/a")
+    assert storage.local_path("images/a.jpg").read_bytes() == b"0123456789"
+
+    storage.delete("images/a.jpg")
+    storage.delete("images/a.jpg")
+    with pytest.raises(FileNotFoundError):
+        storage.read("images/a.jpg")
+    with pytest.raises(FileNotFoundError):
+        storage.local_path("images/a.jpg")
+
+
+def test_public_urls_of_keys_and_absolute_paths():
+    storage = LocalStorage("/storage", "http://localhost")
+
+    assert storage.public_url("uploaded_images/ab/cd/a.jpg") == "http://localhost/storage/uploaded_images/ab/cd/a.jpg"
+    assert storage.public_url("/storage/uploaded_images/a.jpg") == "http://localhost/storage/uploaded_images/a.jpg"
+
+
+def test_read_through_cache_removes_least_recently_used_files():
+    directory = TemporaryDirectory()
+    cache = ReadThroughCache(directory.name, max_bytes=250)
+    downloads = []
+
+    def downloader(key):
+        def download(file):
+            downloads.append(key)
+            file.write(b"x" * 100)
+        return download
+
+    first_path = cache.get("a/first.jpg", downloader("first"))
+    second_path = cache.get("a/second.jpg", downloader("second"))
+    past = time.time() - 60
+    os.utime(first_path, (past, past))
+    os.utime(second_path, (past + 1, past + 1))
+    assert cache.get("a/first.jpg", downloader("first")) == first_path  # Read from the cache, marked as used
+    cache.get("b/third.jpg", downloader("third"))
+
+    assert downloads == ["first", "second", "third"]
+    assert first_path.exists()
+    assert not second_path.exists()
+
+
+def test_s3_storage_uploads_big_files_in_parts():
+    directory = TemporaryDirectory()
+    s3_storage, client = get_s3_storage(directory.name, part_size=4)
+    with patch.object(S3Storage, "client", new_callable=PropertyMock, return_value=client):
+        with s3_storage.writer("/images/small.jpg") as writer:
+            writer.write(b"abc")
+        with s3_storage.writer("images/big.jpg") as writer:
+            writer.write(b"01")
+            writer.write(b"234567")
+            writer.write(b"89")
+        with pytest.raises(ValueError):
+            with s3_storage.writer("images/aborted.jpg") as writer:
+                writer.write(b"0123456789")
+                raise ValueError()
+
+    assert client.objects == {"images/small.jpg": b"abc", "images/big.jpg": b"0123456789"}
+    assert client.uploads == {}
+    assert client.calls == [
+        ("put_object", {"Key": "images/small.jpg", "size": 3}),
+        ("upload_part", {"Key": "images/big.jpg", "PartNumber": 1, "size": 4}),
+        ("upload_part", {"Key": "images/big.jpg", "PartNumber": 2, "size": 4}),
+        ("upload_part", {"Key": "images/big.jpg", "PartNumber": 3, "size": 2}),
+        ("upload_part", {"Key": "images/aborted.jpg", "PartNumber": 1, "size": 4}),
+        ("upload_part", {"Key": "images/aborted.jpg", "PartNumber": 2, "size": 4}),
+        ("abort_multipart_upload", {"Key": "images/aborted.jpg"}),
+    ]
+
+
+def test_s3_storage_requests():
+    directory = TemporaryDirectory()
+    s3_storage, client = get_s3_storage(directory.name)
+    client.objects["tmp/a"] = b"0123456789"
+    with patch.object(S3Storage, "client", new_callable=PropertyMock, return_value=client):
+        assert s3_storage.read("tmp/a") == b"0123456789"
+        assert s3_storage.read("tmp/a", 2, 4) == b"23"
+        assert s3_storage.read("tmp/a", 8) == b"89"
+        s3_storage.move("tmp/a", "images/a.jpg")
+        with pytest.raises(FileNotFoundError):
+            s3_storage.move("tmp/a", "images/b.jpg")
+
+    assert [options["Range"] for operation, options in client.calls if operation == "get_object"] == [
+        None, "bytes=2-3", "bytes=8-"
+    ]
+    assert ("copy_object", {"Key": "images/a.jpg", "CopySource": "tmp/a"}) in client.calls
+    assert client.objects == {"images/a.jpg": b"0123456789"}
+    assert s3_storage.public_url("/images/a.jpg") == "https://bucket.s3.amazonaws.com/images/a.jpg"
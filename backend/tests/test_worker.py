@@ -0,0 +1,42 @@
+import os
+from unittest.mock import patch
+from uuid import uuid4
+
+from rq import Queue
+
+from similarities.jobs import redis_conn
+from similarities.worker import WarmWorker
+
+
+def _run_worker(queue: Queue) -> WarmWorker:
+    worker = WarmWorker([queue], connection=redis_conn)
+    with patch("similarities.worker.WORKER_METRICS_PORT", 0):
+        worker.work(burst=True)
+    return worker
+
+
+@patch("similarities.worker.get_session_instance")
+def test_warm_worker_runs_jobs_in_its_own_process_and_survives_failed_jobs(mock_get_session):
+    queue = Queue(f"test-worker-{uuid4()}", connection=redis_conn)
+    failed_job = queue.enqueue("similarities.histograms.calculate_perceptual_hash", None)
+    job = queue.enqueue("os.getpid")
+
+    _run_worker(queue)
+
+    assert failed_job.get_status(refresh=True) == "failed"
+    assert job.return_value() == os.getpid()
+    assert mock_get_session.return_value.close.call_count == 2  # Session of the jobs is closed after every one
+    queue.delete(delete_jobs=True)
+
+
+@patch("similarities.worker.WORKER_MAX_RSS_MB", 1)
+def test_warm_worker_stops_when_its_memory_grows_above_limit():
+    queue = Queue(f"test-worker-{uuid4()}", connection=redis_conn)
+    first_job = queue.enqueue("os.getpid")
+    second_job = queue.enqueue("os.getpid")
+
+    _run_worker(queue)
+
+    assert first_job.get_status(refresh=True) == "finished"
+    assert second_job.get_status(refresh=True) == "queued"  # Left for a new worker
+    queue.delete(delete_jobs=True)